@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Code analysis
+#
+# Before a piece of bytecode runs it is scanned once to find which offsets
+# are valid JUMP/JUMPI destinations: a JUMPDEST byte (0x5b) counts only if it
+# is an instruction, not a byte inside the data of an earlier PUSH.
+#
+# The result is cached in a bounded LRU keyed by the keccak hash of the code,
+# so calling into the same contract again reuses the decoded bytes and the
+# jump destination bitmap instead of redoing `bytes.fromhex` and the scan.
+# Code seen before is also found by its bytes, so a hit doesn't even hash it
+# again: the code hash is computed once per distinct piece of code.
+
+from collections import OrderedDict
+
+from hashing import keccak256
+
+JUMPDEST = 0x5b
+PUSH1 = 0x60
+PUSH32 = 0x7f
+
+DEFAULT_CACHE_SIZE = 1024
+
+
+class CodeAnalysis:
+    __slots__ = ('code', 'code_hash', 'jumpdests', 'blocks', 'compiled')
+
+    def __init__(self, code, code_hash=None):
+        self.code = code
+        self.code_hash = code_hash if code_hash is not None else keccak256(code)
+        self.jumpdests = jumpdest_bitmap(code)
+        # Decoded basic blocks, filled in by `basic_blocks.py` on first use
+        self.blocks = None
+        # Compiled blocks, filled in by `compiler.py` on first use
+        self.compiled = None
+
+    def is_jumpdest(self, offset):
+        return offset < len(self.jumpdests) and self.jumpdests[offset] == 1
+
+
+def jumpdest_bitmap(code):
+    # One byte per code byte, 1 where a valid JUMPDEST is
+    bitmap = bytearray(len(code))
+    pc = 0
+    n = len(code)
+    while pc < n:
+        op = code[pc]
+        if op == JUMPDEST:
+            bitmap[pc] = 1
+        elif PUSH1 <= op <= PUSH32:
+            pc += op - PUSH1 + 1
+        pc += 1
+    return bytes(bitmap)
+
+
+class CodeCache:
+    # LRU of `CodeAnalysis` by code hash. Code is also remembered by its
+    # bytes, and code read from the JSON state by its hex string, so a hit
+    # skips hashing (and decoding) altogether.
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.by_hash = OrderedDict()
+        self.by_code = OrderedDict()
+        self.by_hex = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, code):
+        code = bytes(code)
+        analysis = self.by_code.get(code)
+        if analysis is not None:
+            self.hits += 1
+            self.by_code.move_to_end(code)
+            return analysis
+        code_hash = keccak256(code)
+        analysis = self.by_hash.get(code_hash)
+        if analysis is not None:
+            self.hits += 1
+            self.by_hash.move_to_end(code_hash)
+        else:
+            self.misses += 1
+            analysis = CodeAnalysis(code, code_hash)
+            self._insert(self.by_hash, code_hash, analysis)
+        self._insert(self.by_code, analysis.code, analysis)
+        return analysis
+
+    def lookup_hex(self, code_hex):
+        analysis = self.by_hex.get(code_hex)
+        if analysis is not None:
+            self.hits += 1
+            self.by_hex.move_to_end(code_hex)
+            return analysis
+        analysis = self.lookup(bytes.fromhex(code_hex))
+        self._insert(self.by_hex, code_hex, analysis)
+        return analysis
+
+    def clear(self):
+        self.by_hash.clear()
+        self.by_code.clear()
+        self.by_hex.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _insert(self, entries, key, analysis):
+        entries[key] = analysis
+        if len(entries) > self.maxsize:
+            entries.popitem(last=False)
+
+
+# Shared by every execution in the process
+code_cache = CodeCache()
+
+EMPTY = CodeAnalysis(b'')
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Basic-block engine
+#
+# Instead of fetching and decoding one byte at a time, bytecode is decoded
+# once into basic blocks: straight runs of instructions that start at pc 0,
+# at a JUMPDEST or right after a JUMPI, and end at a JUMP, JUMPI, a halting
+# opcode or just before the next JUMPDEST.
+#
+# Each instruction of a block is a callable taking the frame. PUSH immediates
+# (and the value of PC) are converted to ints while decoding and bound to the
+# callable with `functools.partial`, so a hot loop runs over ready-made
+# calls and never touches the raw bytes again.
+#
+# The static gas of all instructions of a block is summed while decoding and
+# charged once when the block is entered. Instructions that need the exact
+# remaining gas (GAS and the CALL/CREATE family) end their block, so nothing
+# after them has been charged yet when they run.
+#
+# The lowest and highest stack height each block reaches, relative to its
+# entry height, are also worked out while decoding. When the stack is
+# between `min_stack` and `max_stack` on entry, no instruction of the block
+# can underflow or overflow, and the block runs `unchecked` instructions that
+# skip the 1024 item check of every push. Otherwise it runs the normal
+# `instructions`, which fail at the instruction that underflows or overflows.
+#
+# Common instruction sequences inside a block, like PUSH JUMPI or DUP SWAP,
+# are then fused into single instructions (see `superinstructions.py`).
+#
+# The decoded blocks are stored on the `CodeAnalysis` of the code, so they
+# share its LRU cache entry (see `analysis.py`).
+
+from functools import partial
+
+from gas import STATIC_GAS, OutOfGas
+from interpreter import FAILURES, HANDLERS, Halt, SubCall, fail, run, run_frames
+from stack import STACK_LIMIT
+from superinstructions import fuse
+
+PUSH0 = 0x5f
+PUSH1 = 0x60
+PUSH32 = 0x7f
+JUMPDEST = 0x5b
+PC = 0x58
+DUP1 = 0x80
+SWAP1 = 0x90
+
+# Opcodes after which execution does not fall through to the next byte
+# (JUMPI does when the condition is zero, but still ends the block)
+TERMINATORS = frozenset([
+    0x00,  # STOP
+    0x56,  # JUMP
+    0x57,  # JUMPI
+    0xf3,  # RETURN
+    0xfd,  # REVERT
+    0xfe,  # INVALID
+    0xff,  # SELFDESTRUCT
+])
+
+# Opcodes that read the remaining gas, see above
+GAS_READERS = frozenset([
+    0x5a,  # GAS
+    0xf0,  # CREATE
+    0xf1,  # CALL
+    0xf4,  # DELEGATECALL
+    0xfa,  # STATICCALL
+])
+
+# (items popped, items pushed) of every opcode. DUPn reads n items and puts
+# them back with the copy, SWAPn n + 1. Undefined opcodes fail when they run.
+STACK_EFFECTS = [(0, 0)] * 256
+for opcodes, effect in (
+    # STOP, JUMPDEST, INVALID
+    ((0x00, 0x5b, 0xfe), (0, 0)),
+    # ADD - SIGNEXTEND (but ADDMOD, MULMOD), LT - BYTE (but ISZERO, NOT),
+    # SHL, SHR, SAR, SHA3
+    ((0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x0a, 0x0b, 0x10, 0x11, 0x12, 0x13, 0x14,
+      0x16, 0x17, 0x18, 0x1a, 0x1b, 0x1c, 0x1d, 0x20), (2, 1)),
+    # ADDMOD, MULMOD, CREATE
+    ((0x08, 0x09, 0xf0), (3, 1)),
+    # ISZERO, NOT, BALANCE, CALLDATALOAD, EXTCODESIZE, EXTCODEHASH, BLOCKHASH,
+    # MLOAD, SLOAD
+    ((0x15, 0x19, 0x31, 0x35, 0x3b, 0x3f, 0x40, 0x51, 0x54), (1, 1)),
+    # ADDRESS, ORIGIN, CALLER, CALLVALUE, CALLDATASIZE, CODESIZE, GASPRICE,
+    # RETURNDATASIZE, COINBASE - BASEFEE, PC, MSIZE, GAS, PUSH0 - PUSH32
+    ((0x30, 0x32, 0x33, 0x34, 0x36, 0x38, 0x3a, 0x3d, *range(0x41, 0x49), 0x58, 0x59, 0x5a,
+      *range(PUSH0, PUSH32 + 1)), (0, 1)),
+    # CALLDATACOPY, CODECOPY, RETURNDATACOPY
+    ((0x37, 0x39, 0x3e), (3, 0)),
+    # EXTCODECOPY
+    ((0x3c,), (4, 0)),
+    # POP, JUMP, SELFDESTRUCT
+    ((0x50, 0x56, 0xff), (1, 0)),
+    # MSTORE, MSTORE8, SSTORE, JUMPI, RETURN, REVERT
+    ((0x52, 0x53, 0x55, 0x57, 0xf3, 0xfd), (2, 0)),
+    # CALL
+    ((0xf1,), (7, 1)),
+    # DELEGATECALL, STATICCALL
+    ((0xf4, 0xfa), (6, 1)),
+):
+    for op in opcodes:
+        STACK_EFFECTS[op] = effect
+for n in range(16):
+    STACK_EFFECTS[DUP1 + n] = (n + 1, n + 2)
+    STACK_EFFECTS[SWAP1 + n] = (n + 2, n + 2)
+for n in range(5):
+    STACK_EFFECTS[0xa0 + n] = (n + 2, 0)
+
+
+def stack_bounds(ops):
+    # (items the instructions need on entry, most items they add at any
+    # point)
+    height = 0
+    lowest = 0
+    highest = 0
+    for _, op, _ in ops:
+        pops, pushes = STACK_EFFECTS[op]
+        lowest = min(lowest, height - pops)
+        height += pushes - pops
+        highest = max(highest, height)
+    return -lowest, highest
+
+
+class Block:
+    __slots__ = ('start', 'next', 'ops', 'instructions', 'unchecked', 'static_gas', 'min_stack', 'max_stack')
+
+    def __init__(self, start, next, ops, instructions, unchecked):
+        self.start = start
+        # Where execution continues when the block falls through
+        self.next = next
+        # (pc, opcode, immediate) for every instruction, for later passes
+        self.ops = ops
+        # What runs: one callable per instruction or fused sequence
+        self.instructions = instructions
+        # The same, without stack checks, for entry heights in
+        # [min_stack, max_stack]
+        self.unchecked = unchecked
+        self.static_gas = sum(STATIC_GAS[op] for _, op, _ in ops)
+        need, grow = stack_bounds(ops)
+        self.min_stack = need
+        self.max_stack = STACK_LIMIT - grow
+
+
+# PUSH0 - PUSH32, PC
+def op_push_value(value, f):
+    f.stack.push(value)
+
+
+def op_push_value_unchecked(value, f):
+    f.stack.append(value)
+
+
+# DUP1 - 16, without the stack limit check
+def make_dup_unchecked(index):
+    def op_dup(f):
+        s = f.stack
+        s.append(s[-index])
+    return op_dup
+
+
+UNCHECKED_HANDLERS = list(HANDLERS)
+for n in range(16):
+    UNCHECKED_HANDLERS[DUP1 + n] = make_dup_unchecked(n + 1)
+
+
+def decode_instruction(pc, op, immediate):
+    if immediate is not None:
+        return partial(op_push_value, immediate)
+    return HANDLERS[op]
+
+
+def decode_unchecked(pc, op, immediate):
+    if immediate is not None:
+        return partial(op_push_value_unchecked, immediate)
+    return UNCHECKED_HANDLERS[op]
+
+
+def decode_blocks(code, selection=None):
+    # Maps the start pc of every block to the block. `selection` is the
+    # sequences to fuse, by default the ones in use (see `superinstructions`).
+    blocks = {}
+    n = len(code)
+    pc = 0
+    while pc < n:
+        start = pc
+        ops = []
+        while pc < n:
+            op = code[pc]
+            if op == JUMPDEST and pc != start:
+                break
+            immediate = None
+            if PUSH1 <= op <= PUSH32:
+                size = op - PUSH1 + 1
+                data = code[pc + 1:pc + 1 + size]
+                immediate = int.from_bytes(data, 'big') << (8 * (size - len(data)))
+            elif op == PUSH0:
+                immediate = 0
+            elif op == PC:
+                immediate = pc
+            ops.append((pc, op, immediate))
+            pc += 1 + (op - PUSH1 + 1 if PUSH1 <= op <= PUSH32 else 0)
+            if op in TERMINATORS or op in GAS_READERS:
+                break
+        instructions = fuse(ops, [decode_instruction(*entry) for entry in ops], selection)
+        unchecked = fuse(ops, [decode_unchecked(*entry) for entry in ops], selection, checked=False)
+        blocks[start] = Block(start, pc, tuple(ops), instructions, unchecked)
+    return blocks
+
+
+def get_blocks(analysis):
+    if analysis.blocks is None:
+        analysis.blocks = decode_blocks(analysis.code)
+    return analysis.blocks
+
+
+def execute_blocks(f):
+    return run_frames(f, run_blocks)
+
+
+def run_blocks(f):
+    # Runs `f` until it finishes or starts a sub-call, see `run_frames`
+    blocks = get_blocks(f.analysis)
+    stack = f.stack
+    try:
+        pc = f.pc
+        while True:
+            block = blocks.get(pc)
+            if block is None:
+                # Ran off the end of the code: implicit STOP
+                break
+            gas = f.gas - block.static_gas
+            if gas < 0:
+                raise OutOfGas
+            f.gas = gas
+            # JUMP and JUMPI overwrite this when they are taken
+            f.pc = block.next
+            if block.min_stack <= len(stack) <= block.max_stack:
+                for instruction in block.unchecked:
+                    instruction(f)
+            else:
+                for instruction in block.instructions:
+                    instruction(f)
+            pc = f.pc
+    except Halt:
+        pass
+    except FAILURES:
+        fail(f)
+    except SubCall as call:
+        return call.child
+    return None
+
+
+def execute(code, tx, block, state, static_mode=False):
+    return run(execute_blocks, code, tx, block, state, static_mode)
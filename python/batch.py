@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Batched execution
+#
+# Fuzzing and simulation run the same code over and over with different
+# transactions, mostly different calldata. `execute_batch(code, txs, ...)`
+# runs them all in one go and returns one `evm()` result per transaction:
+#
+# - The code analysis and its basic blocks (see `basic_blocks.py`), the
+#   block environment and the decoded state are shared: the work `evm()`
+#   redoes on every call is done once per batch. Every lane still gets its
+#   own copy of the state, so the transactions don't see each other.
+# - Lanes run in lockstep, one basic block at a time: all lanes at the same
+#   pc run the block together, instruction by instruction across the lanes,
+#   so the block lookup, the dispatch and the loop overhead are paid once per
+#   group instead of once per lane. When a JUMPI sends lanes different ways
+#   the group splits, and lanes that reach the same block again in the same
+#   round merge back.
+#
+# Sub-calls (CALL, CREATE, ...) run per lane on the basic-block engine, right
+# when the lane starts them.
+#
+# - Run `python3 batch.py` to compare a batch with the same transactions run
+#   one by one through `evm()`
+
+import sys
+import time
+
+from analysis import code_cache
+from basic_blocks import execute_blocks, get_blocks
+from interpreter import FAILURES, Frame, Halt, SubCall, fail, log_to_json, resume
+from model import BlockEnv, Message
+from world_state import WorldState
+
+
+def make_lanes(analysis, txs, block, state, static_mode):
+    env = BlockEnv.from_json(block)
+    world = state if isinstance(state, WorldState) else WorldState.from_json(state)
+    lanes = []
+    for tx in txs:
+        msg = Message.from_json(tx)
+        lanes.append(Frame(analysis, msg, env, world.copy(), static_mode, msg.gas))
+    return lanes
+
+
+def run_block(block, lanes):
+    # Runs `block` on every lane, returns the lanes that are still running
+    live = []
+    cost = block.static_gas
+    for f in lanes:
+        if f.gas < cost:
+            fail(f)
+        else:
+            f.gas -= cost
+            # JUMP and JUMPI overwrite this when they are taken
+            f.pc = block.next
+            live.append(f)
+    for instruction in block.instructions:
+        finished = False
+        for f in live:
+            try:
+                instruction(f)
+            except Halt:
+                f.pc = None
+                finished = True
+            except FAILURES:
+                fail(f)
+                f.pc = None
+                finished = True
+            except SubCall as call:
+                # Sub-calls are not batched: run this lane's to completion
+                execute_blocks(call.child)
+                resume(f, call.child)
+        if finished:
+            live = [f for f in live if f.pc is not None]
+    return live
+
+
+def run_lockstep(analysis, lanes):
+    blocks = get_blocks(analysis)
+    # pc -> lanes about to run the block at pc
+    groups = {0: lanes}
+    while groups:
+        next_groups = {}
+        for pc, group in groups.items():
+            block = blocks.get(pc)
+            if block is None:
+                # Ran off the end of the code: implicit STOP
+                continue
+            for f in run_block(block, group):
+                next_groups.setdefault(f.pc, []).append(f)
+        groups = next_groups
+
+
+def result(f, start_gas):
+    # As `interpreter.finish_run`: a failed lane leaves no stack and no logs
+    ret = f.ret.hex() if f.ret is not None else None
+    if not f.success:
+        return (False, [], [], ret, start_gas - f.gas)
+    logs = [log_to_json(log) for log in f.logs]
+    return (True, f.stack.to_list(), logs, ret, start_gas - f.gas)
+
+
+def execute_batch(code, txs, block=None, state=None, static_mode=False):
+    # One `evm()` result per transaction of `txs`. `state` (JSON or a
+    # `WorldState`) is read, never changed.
+    analysis = code_cache.lookup(code)
+    lanes = make_lanes(analysis, txs, block, state, static_mode)
+    start_gas = [f.gas for f in lanes]
+    run_lockstep(analysis, lanes)
+    return [result(f, gas) for f, gas in zip(lanes, start_gas)]
+
+
+def demo_code():
+    # n = calldata[0:32] & 15, then n rounds of x = x * 31 + n; returns x.
+    # Lanes diverge on the loop count and meet again at the end.
+    loop, end = 9, 31
+    return bytes([
+        0x60, 0x00, 0x35,        # PUSH1 0 CALLDATALOAD
+        0x60, 0x0f, 0x16,        # PUSH1 15 AND                -> n
+        0x60, 0x01,              # PUSH1 1                     -> n x
+        0x90,                    # SWAP1                       -> x n
+        0x5b,                    # JUMPDEST (loop)
+        0x80, 0x15,              # DUP1 ISZERO
+        0x61, 0x00, end, 0x57,   # PUSH2 end JUMPI
+        0x90,                    # SWAP1                       -> n x
+        0x60, 0x1f, 0x02,        # PUSH1 31 MUL
+        0x81, 0x01,              # DUP2 ADD
+        0x90,                    # SWAP1                       -> x n
+        0x60, 0x01, 0x90, 0x03,  # PUSH1 1 SWAP1 SUB           -> x n-1
+        0x61, 0x00, loop, 0x56,  # PUSH2 loop JUMP
+        0x5b,                    # JUMPDEST (end)
+        0x50,                    # POP
+        0x60, 0x00, 0x52,        # PUSH1 0 MSTORE
+        0x60, 0x20, 0x60, 0x00,  # PUSH1 32 PUSH1 0
+        0xf3,                    # RETURN
+    ])
+
+
+def main():
+    from evm import evm
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    code = demo_code()
+    txs = [{"data": (i * 2654435761 % 2**256).to_bytes(32, 'big').hex()} for i in range(n)]
+
+    start = time.perf_counter()
+    expected = [evm(code, tx, {}, {}, False) for tx in txs]
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = execute_batch(code, txs)
+    batched = time.perf_counter() - start
+
+    assert results == expected, "batch results differ from evm()"
+
+    # A lane that logs, pushes and then fails
+    failing = bytes.fromhex('60006000a0600160026003fe')
+    assert execute_batch(failing, [{}]) == [evm(failing, {}, {}, {}, False)], \
+        "failed batch result differs from evm()"
+    print(f"{n} transactions: evm() one by one {single * 1000:.1f} ms, "
+          f"batch {batched * 1000:.1f} ms ({single / batched:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Interpreter benchmark
+#
+# Runs synthetic workloads on every engine registered in `evm.ENGINES` and
+# reports instructions per second, nanoseconds per instruction and the peak
+# memory allocated by one run.
+#
+# Every workload is the same counting loop with a different body: one per
+# opcode family (arithmetic, signed, memory, sha3, stack, jumps, calls,
+# storage) plus larger macro workloads (a keccak hash chain, a storage-heavy
+# loop, a loop on a deep stack). Each measurement runs `--warmup` untimed
+# runs first, then `--repeat` timed runs with the garbage collector off, and
+# keeps the fastest.
+#
+# - Run `python3 bench.py` from the `python` directory
+# - Run `python3 bench.py 100000` to change the number of loop iterations
+# - Run `python3 bench.py --workload sha3 --engine blocks` to run a subset
+# - Run `python3 bench.py --save baseline.json` to save the results, and
+#   `python3 bench.py --compare baseline.json` to diff against them: the exit
+#   code is 1 if any workload got slower than `--threshold` (10%)
+
+import argparse
+import copy
+import gc
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+
+from evm import ENGINES
+from model import format_address
+
+# Address of the contract called by the `calls` workload
+CALLEE = 0x1000000000000000000000000000000000000c0d
+
+
+def push(value, size=1):
+    return bytes([0x60 + size - 1]) + value.to_bytes(size, 'big')
+
+
+def ops(*opcodes):
+    # One instruction per opcode, for instructions without immediates
+    return [bytes([op]) for op in opcodes]
+
+
+# PUSH4 n
+# JUMPDEST          <- start
+# (body)
+# PUSH1 1
+# SWAP1
+# SUB
+# DUP1
+# PUSH2 start
+# JUMPI
+# POP
+LOOP_BODY = 7
+
+# The loop counter is pushed with PUSH4
+MAX_ITERATIONS = 0xffffffff
+
+
+def counting_loop(iterations, prefix=b'', suffix=b'', body=None):
+    # `body(offset)` returns the instructions run in every iteration, as a
+    # list of bytes, given the offset they start at. It must leave the stack
+    # as it found it.
+    start = len(prefix) + 5
+    instructions = body(start + 1) if body is not None else []
+    code = prefix + push(iterations, 4) + bytes([0x5b]) + b''.join(instructions) + bytes([
+        0x60, 0x01,
+        0x90,
+        0x03,
+        0x80,
+    ]) + push(start, 2) + bytes([
+        0x57,
+        0x50,
+    ]) + suffix
+    executed = 1 + iterations * (LOOP_BODY + len(instructions)) + 1
+    return code, executed
+
+
+def deep_stack(iterations, depth=1000):
+    # Same loop, run on top of `depth` items left on the stack
+    code, instructions = counting_loop(iterations, bytes([0x60, 0x00]) * depth, bytes([0x50]) * depth)
+    return code, instructions + 2 * depth
+
+
+def arithmetic(offset):
+    # 7 + 3, * 5, / 2, % 9, addmod, exp
+    return [push(7), push(3)] + ops(0x01) + [push(5)] + ops(0x02) + [push(2)] + ops(0x90, 0x04) + \
+        [push(9)] + ops(0x90, 0x06) + [push(4), push(11)] + ops(0x08) + [push(3)] + ops(0x0a, 0x50)
+
+
+def signed(offset):
+    # signextend 0xff to -1, 7 / -1, -7 smod 3, sar 1, 0 sgt, signextend
+    return [push(0xff), push(0)] + ops(0x0b) + [push(7)] + ops(0x05) + [push(3)] + ops(0x90, 0x07) + \
+        [push(1)] + ops(0x1d) + [push(0)] + ops(0x13) + [push(0)] + ops(0x0b, 0x50)
+
+
+def memory(offset):
+    # MSTORE, MLOAD, MSTORE8 and MSIZE on the first two words
+    return [push(42), push(0)] + ops(0x52) + [push(0)] + ops(0x51) + [push(33)] + ops(0x53) + \
+        ops(0x59, 0x50)
+
+
+def sha3(offset):
+    return [push(64), push(0)] + ops(0x20, 0x50)
+
+
+def stack(offset):
+    # The counter is the only item: duplicate it, shuffle the copies, drop them
+    return ops(0x80, 0x80, 0x81, 0x91, 0x90, 0x92, 0x50, 0x50, 0x50)
+
+
+def jumps(offset):
+    # An unconditional jump and a taken conditional jump to the next byte
+    target = offset + 4
+    return [push(target, 2)] + ops(0x56, 0x5b) + [push(1), push(target + 7, 2)] + ops(0x57, 0x5b)
+
+
+def calls(offset):
+    # CALL(gas, CALLEE, 0, 0, 0, 0, 0) into a contract that returns at once
+    return [push(0)] * 5 + [push(CALLEE, 20)] + ops(0x5a, 0xf1, 0x50)
+
+
+def storage(offset):
+    # Write the counter to its own slot and read it back
+    return ops(0x80, 0x80, 0x55, 0x80, 0x54, 0x50)
+
+
+def keccak_chain(offset):
+    # Hash the first word and store the hash back into it
+    return [push(32), push(0)] + ops(0x20) + [push(0)] + ops(0x52)
+
+
+def storage_heavy(offset):
+    # Three slots derived from the counter: two writes, three reads
+    return ops(0x80, 0x80, 0x55) + ops(0x80) + [push(1)] + ops(0x01, 0x80, 0x80, 0x55) + \
+        ops(0x54, 0x50) + ops(0x80, 0x54, 0x50) + [push(0)] + ops(0x54, 0x50)
+
+
+# MSTORE(32, 1): the SHA3 workloads hash memory that is already there
+MEMORY_PREFIX = push(1) + push(32) + bytes([0x52])
+
+
+def family(body, prefix=b'', prefix_instructions=0):
+    def build(iterations):
+        code, instructions = counting_loop(iterations, prefix, body=body)
+        return code, instructions + prefix_instructions
+    return build
+
+
+def with_callee(build):
+    # The `calls` workload needs a callee in the state: STOP, 1 instruction
+    def build_calls(iterations):
+        code, instructions = build(iterations)
+        state = {format_address(CALLEE): {"balance": "0x0", "code": {"bin": "00"}}}
+        return code, instructions + iterations, state
+    return build_calls
+
+
+WORKLOADS = {
+    'loop': counting_loop,
+    'arithmetic': family(arithmetic),
+    'signed': family(signed),
+    'memory': family(memory),
+    'sha3': family(sha3, MEMORY_PREFIX, 3),
+    'stack': family(stack),
+    'jumps': family(jumps),
+    'calls': with_callee(family(calls)),
+    'storage': family(storage),
+    'keccak loop': family(keccak_chain, MEMORY_PREFIX, 3),
+    'storage heavy': family(storage_heavy),
+    'deep stack': deep_stack,
+}
+
+
+def build_workload(build, iterations):
+    # (code, instructions, state), workloads without state return 2 items
+    workload = build(iterations)
+    if len(workload) == 2:
+        return workload + ({},)
+    return workload
+
+
+def run_once(engine, code, state):
+    success, stack, logs, ret, gas_used = engine(code, {}, {}, state, False)
+    assert success and stack == []
+
+
+def measure(engine, code, repeat=3, warmup=1, state=None):
+    # Fastest and median wall time of `repeat` runs, in seconds
+    state = state or {}
+    for _ in range(warmup):
+        run_once(engine, code, copy.deepcopy(state))
+    times = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            run_state = copy.deepcopy(state)
+            start = time.perf_counter()
+            run_once(engine, code, run_state)
+            times.append(time.perf_counter() - start)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return min(times), statistics.median(times)
+
+
+def peak_memory(engine, code, state=None):
+    # Peak bytes allocated by one run, measured in a separate untimed run
+    # because tracing allocations slows everything down
+    run_state = copy.deepcopy(state or {})
+    tracemalloc.start()
+    try:
+        run_once(engine, code, run_state)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def compare(results, baseline, threshold):
+    # Workloads whose ns/op grew by more than `threshold` since `baseline`
+    regressions = []
+    for workload, engines in results.items():
+        for name, result in engines.items():
+            before = baseline.get(workload, {}).get(name)
+            if before is None:
+                continue
+            change = result['ns_per_op'] / before['ns_per_op'] - 1
+            print(f"  {workload:>14} {name:>8}: {before['ns_per_op']:8.1f} -> {result['ns_per_op']:8.1f} ns/op ({change:+.1%})")
+            if change > threshold:
+                regressions.append((workload, name, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the EVM engines")
+    parser.add_argument('iterations', nargs='?', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--engine', action='append', choices=sorted(ENGINES), help="engine to run (repeatable)")
+    parser.add_argument('--workload', action='append', choices=sorted(WORKLOADS), help="workload to run (repeatable)")
+    parser.add_argument('--no-memory', action='store_true', help="skip the peak memory run")
+    parser.add_argument('--save', help="save the results to this JSON file")
+    parser.add_argument('--compare', help="compare against results saved with --save")
+    parser.add_argument('--threshold', type=float, default=0.10, help="allowed ns/op growth for --compare")
+    args = parser.parse_args(argv)
+
+    engines = {name: ENGINES[name] for name in (args.engine or ENGINES)}
+    if not 0 < args.iterations <= MAX_ITERATIONS:
+        parser.error(f"iterations must be between 1 and {MAX_ITERATIONS}")
+    iterations = args.iterations
+    results = {}
+    for workload in args.workload or WORKLOADS:
+        code, instructions, state = build_workload(WORKLOADS[workload], iterations)
+        print(f"{workload}:")
+        results[workload] = {}
+        for name, engine in engines.items():
+            best, median = measure(engine, code, args.repeat, args.warmup, state)
+            result = {
+                'instructions': instructions,
+                'seconds': best,
+                'median_seconds': median,
+                'instructions_per_second': instructions / best,
+                'ns_per_op': best * 1e9 / instructions,
+            }
+            line = f"  {name:>8}: {result['instructions_per_second']:>12,.0f} instructions/s" \
+                f" {result['ns_per_op']:8.1f} ns/op ({best * 1000:.1f} ms, median {median * 1000:.1f} ms)"
+            if not args.no_memory:
+                result['peak_memory'] = peak_memory(engine, code, state)
+                line += f" peak {result['peak_memory'] / 1024:,.0f} KiB"
+            results[workload][name] = result
+            print(line)
+        if 'loop' in results[workload]:
+            for name, result in results[workload].items():
+                if name != 'loop':
+                    print(f"  {name:>8}: {results[workload]['loop']['seconds'] / result['seconds']:.2f}x faster than loop")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"compared to {args.compare}:")
+        regressions = compare(results, baseline, args.threshold)
+        for workload, name, change in regressions:
+            print(f"❌ {workload} on {name} is {change:.1%} slower")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Block executor
+#
+# `execute_block(txs, block, state)` runs an ordered list of transactions
+# against one shared state, like calling `evm()` on each of them in turn,
+# with the code of each transaction taken from its `to` account. As with
+# `evm()` there is no intrinsic gas, no nonce check and no top-level value
+# transfer.
+#
+# Transactions run optimistically in parallel on a process pool, all against
+# the state as it was before the block. Each one runs on a `TrackedWorldState`
+# that records what it read (accounts, storage slots) and, by diffing with
+# the starting state, what it wrote. The results are then committed in
+# order: a transaction that read nothing written by an earlier transaction of
+# the block saw exactly the state it would have seen serially, so its writes
+# are applied as they are. The others are re-executed, in order, against the
+# up-to-date state. The final state is the same as the serial one.
+#
+# Reads are tracked per account (balance, nonce, code and existence together)
+# and per storage slot. Changing an account also counts as reading it, since
+# balance and nonce updates are read-modify-writes; writing a storage slot
+# does not.
+#
+# - Run `python3 block_executor.py` to compare parallel and serial execution
+#   on a synthetic block
+
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from basic_blocks import execute_blocks
+from interpreter import run
+from model import Account, format_address, parse_int
+from world_state import WorldState
+
+ACCOUNT = 'account'
+STORAGE = 'storage'
+
+
+class Overlay(dict):
+    # Accounts of `base` are copied in on first access, so nothing done here
+    # ever changes `base`
+
+    def __init__(self, base):
+        super().__init__()
+        self.base = base
+        self.loaded = set()
+
+    def load(self, address):
+        if address not in self.loaded:
+            self.loaded.add(address)
+            account = self.base.get(address)
+            if account is not None:
+                dict.__setitem__(self, address, account.copy())
+
+    def get(self, address, default=None):
+        self.load(address)
+        return dict.get(self, address, default)
+
+    def __contains__(self, address):
+        self.load(address)
+        return dict.__contains__(self, address)
+
+    def __getitem__(self, address):
+        self.load(address)
+        return dict.__getitem__(self, address)
+
+    def __setitem__(self, address, account):
+        self.load(address)
+        dict.__setitem__(self, address, account)
+
+    def pop(self, address, *default):
+        self.load(address)
+        return dict.pop(self, address, *default)
+
+
+class TrackedWorldState(WorldState):
+    # A `WorldState` over `base` (a `WorldState`, left untouched) that
+    # records its reads; `writes()` diffs it against `base`
+
+    def __init__(self, base):
+        super().__init__(Overlay(base.accounts))
+        self.base = base
+        self.reads = set()
+
+    def exists(self, address):
+        self.reads.add((ACCOUNT, address))
+        return super().exists(address)
+
+    def get_account(self, address):
+        self.reads.add((ACCOUNT, address))
+        return super().get_account(address)
+
+    def _touch(self, address):
+        self.reads.add((ACCOUNT, address))
+        return super()._touch(address)
+
+    def get_balance(self, address):
+        self.reads.add((ACCOUNT, address))
+        return super().get_balance(address)
+
+    def get_nonce(self, address):
+        self.reads.add((ACCOUNT, address))
+        return super().get_nonce(address)
+
+    def get_code(self, address):
+        self.reads.add((ACCOUNT, address))
+        return super().get_code(address)
+
+    def create_account(self, address):
+        self.reads.add((ACCOUNT, address))
+        super().create_account(address)
+
+    def delete_account(self, address):
+        self.reads.add((ACCOUNT, address))
+        super().delete_account(address)
+
+    def get_storage(self, address, slot):
+        self.reads.add((STORAGE, address, slot))
+        account = self.accounts.get(address)
+        return account.storage.get(slot, 0) if account is not None else 0
+
+    def writes(self):
+        # {key: value}: (ACCOUNT, address) -> (balance, nonce, code) or None
+        # when deleted, (STORAGE, address, slot) -> value
+        writes = {}
+        for address in self.accounts.loaded:
+            before = self.base.accounts.get(address)
+            after = dict.get(self.accounts, address)
+            if before is None and after is None:
+                continue
+            fields = None if after is None else (after.balance, after.nonce, after.code)
+            if before is None or fields != (before.balance, before.nonce, before.code):
+                writes[(ACCOUNT, address)] = fields
+            old = before.storage if before is not None else {}
+            new = after.storage if after is not None else {}
+            for slot in old.keys() | new.keys():
+                if old.get(slot, 0) != new.get(slot, 0):
+                    writes[(STORAGE, address, slot)] = new.get(slot, 0)
+        return writes
+
+
+def apply_writes(world, writes):
+    accounts = world.accounts
+    for key, value in writes.items():
+        if key[0] != ACCOUNT:
+            continue
+        address = key[1]
+        if value is None:
+            accounts.pop(address, None)
+            continue
+        account = accounts.get(address)
+        if account is None:
+            account = accounts[address] = Account()
+        account.balance, account.nonce, code = value
+        if account.code != code:
+            account.code = code
+            account.analysis = None
+    for key, value in writes.items():
+        if key[0] != STORAGE:
+            continue
+        _, address, slot = key
+        account = accounts.get(address)
+        if account is None:
+            if not value:
+                continue
+            account = accounts[address] = Account()
+        if value:
+            account.storage[slot] = value
+        else:
+            account.storage.pop(slot, None)
+
+
+def execute_tracked(world, tx, block):
+    # (result, reads, writes) of `tx` run on top of `world`
+    tracked = TrackedWorldState(world)
+    code = tracked.get_code(parse_int(tx.get('to')))
+    result = run(execute_blocks, code, tx, block, tracked)
+    return result, tracked.reads, tracked.writes()
+
+
+# The pre-block state and block of the workers, set by `init_worker`
+worker_world = None
+worker_block = None
+
+
+def init_worker(state, block):
+    global worker_world, worker_block
+    worker_world = WorldState.from_json(state)
+    worker_block = block
+
+
+def execute_in_worker(tx):
+    return execute_tracked(worker_world, tx, worker_block)
+
+
+def execute_block(txs, block=None, state=None, workers=None, chunksize=4):
+    # Returns (results, final JSON state, number of re-executed transactions)
+    state = state or {}
+    world = WorldState.from_json(state)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(state, block)) as pool:
+        speculative = list(pool.map(execute_in_worker, txs, chunksize=chunksize))
+
+    results = []
+    written = set()
+    reexecuted = 0
+    for tx, (result, reads, writes) in zip(txs, speculative):
+        if not reads.isdisjoint(written):
+            # Read something an earlier transaction changed: run it again
+            # against the current state
+            result, reads, writes = execute_tracked(world, tx, block)
+            reexecuted += 1
+        apply_writes(world, writes)
+        written.update(writes)
+        results.append(result)
+    return results, world.to_json(), reexecuted
+
+
+def execute_serial(txs, block=None, state=None):
+    # The reference: every transaction in turn on one `WorldState`
+    world = WorldState.from_json(state or {})
+    results = []
+    for tx in txs:
+        code = world.get_code(parse_int(tx.get('to')))
+        results.append(run(execute_blocks, code, tx, block, world))
+        world.commit()
+    return results, world.to_json()
+
+
+def demo_block(n):
+    # Contracts that hash their calldata in a loop, then add 1 to a storage
+    # slot chosen by the calldata: every 8th transaction hits a shared slot
+    # of a shared contract, the others have a slot of their own
+    code = bytes([
+        0x61, 0x01, 0x00,        # PUSH2 256        -> i
+        0x5b,                    # JUMPDEST (3)
+        0x60, 0x20, 0x60, 0x00,  # PUSH1 32 PUSH1 0
+        0x20, 0x60, 0x00, 0x52,  # SHA3 PUSH1 0 MSTORE
+        0x60, 0x01, 0x90, 0x03,  # PUSH1 1 SWAP1 SUB
+        0x80, 0x61, 0x00, 0x03,  # DUP1 PUSH2 3
+        0x57,                    # JUMPI
+        0x50,                    # POP
+        0x60, 0x00, 0x35,        # PUSH1 0 CALLDATALOAD -> slot
+        0x80, 0x54,              # DUP1 SLOAD
+        0x60, 0x01, 0x01,        # PUSH1 1 ADD
+        0x90, 0x55,              # SWAP1 SSTORE
+    ])
+    contracts = [0x1000 + i for i in range(8)]
+    state = {format_address(address): {"balance": "0x0", "code": {"bin": code.hex()}} for address in contracts}
+    txs = []
+    for i in range(n):
+        slot = 0 if i % 8 == 0 else i
+        txs.append({
+            "to": format_address(contracts[i % 8] if i % 8 else contracts[0]),
+            "from": format_address(0xaaaa),
+            "data": slot.to_bytes(32, 'big').hex(),
+        })
+    return txs, state
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    txs, state = demo_block(n)
+
+    start = time.perf_counter()
+    expected_results, expected_state = execute_serial(txs, {}, state)
+    serial = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results, final_state, reexecuted = execute_block(txs, {}, state)
+    parallel = time.perf_counter() - start
+
+    assert results == expected_results, "results differ from serial execution"
+    assert final_state == expected_state, "final state differs from serial execution"
+    print(f"{n} transactions: serial {serial * 1000:.1f} ms, parallel {parallel * 1000:.1f} ms "
+          f"({serial / parallel:.2f}x), {reexecuted} re-executed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Bytecode compiler
+#
+# The basic-block engine (see `basic_blocks.py`) still makes one Python call
+# per instruction, and every one of them goes through the `Stack`. For code
+# that runs over and over, this engine translates each basic block into the
+# Python source of one function instead:
+#
+# - the stack is modelled while translating: PUSH values are constants,
+#   DUP, SWAP and POP only move names around, and arithmetic, comparisons
+#   and bitwise ops become expressions on local variables, folded when their
+#   operands are constants
+# - the real `Stack` is only written where it has to be: before an
+#   instruction that is left to its interpreter handler (memory, storage,
+#   calls, ...), and at the end of the block
+# - a block returns the pc of the next block: JUMP and JUMPI to a constant
+#   JUMPDEST are plain `return`s, checked once at compile time
+#
+#     def block_4(f, s):
+#         gas = f.gas - 26
+#         if gas < 0:
+#             raise OutOfGas
+#         f.gas = gas
+#         if len(s) < 1 or len(s) > 1022:
+#             return slow(f, 4)
+#         v0 = s[-1]
+#         s[-1] = 1
+#         v1 = s.pop()
+#         v2 = (v0 - v1) & M
+#         s.append(v2)
+#         return 4 if v2 else 13
+#
+# Stack underflow and overflow are checked once per block, against the
+# entry heights the block is safe for (`min_stack` and `max_stack`, see
+# `basic_blocks.py`). A block that would fail that check runs on the
+# basic-block instructions instead (`slow`), so it fails at the same
+# instruction, with the same stack, as the other engines.
+#
+# The source of a whole contract is compiled into one code object, which is
+# kept on the `CodeAnalysis` of the code and on disk, marshalled, under the
+# code hash (in `$EVM_COMPILE_CACHE`, by default `~/.cache/evm-from-scratch`),
+# so a contract is translated once, not once per process. The file name also
+# has a fingerprint of the compiler and the tables it inlines, so code
+# compiled before any of them changed is never loaded.
+#
+# - Run `python3 evm.py --engine compiled` to run the tests on this engine
+# - Run `python3 compiler.py <code hex>` to print the source of some bytecode
+
+import hashlib
+import importlib.util
+import itertools
+import marshal
+import os
+import sys
+
+from basic_blocks import GAS_READERS, JUMPDEST, STACK_EFFECTS, get_blocks
+from gas import STATIC_GAS, OutOfGas
+from interpreter import FAILURES, HANDLERS, EVMError, Halt, SubCall, copy_padded, fail, run, run_frames
+from stack import STACK_LIMIT
+from uint256 import MAX_UINT256, sar, sdiv, signextend, smod, to_signed
+
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache')),
+    'evm-from-scratch',
+)
+
+JUMP = 0x56
+JUMPI = 0x57
+DUP1 = 0x80
+DUP16 = 0x8f
+SWAP1 = 0x90
+SWAP16 = 0x9f
+POP = 0x50
+CODESIZE = 0x38
+
+# Expressions for the opcodes computed inline. `a` is the top of the stack,
+# `b` the item below it, then `c`.
+EXPRESSIONS = {
+    0x01: '({a} + {b}) & M',
+    0x02: '({a} * {b}) & M',
+    0x03: '({a} - {b}) & M',
+    0x04: '{a} // {b} if {b} else 0',
+    0x05: 'sdiv({a}, {b})',
+    0x06: '{a} % {b} if {b} else 0',
+    0x07: 'smod({a}, {b})',
+    0x08: '({a} + {b}) % {c} if {c} else 0',
+    0x09: '({a} * {b}) % {c} if {c} else 0',
+    0x0b: 'signextend({a}, {b})',
+    0x10: '1 if {a} < {b} else 0',
+    0x11: '1 if {a} > {b} else 0',
+    0x12: '1 if to_signed({a}) < to_signed({b}) else 0',
+    0x13: '1 if to_signed({a}) > to_signed({b}) else 0',
+    0x14: '1 if {a} == {b} else 0',
+    0x15: '0 if {a} else 1',
+    0x16: '{a} & {b}',
+    0x17: '{a} | {b}',
+    0x18: '{a} ^ {b}',
+    0x19: 'M ^ {a}',
+    0x1a: '({b} >> ((31 - {a}) * 8)) & 0xff if {a} < 32 else 0',
+    0x1b: '({b} << {a}) & M if {a} < 256 else 0',
+    0x1c: '{b} >> {a} if {a} < 256 else 0',
+    0x1d: 'sar({a}, {b})',
+    0x30: 'f.address',
+    0x32: 'f.tx.origin',
+    0x33: 'f.tx.caller',
+    0x34: 'f.tx.value',
+    0x35: "int.from_bytes(copy_padded(f.calldata, {a}, 32), 'big')",
+    0x36: 'len(f.calldata)',
+    0x3a: 'f.tx.gasprice',
+    0x41: 'f.block.coinbase',
+    0x42: 'f.block.timestamp',
+    0x43: 'f.block.number',
+    0x44: 'f.block.difficulty',
+    0x45: 'f.block.gaslimit',
+    0x46: 'f.block.chainid',
+    0x48: 'f.block.basefee',
+}
+
+# Inline opcodes that only depend on their operands, so constant operands
+# give a constant
+PURE = frozenset(op for op, expression in EXPRESSIONS.items() if 'f.' not in expression and '{a}' in expression)
+
+
+def operand_count(expression):
+    return sum(1 for name in ('{a}', '{b}', '{c}') if name in expression)
+
+
+class BlockTranslator:
+    # Turns one `basic_blocks.Block` into the source of a function
+
+    def __init__(self, block, analysis):
+        self.block = block
+        self.analysis = analysis
+        self.lines = []
+        # The items the block pushed and that are not on `s` yet, bottom
+        # first: ints for constants, names of locals otherwise
+        self.virtual = []
+        self.names = itertools.count()
+
+    def emit(self, line):
+        self.lines.append(line)
+
+    def assign(self, expression):
+        name = f"v{next(self.names)}"
+        self.emit(f"{name} = {expression}")
+        return name
+
+    def pop(self):
+        if self.virtual:
+            return self.virtual.pop()
+        return self.assign('s.pop()')
+
+    def flush(self):
+        # Writes the pending items to `s`
+        virtual = self.virtual
+        if len(virtual) == 1:
+            self.emit(f"s.append({virtual[0]})")
+        elif virtual:
+            self.emit(f"s.extend(({', '.join(map(str, virtual))}))")
+        virtual.clear()
+
+    def is_jumpdest(self, target):
+        return self.analysis.is_jumpdest(target)
+
+    def translate(self):
+        block = self.block
+        self.emit(f"def block_{block.start}(f, s):")
+        if block.static_gas:
+            self.emit(f"    gas = f.gas - {block.static_gas}")
+            self.emit("    if gas < 0:")
+            self.emit("        raise OutOfGas")
+            self.emit("    f.gas = gas")
+        checks = []
+        if block.min_stack:
+            checks.append(f"len(s) < {block.min_stack}")
+        if block.max_stack < STACK_LIMIT:
+            checks.append(f"len(s) > {block.max_stack}")
+        if checks:
+            self.emit(f"    if {' or '.join(checks)}:")
+            self.emit(f"        return slow(f, {block.start})")
+        body = len(self.lines)
+        ended = False
+        for pc, op, immediate in block.ops:
+            ended = self.translate_op(pc, op, immediate)
+        if not ended:
+            self.flush()
+            self.emit(f"return {block.next}")
+        self.lines[body:] = ['    ' + line for line in self.lines[body:]]
+        return '\n'.join(self.lines) + '\n'
+
+    def translate_op(self, pc, op, immediate):
+        # Emits `op`, True if it ended the function
+        virtual = self.virtual
+        if immediate is not None:
+            # PUSH0 - PUSH32, PC
+            virtual.append(immediate)
+        elif op == JUMPDEST:
+            pass
+        elif op == CODESIZE:
+            virtual.append(len(self.analysis.code))
+        elif op == POP:
+            if virtual:
+                virtual.pop()
+            else:
+                self.emit("del s[-1]")
+        elif DUP1 <= op <= DUP16:
+            n = op - DUP1 + 1
+            if n <= len(virtual):
+                virtual.append(virtual[-n])
+            else:
+                virtual.append(self.assign(f"s[-{n - len(virtual)}]"))
+        elif SWAP1 <= op <= SWAP16:
+            n = op - SWAP1 + 1
+            if n < len(virtual):
+                virtual[-1], virtual[-n - 1] = virtual[-n - 1], virtual[-1]
+            elif virtual:
+                # The other item is on `s`
+                depth = n + 1 - len(virtual)
+                other = self.assign(f"s[-{depth}]")
+                self.emit(f"s[-{depth}] = {virtual[-1]}")
+                virtual[-1] = other
+            else:
+                self.emit(f"s[-1], s[-{n + 1}] = s[-{n + 1}], s[-1]")
+        elif op in EXPRESSIONS:
+            expression = EXPRESSIONS[op]
+            operands = [self.pop() for _ in range(operand_count(expression))]
+            expression = expression.format(**dict(zip('abc', operands)))
+            if op in PURE and all(isinstance(operand, int) for operand in operands):
+                virtual.append(eval(expression, NAMESPACE))
+            else:
+                virtual.append(self.assign(expression))
+        elif op == JUMP:
+            target = self.pop()
+            self.flush()
+            self.jump(target)
+            return True
+        elif op == JUMPI:
+            target = self.pop()
+            condition = self.pop()
+            self.flush()
+            if isinstance(condition, int):
+                if condition:
+                    self.jump(target)
+                else:
+                    self.emit(f"return {self.block.next}")
+            elif isinstance(target, int):
+                if self.is_jumpdest(target):
+                    self.emit(f"return {target} if {condition} else {self.block.next}")
+                else:
+                    self.emit(f"if {condition}:")
+                    self.emit("    raise EVMError('invalid jump destination')")
+                    self.emit(f"return {self.block.next}")
+            else:
+                self.emit(f"if {condition}:")
+                self.emit(f"    if not J({target}):")
+                self.emit("        raise EVMError('invalid jump destination')")
+                self.emit(f"    return {target}")
+                self.emit(f"return {self.block.next}")
+            return True
+        else:
+            # Everything else runs its interpreter handler on the real stack
+            self.flush()
+            if op in GAS_READERS:
+                # Sub-calls resume at the next block
+                self.emit(f"f.pc = {self.block.next}")
+            self.emit(f"H[{op}](f)")
+        return False
+
+    def jump(self, target):
+        if isinstance(target, int):
+            if self.is_jumpdest(target):
+                self.emit(f"return {target}")
+            else:
+                self.emit("raise EVMError('invalid jump destination')")
+        else:
+            self.emit(f"if not J({target}):")
+            self.emit("    raise EVMError('invalid jump destination')")
+            self.emit(f"return {target}")
+
+
+def translate(analysis):
+    # Python source for all blocks of `analysis`, defining PROGRAM: the
+    # function of every block by its start pc
+    blocks = get_blocks(analysis)
+    parts = [BlockTranslator(block, analysis).translate() for block in blocks.values()]
+    program = ', '.join(f"{start}: block_{start}" for start in blocks)
+    parts.append(f"PROGRAM = {{{program}}}\n")
+    return '\n\n'.join(parts)
+
+
+# Names the generated code uses, besides the per-code `J` and `slow`
+NAMESPACE = {
+    'H': HANDLERS,
+    'M': MAX_UINT256,
+    'EVMError': EVMError,
+    'OutOfGas': OutOfGas,
+    'copy_padded': copy_padded,
+    'sar': sar,
+    'sdiv': sdiv,
+    'signextend': signextend,
+    'smod': smod,
+    'to_signed': to_signed,
+}
+
+
+def run_slow(blocks, f, start):
+    # Runs a block on the basic-block instructions (its gas is already paid)
+    block = blocks[start]
+    f.pc = block.next
+    for instruction in block.instructions:
+        instruction(f)
+    return f.pc
+
+
+def generator_fingerprint():
+    # A hash of everything besides the bytecode that the generated code
+    # depends on: the gas and stack tables it inlines, and the source of the
+    # modules that split, check and translate the blocks
+    digest = hashlib.sha256(repr((STATIC_GAS, STACK_EFFECTS, STACK_LIMIT)).encode())
+    for name in (__name__, 'basic_blocks', 'analysis'):
+        with open(sys.modules[name].__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+# Part of the cache file names, so that a change to the compiler or its
+# inputs never loads code compiled before it
+FINGERPRINT = generator_fingerprint()
+
+
+def cache_path(analysis, cache_dir):
+    magic = importlib.util.MAGIC_NUMBER.hex()
+    return os.path.join(cache_dir, f"{analysis.code_hash.hex()}-{FINGERPRINT}-{magic}.bin")
+
+
+def load_code(analysis, cache_dir):
+    # The compiled code object of `analysis`, from the disk cache if there
+    path = cache_path(analysis, cache_dir) if cache_dir else None
+    if path is not None:
+        try:
+            with open(path, 'rb') as f:
+                return marshal.load(f)
+        except (OSError, ValueError, EOFError, TypeError):
+            pass
+    code = compile(translate(analysis), f"<evm {analysis.code_hash.hex()[:16]}>", 'exec')
+    if path is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            temporary = f"{path}.{os.getpid()}"
+            with open(temporary, 'wb') as f:
+                marshal.dump(code, f)
+            os.replace(temporary, path)
+        except OSError:
+            # A read-only cache only costs the compilation
+            pass
+    return code
+
+
+def get_program(analysis, cache_dir=None):
+    if analysis.compiled is None:
+        if cache_dir is None:
+            cache_dir = os.environ.get('EVM_COMPILE_CACHE', DEFAULT_CACHE_DIR)
+        namespace = dict(NAMESPACE)
+        namespace['J'] = analysis.is_jumpdest
+        blocks = get_blocks(analysis)
+        namespace['slow'] = lambda f, start: run_slow(blocks, f, start)
+        exec(load_code(analysis, cache_dir), namespace)
+        analysis.compiled = namespace['PROGRAM']
+    return analysis.compiled
+
+
+def execute_compiled(f):
+    return run_frames(f, run_compiled)
+
+
+def run_compiled(f):
+    # Runs `f` until it finishes or starts a sub-call, see `run_frames`
+    program = get_program(f.analysis)
+    s = f.stack
+    try:
+        pc = f.pc
+        while True:
+            block = program.get(pc)
+            if block is None:
+                # Ran off the end of the code: implicit STOP
+                break
+            pc = block(f, s)
+    except Halt:
+        pass
+    except FAILURES:
+        fail(f)
+    except SubCall as call:
+        return call.child
+    return None
+
+
+def execute(code, tx, block, state, static_mode=False):
+    return run(execute_compiled, code, tx, block, state, static_mode)
+
+
+if __name__ == '__main__':
+    from analysis import code_cache
+
+    if len(sys.argv) != 2:
+        print("usage: python3 compiler.py <code hex>")
+        sys.exit(2)
+    print(translate(code_cache.lookup(bytes.fromhex(sys.argv[1]))))
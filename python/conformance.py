@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Parallel conformance runner
+#
+# `evm.py` runs the fixtures one after the other and stops at the first
+# failure, which is what you want while implementing opcodes. This runner is
+# for checking a finished engine against many fixture files: the cases are
+# split into shards that run on a process pool, every case runs to
+# completion, and the exit code is 1 if any case failed.
+#
+# - Run `python3 conformance.py` from the `python` directory to run `evm.json`
+# - Run `python3 conformance.py more.json other.json` to run other fixture
+#   files (same format as `evm.json`, or converted by `fixture_format.py`)
+# - `--engine loop|table|blocks|compiled` selects the engine, `-j N` the
+#   number of worker processes, `-k TEXT` / `--match REGEX` filter cases by
+#   name
+# - `--json report.json` and `--junit report.xml` write a report with the
+#   outcome and wall time of every case
+#
+# Fixture files are read with `fixtures.open_fixtures`, as JSON or in the
+# binary format of `fixture_format.py`: the main process only keeps the name
+# and byte range of each case, and every worker maps the file and decodes
+# just the cases of its shards.
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree
+
+from evm import DEFAULT_ENGINE, ENGINES, evm_fixture
+from fixtures import open_fixtures
+
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "evm.json")
+
+# Fixture files opened by this process, by path
+fixture_files = {}
+
+
+def get_fixture_file(path):
+    if path not in fixture_files:
+        fixture_files[path] = open_fixtures(path)
+    return fixture_files[path]
+
+
+def check(fixture, result):
+    # None if `result` matches the expectation of `fixture`, else what differs
+    success, stack, logs, ret, gas_used = result
+    expect = fixture.expect
+    expected_stack = [int(x, 16) for x in expect.get('stack', [])]
+    if stack != expected_stack:
+        return f"stack: expected {[hex(x) for x in expected_stack]}, got {[hex(x) for x in stack]}"
+    if logs != expect.get('logs', []):
+        return f"logs: expected {expect.get('logs', [])}, got {logs}"
+    if ret != expect.get('return'):
+        return f"return: expected {expect.get('return')}, got {ret}"
+    if success != expect['success']:
+        return f"success: expected {expect['success']}, got {success}"
+    return None
+
+
+def run_case(fixture, engine):
+    start = time.perf_counter()
+    try:
+        result = evm_fixture(fixture, engine)
+        status, message = 'passed', check(fixture, result)
+        if message is not None:
+            status = 'failed'
+    except Exception as e:
+        status, message = 'error', f"{type(e).__name__}: {e}"
+    return {
+        'name': fixture.name,
+        'status': status,
+        'message': message,
+        'time': time.perf_counter() - start,
+    }
+
+
+def run_shard(shard):
+    # Runs in a worker: the file is mapped once per process, only byte
+    # ranges and results cross the process boundary
+    path, cases, engine = shard
+    fixtures = get_fixture_file(path)
+    results = []
+    for i, start, end in cases:
+        result = run_case(fixtures.read(start, end), engine)
+        result['file'] = path
+        result['index'] = i
+        results.append(result)
+    return results
+
+
+def select(paths, pattern=None, keyword=None):
+    # (path, (index, start, end)) of every case whose name matches the
+    # filters. Without filters, only the byte ranges are needed.
+    regex = re.compile(pattern) if pattern else None
+    selected = []
+    for path in paths:
+        fixtures = get_fixture_file(path)
+        if keyword is None and regex is None:
+            selected.extend((path, (i, start, end)) for i, (start, end) in enumerate(fixtures.spans()))
+            continue
+        for i, (name, start, end) in enumerate(fixtures.index()):
+            if keyword is not None and keyword.lower() not in name.lower():
+                continue
+            if regex is not None and not regex.search(name):
+                continue
+            selected.append((path, (i, start, end)))
+    return selected
+
+
+def make_shards(selected, engine, shard_size):
+    shards = []
+    for path in dict.fromkeys(path for path, _ in selected):
+        cases = [case for p, case in selected if p == path]
+        for start in range(0, len(cases), shard_size):
+            shards.append((path, cases[start:start + shard_size], engine))
+    return shards
+
+
+def run(paths, engine=DEFAULT_ENGINE, workers=None, pattern=None, keyword=None, shard_size=16):
+    shards = make_shards(select(paths, pattern, keyword), engine, shard_size)
+    if workers == 1:
+        return [result for shard in shards for result in run_shard(shard)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return [result for results in pool.map(run_shard, shards) for result in results]
+
+
+def summarize(results):
+    counts = {'passed': 0, 'failed': 0, 'error': 0}
+    for result in results:
+        counts[result['status']] += 1
+    return counts
+
+
+def write_json(path, results, engine, elapsed):
+    report = {
+        'engine': engine,
+        'time': elapsed,
+        'summary': summarize(results),
+        'cases': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def write_junit(path, results, engine, elapsed):
+    counts = summarize(results)
+    suite = ElementTree.Element('testsuite', {
+        'name': f"evm-{engine}",
+        'tests': str(len(results)),
+        'failures': str(counts['failed']),
+        'errors': str(counts['error']),
+        'time': f"{elapsed:.6f}",
+    })
+    for result in results:
+        case = ElementTree.SubElement(suite, 'testcase', {
+            'classname': os.path.basename(result['file']),
+            'name': result['name'],
+            'time': f"{result['time']:.6f}",
+        })
+        if result['status'] == 'failed':
+            ElementTree.SubElement(case, 'failure', {'message': result['message']})
+        elif result['status'] == 'error':
+            ElementTree.SubElement(case, 'error', {'message': result['message']})
+    ElementTree.ElementTree(suite).write(path, encoding='utf-8', xml_declaration=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run evm.json-style fixtures in parallel")
+    parser.add_argument('files', nargs='*', default=[DEFAULT_FIXTURES])
+    parser.add_argument('--engine', default=DEFAULT_ENGINE, choices=sorted(ENGINES),
+                        help=f"engine to run: {', '.join(ENGINES)} (default: {DEFAULT_ENGINE})")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('-k', dest='keyword', help="only cases whose name contains this text")
+    parser.add_argument('--match', dest='pattern', help="only cases whose name matches this regex")
+    parser.add_argument('--shard-size', type=int, default=16)
+    parser.add_argument('--json', dest='json_report', help="write a JSON report to this file")
+    parser.add_argument('--junit', dest='junit_report', help="write a JUnit XML report to this file")
+    parser.add_argument('-q', '--quiet', action='store_true', help="only print failures and the summary")
+    args = parser.parse_args(argv)
+
+    paths = [os.path.abspath(path) for path in args.files]
+    start = time.perf_counter()
+    results = run(paths, args.engine, args.workers, args.pattern, args.keyword, args.shard_size)
+    elapsed = time.perf_counter() - start
+
+    for result in results:
+        if result['status'] != 'passed':
+            print(f"❌ {result['name']} ({result['status']}): {result['message']}")
+        elif not args.quiet:
+            print(f"✓  {result['name']}")
+    counts = summarize(results)
+    print(f"{counts['passed']} passed, {counts['failed']} failed, {counts['error']} errors in {elapsed:.2f}s")
+
+    if args.json_report:
+        write_json(args.json_report, results, args.engine, elapsed)
+    if args.junit_report:
+        write_junit(args.junit_report, results, args.engine, elapsed)
+    return 0 if counts['passed'] == len(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,16 +9,49 @@
 # - Go to the `python` directory: `cd python`
 # - Edit `evm.py` (this file!), see TODO below
 # - Run `python3 evm.py` to run the tests
+# - Run `python3 evm.py --engine loop` to run them on the reference if/elif loop
+#   (or `--engine blocks` for the pre-decoded basic-block engine, `--engine
+#   compiled` for the engine that compiles blocks to Python)
+# - Run `python3 bench.py` to compare the speed of the engines
+# - Run `python3 conformance.py` to run all cases in parallel, with reports
+# - Run `python3 instrument.py <code hex>` to profile or trace some bytecode
+# - Run `python3 uint256.py` to check the 256-bit arithmetic against a reference
+# - Run `python3 storage_backend.py` to check execution on a persistent (SQLite) state
 
-import json
 import os
 import math
-from eth_hash.auto import keccak
-
-# Persistent
-storage = {}
-
-def evm(code, tx, block, state, static_mode=False):
+import sys
+
+import basic_blocks
+import compiler
+import interpreter
+import uint256
+from analysis import code_cache
+from fixtures import open_fixtures
+from gas import MAX_MEMORY, OutOfGas
+from hashing import keccak_int
+from model import parse_int
+from storage_backend import DictBackend
+
+# Reference implementation: one big if/elif chain, kept to compare results
+# against the dispatch-table engine in `interpreter.py`
+def evm_loop(code, tx, block, state, static_mode=False, storage=None):
+    # `storage` is shared with the sub-calls of an execution, a new one is
+    # made for every top-level execution
+    if storage is None:
+        storage = DictBackend()
+    try:
+        success, stack, logs, ret, gas_used = run_loop(code, tx, block, state, static_mode, storage)
+    except OutOfGas:
+        # Memory past `gas.MAX_MEMORY`
+        return (False, [], [], None, None)
+    if not success:
+        # Like the other engines: a failed execution leaves no stack or logs
+        return (False, [], [], ret, gas_used)
+    return (success, stack, logs, ret, gas_used)
+
+def run_loop(code, tx, block, state, static_mode, storage):
+    # `storage`: slots by (address, slot), see `evm_loop`
     pc = 0
     success = True
     stack = []
@@ -28,7 +61,6 @@ def evm(code, tx, block, state, static_mode=False):
     last_ret = None
     BYTE_SIZE = 8
     MAX_UINT256 = 2**256 - 1
-    MAX_UINT32 = 2**32 - 1
 
     def get_n_of_stack_elements(n, stack):
         if n <= 0:
@@ -45,32 +77,24 @@ def evm(code, tx, block, state, static_mode=False):
         # elif n == 4:
         #     return [stack.pop(0), stack.pop(0), stack.pop(0), stack.pop(0)]
         
-    def is_num_negative(num):
-        if num == 0:
-            return False, None # The Byte Size here should be dependent to the num format
-        if num.bit_length() % BYTE_SIZE == 0:
-            return True, int(num.bit_length() / BYTE_SIZE)
-        return False, int(math.floor(num.bit_length() / BYTE_SIZE))+1
-
-    def negative_to_positive(num, byte_size):
-        return ((0x1 << byte_size * BYTE_SIZE) - num)
-
-    def extract_lower_bits(num, n_bits):
-        bit_mask = (0x1 << n_bits) - 1
-        return num & bit_mask
+    analysis = code_cache.lookup(code)
 
     def is_invalid_JUMPDEST(destination_offset):
-        for i in range(1, 33):
-            index = destination_offset - i
-            if index >= 0 and code[index] >= 0x5f + i and code[index] < 0x80:
-                return True
-        return False
+        return not analysis.is_jumpdest(destination_offset)
 
     def padding_address(address):
         return '0x' + '0'*(22 - len(address)) + address[2:] if len(address) < 22 else address
 
+    def check_memory(end):
+        # No gas here, but memory stops at the same size as in the engines
+        if end > MAX_MEMORY:
+            raise OutOfGas
+
     def mload(memory, byte_offset, byte_size):
+        if byte_size == 0:
+            return 0
         if len(memory) < byte_offset + byte_size:
+            check_memory(byte_offset + byte_size)
             memory += ([0] * (byte_offset + byte_size - len(memory)))
         data = 0
         for i in range(byte_size):
@@ -79,7 +103,10 @@ def evm(code, tx, block, state, static_mode=False):
         return data
 
     def mstore(memory, data, byte_offset, byte_size):
+        if byte_size == 0:
+            return memory
         if len(memory) < byte_offset + byte_size:
+            check_memory(byte_offset + byte_size)
             memory += ([0] * (byte_offset + byte_size - len(memory)))
         for i in range(byte_size):
             memory[byte_offset + byte_size - i - 1] = (data >> (i * 8)) & 0xFF
@@ -113,43 +140,13 @@ def evm(code, tx, block, state, static_mode=False):
         # DIV (whole) (by zero)
         elif op == 0x04:
             [a, b], stack = get_n_of_stack_elements(2, stack)
-            value = 0 if b == 0 else math.floor(a / b)
+            value = uint256.div(a, b)
             stack.insert(0, value)
         
         # SDIV (negative) (mix of negative and positive) (by zero)
         elif op == 0x05:
             [a, b], stack = get_n_of_stack_elements(2, stack)
-            if b == 0:
-                stack.insert(0, 0)
-            else:
-                a_is_negative, a_byte_size = is_num_negative(a)
-                b_is_negative, b_byte_size = is_num_negative(b)
-                if not a_is_negative and not b_is_negative:
-                    # both positive
-                    value = a / b
-                    stack.insert(0, value)
-                elif a_is_negative and b_is_negative:
-                    # both negative
-                    value = math.floor(negative_to_positive(a, a_byte_size) / negative_to_positive(b, b_byte_size))
-                    stack.insert(0, value)
-                elif a_is_negative:
-                    # only one negative, and a is negative
-                    value = math.floor(negative_to_positive(a, a_byte_size) / b)
-                    padding = 1
-                    counter = 0
-                    while counter < a.bit_length():
-                        padding = padding << 1
-                        counter += 1
-                    stack.insert(0, padding - value)
-                elif b_is_negative:
-                    # only one negative, and b is negative
-                    value = math.floor(a / negative_to_positive(b, b_byte_size))
-                    padding = 1
-                    counter = 0
-                    while counter < b.bit_length():
-                        padding = padding << 1
-                        counter += 1
-                    stack.insert(0, padding - value)
+            stack.insert(0, uint256.sdiv(a, b))
 
         # MOD (by larger number) (by zero)
         elif op == 0x06:
@@ -162,20 +159,7 @@ def evm(code, tx, block, state, static_mode=False):
         # SMOD (negative) (by zero)
         elif op == 0x07:
             [a, b], stack = get_n_of_stack_elements(2, stack)
-            if b == 0:
-                stack.insert(0, 0)
-            else:
-                a_is_negative, a_byte_size = is_num_negative(a)
-                b_is_negative, b_byte_size = is_num_negative(b)
-                if b_is_negative:
-                    b = negative_to_positive(b, b_byte_size)
-                if a_is_negative:
-                    a = negative_to_positive(a, a_byte_size)
-                    value = negative_to_positive((a % b), a_byte_size)
-                    stack.insert(0, value)
-                else:
-                    value = a % b
-                    stack.insert(0, value)
+            stack.insert(0, uint256.smod(a, b))
 
         # ADDMOD (wrapped)
         elif op == 0x08:
@@ -195,20 +179,10 @@ def evm(code, tx, block, state, static_mode=False):
             value = a ** exponent
             stack.insert(0, value)
         
-        # SIGNEXTEND (positive)
+        # SIGNEXTEND (positive) (negative)
         elif op == 0x0b:
             [b, x], stack = get_n_of_stack_elements(2, stack)
-            x_bit_length = x.bit_length()
-            if x_bit_length % BYTE_SIZE != 0:
-                stack.insert(0, x)
-            else:
-                padding = 1
-                counter = 0
-                while counter < x_bit_length:
-                    padding = padding << 1
-                    counter += 1
-                padding = padding - 1 # after bit shift, need to minus one
-                stack.insert(0, MAX_UINT256 - padding + x)
+            stack.insert(0, uint256.signextend(b, x))
         
         # LT (equal) (greater)
         elif op == 0x10:
@@ -229,34 +203,12 @@ def evm(code, tx, block, state, static_mode=False):
         # SLT (equal) (less)
         elif op == 0x12:
             [a, b], stack = get_n_of_stack_elements(2, stack)
-            a_is_negative, a_byte_size = is_num_negative(a)
-            b_is_negative, b_byte_size = is_num_negative(b)
-            if a_is_negative and b_is_negative:
-                a = negative_to_positive(a, a_byte_size)
-                b = negative_to_positive(b, b_byte_size)
-                stack.insert(0, 1 if a - b > 0 else 0)
-            elif a_is_negative:
-                stack.insert(0, 1)
-            elif b_is_negative:
-                stack.insert(0, 0)
-            else:
-                stack.insert(0, 1 if a - b < 0 else 0)
+            stack.insert(0, uint256.slt(a, b))
         
         # SGT (equal) (greater)
         elif op == 0x13:
             [a, b], stack = get_n_of_stack_elements(2, stack)
-            a_is_negative, a_byte_size = is_num_negative(a)
-            b_is_negative, b_byte_size = is_num_negative(b)
-            if a_is_negative and b_is_negative:
-                a = negative_to_positive(a, a_byte_size)
-                b = negative_to_positive(b, b_byte_size)
-                stack.insert(0, 1 if a - b < 0 else 0)
-            elif b_is_negative:
-                stack.insert(0, 1)
-            elif a_is_negative:
-                stack.insert(0, 0)
-            else:
-                stack.insert(0, 1 if a - b > 0 else 0)
+            stack.insert(0, uint256.sgt(a, b))
         
         # EQ (not equal)
         elif op == 0x14:
@@ -313,52 +265,26 @@ def evm(code, tx, block, state, static_mode=False):
         # SHL (discards) (too large)
         elif op == 0x1b:
             [shift, num], stack = get_n_of_stack_elements(2, stack)
-            num_is_negative, num_byte_size = is_num_negative(num)
-            if shift >= MAX_UINT32: # (too large)
-                stack.insert(0, 0)
-            else: # (discards)
-                value = extract_lower_bits(num, num_byte_size * BYTE_SIZE - shift) << shift
-                stack.insert(0, value)
+            stack.insert(0, uint256.shl(shift, num))
 
         # SHR (discards) (too large)
         elif op == 0x1c:
             [shift, num], stack = get_n_of_stack_elements(2, stack)
-            num_is_negative, num_byte_size = is_num_negative(num)
-            if shift >= MAX_UINT32: # (too large)
-                stack.insert(0, 0)
-            else: # (discards) 
-                value = num >> shift
-                stack.insert(0, value)
+            stack.insert(0, uint256.shr(shift, num))
 
         # SAR (fills 1s) (too large) (positive, too large)
         elif op == 0x1d:
             [shift, num], stack = get_n_of_stack_elements(2, stack)
-            num_is_negative, num_byte_size = is_num_negative(num)
-            if shift >= MAX_UINT32:  # (too large) 
-                if num_is_negative:
-                    stack.insert(0, (0x1 << (num_byte_size * BYTE_SIZE)) - 1)
-                else:
-                    stack.insert(0, 0)
-            else:
-                if num_is_negative: # (fills 1s) 
-                    bit_mask = ((0x1 << num_byte_size * BYTE_SIZE) - 1) ^ ((0x1 << (num_byte_size * BYTE_SIZE - shift)) - 1)
-                    value = (num >> shift) | bit_mask
-                    stack.insert(0, value)
-                else: # positive
-                    value = num >> shift
-                    stack.insert(0, value)
+            stack.insert(0, uint256.sar(shift, num))
 
         # SHA3
         elif op == 0x20:
             [byte_offset, byte_size], stack = get_n_of_stack_elements(2, stack)
-            if len(memory) < byte_offset + byte_size:
-                memory += ([0] * (byte_offset + 32 - len(memory)))
-            value = 0
-            for i in range(byte_size):
-                value = value << BYTE_SIZE
-                value += memory[byte_offset + i]
-            hashed_value = int.from_bytes(keccak(value.to_bytes(byte_size, byteorder='big')), byteorder="big")
-            stack.insert(0, hashed_value)
+            if byte_size and len(memory) < byte_offset + byte_size:
+                check_memory(byte_offset + byte_size)
+                memory += [0] * (byte_offset + byte_size - len(memory))
+            data = bytes(memory[byte_offset:byte_offset + byte_size])
+            stack.insert(0, keccak_int(data.ljust(byte_size, b'\0')))
 
         # ADDRESS
         elif op == 0x30:
@@ -415,6 +341,7 @@ def evm(code, tx, block, state, static_mode=False):
             bit_mask = ((0x1 << 256) - 1) ^ ((0x1 << (256 - byte_size * 8)) - 1)
             data = (data << (BYTE_SIZE * byte_offset)) & bit_mask # (tail)
             if len(memory) < dest_offset + 32: # (tail)
+                check_memory(dest_offset + 32)
                 memory += [0] * (dest_offset + 32 - len(memory))
             for i in range(32):
                 memory[dest_offset + 31 - i] = (data >> (i * 8)) & 0xFF
@@ -427,6 +354,7 @@ def evm(code, tx, block, state, static_mode=False):
         elif op == 0x39:
             [dest_offset, byte_offset, byte_size], stack = get_n_of_stack_elements(3, stack)
             if len(memory) < dest_offset + byte_size:
+                check_memory(dest_offset + byte_size)
                 memory += ([0] * (dest_offset + byte_size - len (memory)))
             data = code
             for i in range(byte_size):
@@ -461,6 +389,7 @@ def evm(code, tx, block, state, static_mode=False):
                 extcode = bytes.fromhex(state[address]['code']['bin'])
             
             if len(memory) < dest_offset + byte_size:
+                check_memory(dest_offset + byte_size)
                 memory += ([0] * (dest_offset + byte_size - len (memory)))
             for i in range(byte_size):
                 if (byte_offset + i) < len(extcode):
@@ -488,8 +417,8 @@ def evm(code, tx, block, state, static_mode=False):
             if state is None or address not in state or 'code' not in state[address]:
                 stack.insert(0, 0)
             else:
-                extcode = bytes.fromhex(state[address]['code']['bin'])
-                stack.insert(0, int.from_bytes(keccak(extcode), byteorder='big'))
+                code_hash = code_cache.lookup_hex(state[address]['code']['bin']).code_hash
+                stack.insert(0, int.from_bytes(code_hash, byteorder='big'))
 
         # BLOCKHASH
         elif op == 0x40:
@@ -558,13 +487,14 @@ def evm(code, tx, block, state, static_mode=False):
         elif op == 0x53:
             [byte_offset, num], stack = get_n_of_stack_elements(2, stack)
             if len(memory) < byte_offset + 1:
+                check_memory(byte_offset + 1)
                 memory += [0] * (byte_offset + 1 - len(memory))
             memory[byte_offset] = num & 0xff
 
         # SLOAD
         elif op == 0x54:
             [key], stack = get_n_of_stack_elements(1, stack)
-            stack.insert(0, storage.get(hex(key), 0))
+            stack.insert(0, storage.load_slot(parse_int(tx.get('to')) if tx else 0, key))
         
         # SSTORE
         elif op == 0x55:
@@ -572,7 +502,7 @@ def evm(code, tx, block, state, static_mode=False):
                 success = False
                 break
             [key, value], stack = get_n_of_stack_elements(2, stack)
-            storage[hex(key)] = value
+            storage.store_slot(parse_int(tx.get('to')) if tx else 0, key, value)
 
         # JUMP
         elif op == 0x56:
@@ -651,6 +581,7 @@ def evm(code, tx, block, state, static_mode=False):
             else:
                 topics = []
             if len(memory) < byte_offset + 32:
+                check_memory(byte_offset + 32)
                 memory += ([0] * (byte_offset + 32 - len(memory)))
             data = 0
             for i in range(byte_size):
@@ -669,7 +600,7 @@ def evm(code, tx, block, state, static_mode=False):
             address = tx['to']
             contract = mload(memory, byte_offset, byte_size)
             if contract != 0:
-                _success, _, _logs, _ret = evm(bytes.fromhex(hex(contract)[2:]), {}, block, False)
+                _success, _, _logs, _ret, _ = evm_loop(bytes.fromhex(hex(contract)[2:]), {}, block, False, storage=storage)
                 if not _success:
                     stack.insert(0, 0)
                 else:
@@ -701,7 +632,7 @@ def evm(code, tx, block, state, static_mode=False):
                 "origin": tx.get("origin") if tx else None,
                 "from": tx.get("to") if tx else None,
             }
-            _success, _, new_logs, new_ret = evm(bytes.fromhex(state[address]['code']['bin']), new_tx, block, state, False)
+            _success, _, new_logs, new_ret, _ = evm_loop(bytes.fromhex(state[address]['code']['bin']), new_tx, block, state, False, storage)
             logs += new_logs
             if new_ret != None and len(new_ret) != 0:
                 new_ret = new_ret[:ret_size * 2]
@@ -721,7 +652,7 @@ def evm(code, tx, block, state, static_mode=False):
             [gas, address, args_offset, args_size, ret_offset, ret_size], stack = get_n_of_stack_elements(6, stack)
             address = padding_address(hex(address))
             args = mload(memory, args_offset, args_size)
-            _success, _, new_logs, new_ret = evm(bytes.fromhex(state[address]['code']['bin']), tx, block, state, False)
+            _success, _, new_logs, new_ret, _ = evm_loop(bytes.fromhex(state[address]['code']['bin']), tx, block, state, False, storage)
             logs += new_logs
             if new_ret != None and len(new_ret) != 0:
                 new_ret = new_ret[:ret_size * 2]
@@ -739,7 +670,7 @@ def evm(code, tx, block, state, static_mode=False):
                 "origin": tx.get("origin") if tx else None,
                 "from": tx.get("to") if tx else None
             }
-            _success, _, new_logs, new_ret = evm(bytes.fromhex(state[address]['code']['bin']), new_tx, block, state, True)
+            _success, _, new_logs, new_ret, _ = evm_loop(bytes.fromhex(state[address]['code']['bin']), new_tx, block, state, True, storage)
             logs += new_logs
             if new_ret != None and len(new_ret) != 0:
                 new_ret = new_ret[:ret_size * 2]
@@ -774,23 +705,38 @@ def evm(code, tx, block, state, static_mode=False):
             state[address]['balance'] = hex(int(state[address]['balance'], 16) + balance)
         pc += 1
 
-    return (success, stack, logs, ret)
+    # No gas accounting in the reference loop
+    return (success, stack, logs, ret, None)
 
-def test():
+ENGINES = {
+    'loop': evm_loop,
+    'table': interpreter.execute,
+    'blocks': basic_blocks.execute,
+    'compiled': compiler.execute,
+}
+DEFAULT_ENGINE = 'table'
+
+def evm(code, tx, block, state, static_mode=False, engine=DEFAULT_ENGINE):
+    return ENGINES[engine](code, tx, block, state, static_mode)
+
+def evm_fixture(fixture, engine=DEFAULT_ENGINE):
+    # Runs a `fixtures.Fixture`: the loop engine takes (and changes) the JSON
+    # state, the others a copy of the decoded `WorldState`
+    state = fixture.json_state() if engine == 'loop' else fixture.world()
+    return evm(fixture.code, fixture.tx, fixture.block, state, False, engine)
+
+def test(engine=DEFAULT_ENGINE):
     script_dirname = os.path.dirname(os.path.abspath(__file__))
     json_file = os.path.join(script_dirname, "..", "evm.json")
-    with open(json_file) as f:
-        data = json.load(f)
-        total = len(data)
-
-        for i, test in enumerate(data):
-            # Note: as the test cases get more complex, you'll need to modify this
-            # to pass down more arguments to the evm function
-            code = bytes.fromhex(test['code']['bin'])
-            tx = test.get('tx')
-            block = test.get('block')
-            state = test.get('state')
-            (success, stack, logs, ret) = evm(code, tx, block, state, False)
+    with open_fixtures(json_file) as fixtures:
+        # Cases are found as they run, so only a binary fixture file (which
+        # has an index) knows how many there are up front
+        total = f"/{len(fixtures)}" if hasattr(fixtures, '__len__') else ''
+
+        for i, (start, end) in enumerate(fixtures.spans()):
+            fixture = fixtures.read(start, end)
+            test = fixture.data
+            (success, stack, logs, ret, gas_used) = evm_fixture(fixture, engine)
 
             expected_stack = [int(x, 16) for x in test['expect'].get('stack', [])]
             expected_logs = test['expect'].get('logs', [])
@@ -798,7 +744,7 @@ def test():
 
 
             if stack != expected_stack or success != test['expect']['success'] or expected_logs != logs or expected_return != ret:
-                print(f"❌ Test #{i + 1}/{total} {test['name']}")
+                print(f"❌ Test #{i + 1}{total} {test['name']}")
                 if stack != expected_stack:
                     print("Stack doesn't match")
                     print(" expected in decimal:", expected_stack)
@@ -823,11 +769,15 @@ def test():
                 print("")
                 print("Hint:", test['hint'])
                 print("")
-                print(f"Progress: {i}/{len(data)}")
+                print(f"Progress: {i}{total}")
                 print("")
                 break
             else:
-                print(f"✓  Test #{i + 1}/{total} {test['name']}")
+                print(f"✓  Test #{i + 1}{total} {test['name']}")
 
 if __name__ == '__main__':
-    test()
+    # python3 evm.py [--engine loop|table|blocks]
+    engine = DEFAULT_ENGINE
+    if '--engine' in sys.argv:
+        engine = sys.argv[sys.argv.index('--engine') + 1]
+    test(engine)
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Binary fixture format
+#
+# `evm.json` stores code, numbers and addresses as hex strings, about twice
+# the size of the bytes they stand for, and a reader has to parse all of it
+# to find one case. This is a binary container for the same data, which
+# converts back to the same JSON:
+#
+#     header   8-byte magic b'EVMFIX\0\1' (the last byte is the version),
+#              then the offset of the index (uint64, little-endian)
+#     cases    one encoded value per case, back to back
+#     index    varint case count, then for each case: varint offset,
+#              varint length, varint name length, UTF-8 name
+#
+# so a reader maps the file, reads the index, and decodes only the cases it
+# asks for, by position or by name (`BinaryFixtureFile`, which has the same
+# interface as `fixtures.FixtureFile`; `fixtures.open_fixtures` picks the
+# right one from the first bytes of the file).
+#
+# A case is encoded as a tagged JSON value, one tag byte then:
+#
+#     NULL, FALSE, TRUE    nothing
+#     INT                  zigzag varint
+#     KEY                  one byte, index of a field name of the evm.json
+#                          schema in `KEYS`
+#     ADDRESS              '0x' and 40 hex digits: the 20 bytes
+#     HEX                  other '0x' numbers: varint digit count (leading
+#                          zeros are kept) and the big-endian bytes
+#     RAW                  un-prefixed hex, like code and calldata: varint
+#                          length and the bytes
+#     TEXT                 any other string: varint length and UTF-8
+#     LIST                 varint length and the items
+#     DICT                 varint length and the key/value pairs, keys
+#                          encoded as strings (so addresses as ADDRESS)
+#
+# Varints are unsigned LEB128. Only lowercase hex is stored as bytes, so
+# every string converts back exactly. `KEYS` can only be appended to.
+#
+# - Run `python3 fixture_format.py IN OUT` to convert `IN` to the other
+#   format (JSON to binary or binary to JSON)
+# - Run `python3 fixture_format.py` to convert `evm.json` both ways, check
+#   that nothing changed and compare the size and loading time of the two
+
+import json
+import mmap
+import re
+import struct
+import sys
+
+from fixtures import Fixture
+
+MAGIC = b'EVMFIX\x00\x01'
+HEADER = struct.Struct('<8sQ')
+
+NULL, FALSE, TRUE, INT, KEY, ADDRESS, HEX, RAW, TEXT, LIST, DICT = range(11)
+
+KEYS = (
+    'name', 'hint', 'code', 'asm', 'bin', 'tx', 'block', 'state', 'expect',
+    'success', 'stack', 'logs', 'return', 'address', 'topics', 'data',
+    'to', 'from', 'origin', 'gasprice', 'value', 'gas',
+    'coinbase', 'timestamp', 'number', 'difficulty', 'gaslimit', 'chainid', 'basefee',
+    'balance', 'nonce', 'storage',
+)
+KEY_INDEX = {key: i for i, key in enumerate(KEYS)}
+
+ADDRESS_STRING = re.compile(r'0x[0-9a-f]{40}\Z')
+HEX_STRING = re.compile(r'0x[0-9a-f]*\Z')
+RAW_STRING = re.compile(r'(?:[0-9a-f]{2})*\Z')
+
+
+def write_varint(out, n):
+    while n >= 0x80:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def encode_string(out, s):
+    index = KEY_INDEX.get(s)
+    if index is not None:
+        out.append(KEY)
+        out.append(index)
+    elif ADDRESS_STRING.match(s):
+        out.append(ADDRESS)
+        out += bytes.fromhex(s[2:])
+    elif HEX_STRING.match(s):
+        digits = s[2:]
+        out.append(HEX)
+        write_varint(out, len(digits))
+        out += bytes.fromhex(digits.zfill(len(digits) + (len(digits) & 1)))
+    elif RAW_STRING.match(s):
+        out.append(RAW)
+        write_varint(out, len(s) // 2)
+        out += bytes.fromhex(s)
+    else:
+        data = s.encode()
+        out.append(TEXT)
+        write_varint(out, len(data))
+        out += data
+
+
+def encode_value(out, value):
+    if value is None:
+        out.append(NULL)
+    elif value is False:
+        out.append(FALSE)
+    elif value is True:
+        out.append(TRUE)
+    elif isinstance(value, int):
+        out.append(INT)
+        write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+    elif isinstance(value, str):
+        encode_string(out, value)
+    elif isinstance(value, list):
+        out.append(LIST)
+        write_varint(out, len(value))
+        for item in value:
+            encode_value(out, item)
+    elif isinstance(value, dict):
+        out.append(DICT)
+        write_varint(out, len(value))
+        for key, item in value.items():
+            encode_string(out, key)
+            encode_value(out, item)
+    else:
+        raise TypeError(f"can't encode a {type(value).__name__} in a fixture")
+
+
+def decode_value(data, pos):
+    # (value, position after it) of the value encoded at `pos`
+    tag = data[pos]
+    pos += 1
+    if tag == KEY:
+        return KEYS[data[pos]], pos + 1
+    if tag == RAW:
+        size, pos = read_varint(data, pos)
+        return data[pos:pos + size].hex(), pos + size
+    if tag == HEX:
+        digits, pos = read_varint(data, pos)
+        size = (digits + 1) // 2
+        return '0x' + data[pos:pos + size].hex()[2 * size - digits:], pos + size
+    if tag == ADDRESS:
+        return '0x' + data[pos:pos + 20].hex(), pos + 20
+    if tag == DICT:
+        size, pos = read_varint(data, pos)
+        value = {}
+        for _ in range(size):
+            key, pos = decode_value(data, pos)
+            value[key], pos = decode_value(data, pos)
+        return value, pos
+    if tag == LIST:
+        size, pos = read_varint(data, pos)
+        value = []
+        for _ in range(size):
+            item, pos = decode_value(data, pos)
+            value.append(item)
+        return value, pos
+    if tag == TEXT:
+        size, pos = read_varint(data, pos)
+        return data[pos:pos + size].decode(), pos + size
+    if tag == TRUE:
+        return True, pos
+    if tag == FALSE:
+        return False, pos
+    if tag == NULL:
+        return None, pos
+    if tag == INT:
+        n, pos = read_varint(data, pos)
+        return (n >> 1) ^ -(n & 1), pos
+    raise ValueError(f"unknown fixture value tag {tag}")
+
+
+def encode_case(case):
+    out = bytearray()
+    encode_value(out, case)
+    return out
+
+
+def decode_case(data):
+    return decode_value(data, 0)[0]
+
+
+def write_binary(cases, path):
+    # Writes the JSON `cases` (any iterable) to `path` in the binary format
+    with open(path, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, 0))
+        index = []
+        offset = HEADER.size
+        for case in cases:
+            data = encode_case(case)
+            index.append((case.get('name', ''), offset, len(data)))
+            out.write(data)
+            offset += len(data)
+        table = bytearray()
+        write_varint(table, len(index))
+        for name, start, size in index:
+            write_varint(table, start)
+            write_varint(table, size)
+            name = name.encode()
+            write_varint(table, len(name))
+            table += name
+        out.write(table)
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, offset))
+
+
+def write_json(cases, path):
+    # Writes the JSON `cases` as a JSON array, one case at a time
+    with open(path, 'w') as out:
+        out.write('[')
+        separator = '\n'
+        for case in cases:
+            out.write(separator)
+            out.write('\n'.join('  ' + line for line in json.dumps(case, indent=2).split('\n')))
+            separator = ',\n'
+        out.write('\n]\n')
+
+
+class BinaryFixtureFile:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, offset = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a binary fixture file")
+        # [(name, start, end)] of every case, in order
+        self.cases = []
+        data = self.buffer
+        count, pos = read_varint(data, offset)
+        for _ in range(count):
+            start, pos = read_varint(data, pos)
+            size, pos = read_varint(data, pos)
+            length, pos = read_varint(data, pos)
+            self.cases.append((data[pos:pos + length].decode(), start, start + size))
+            pos += length
+        self.by_name = {}
+        for name, start, end in self.cases:
+            self.by_name.setdefault(name, (start, end))
+
+    def __iter__(self):
+        for _, start, end in self.cases:
+            yield self.read(start, end)
+
+    def __len__(self):
+        return len(self.cases)
+
+    def spans(self):
+        return [(start, end) for _, start, end in self.cases]
+
+    def index(self):
+        return list(self.cases)
+
+    def read(self, start, end):
+        return Fixture(decode_case(self.buffer[start:end]))
+
+    def get(self, name):
+        # The first case called `name`
+        start, end = self.by_name[name]
+        return self.read(start, end)
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def is_binary(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def convert(source, destination):
+    # Converts `source` to the other format, returns the number of cases
+    from fixtures import open_fixtures
+
+    count = 0
+
+    def cases():
+        nonlocal count
+        with open_fixtures(source) as fixtures:
+            for fixture in fixtures:
+                count += 1
+                yield fixture.data
+
+    if is_binary(source):
+        write_json(cases(), destination)
+    else:
+        write_binary(cases(), destination)
+    return count
+
+
+def compare(path):
+    # Converts `path` to binary and back, checks that the cases are the
+    # same and times loading every case of each file
+    import os
+    import tempfile
+    import time
+
+    from fixtures import open_fixtures
+
+    with tempfile.TemporaryDirectory() as directory:
+        binary = os.path.join(directory, 'fixtures.evmfix')
+        back = os.path.join(directory, 'fixtures.json')
+        convert(path, binary)
+        convert(binary, back)
+
+        with open(path) as f:
+            original = json.load(f)
+        with open(back) as f:
+            same = json.load(f) == original
+        print("✓  binary and back gives the same cases" if same else "❌ cases changed in the conversion")
+
+        start = time.perf_counter()
+        with open(path) as f:
+            json.load(f)
+        print(f"json.load of {os.path.basename(path)}: {(time.perf_counter() - start) * 1000:.2f} ms")
+        for name, file in (('json', path), ('binary', binary)):
+            start = time.perf_counter()
+            with open_fixtures(file) as fixtures:
+                opened = time.perf_counter()
+                for fixture in fixtures:
+                    fixture.code
+            done = time.perf_counter()
+            print(f"{name:>6}: {os.path.getsize(file):6} bytes, open {(opened - start) * 1000:.2f} ms, "
+                  f"every case {(done - start) * 1000:.2f} ms")
+        return same
+
+
+def main():
+    import os
+
+    if len(sys.argv) == 3:
+        count = convert(sys.argv[1], sys.argv[2])
+        print(f"{count} cases written to {sys.argv[2]}")
+    elif len(sys.argv) == 1:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'evm.json')
+        sys.exit(0 if compare(path) else 1)
+    else:
+        print("usage: python3 fixture_format.py [IN OUT]")
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
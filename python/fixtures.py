@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Fixture loading
+#
+# `json.load` of a fixture file parses every case before the first one
+# runs, and keeps them all in memory. Fixture and state dumps can be far
+# bigger than `evm.json`, so `FixtureFile` reads them case by case instead:
+#
+# - the file is memory-mapped, nothing is read up front
+# - cases are found by scanning for the braces of the top-level array with
+#   a regex over the mapped bytes (JSON strings are matched whole, so braces
+#   inside them don't count), and only the bytes of one case are parsed at a
+#   time
+# - `spans()` yields the byte range of every case without parsing any of
+#   them, as the scan finds it, and `read(start, end)` parses one: the first
+#   case can run before the rest of the file has been scanned, and a worker
+#   can run a few cases of a huge file without touching the others
+#
+# Binary fixture files (see `fixture_format.py`) have an index of the cases
+# instead, `open_fixtures` opens either kind.
+#
+# Each case is a `Fixture`, which decodes what it needs on first use and
+# keeps it: the code, and the state as a `WorldState` that every execution
+# gets a copy of (the contract code in it is decoded once).
+#
+#     with open_fixtures('evm.json') as fixtures:
+#         for fixture in fixtures:
+#             evm_fixture(fixture)
+#
+# - Run `python3 fixtures.py FILE` to list the cases of a fixture file
+
+import copy
+import json
+import mmap
+import re
+import sys
+
+from world_state import WorldState
+
+# A JSON string, or a brace
+TOKENS = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}]', re.S)
+
+OPEN_BRACE = ord('{')
+CLOSE_BRACE = ord('}')
+
+NAME_KEY = b'"name"'
+COLON = re.compile(rb'\s*:')
+
+
+class Fixture:
+    __slots__ = ('data', '_code', '_world')
+
+    def __init__(self, data):
+        # One case of an `evm.json`-style file, as parsed from JSON
+        self.data = data
+        self._code = None
+        self._world = None
+
+    @property
+    def name(self):
+        return self.data['name']
+
+    @property
+    def code(self):
+        if self._code is None:
+            self._code = bytes.fromhex(self.data['code']['bin'])
+        return self._code
+
+    @property
+    def tx(self):
+        return self.data.get('tx')
+
+    @property
+    def block(self):
+        return self.data.get('block')
+
+    @property
+    def expect(self):
+        return self.data['expect']
+
+    def json_state(self):
+        # A copy of the JSON state, for engines that change it in place
+        return copy.deepcopy(self.data.get('state'))
+
+    def world(self):
+        # A fresh `WorldState` with the state of the case
+        if self._world is None:
+            self._world = WorldState.from_json(self.data.get('state'))
+        return self._world.copy()
+
+
+def scan(buffer, start=0):
+    # (start, end) of every object of the JSON array in `buffer`, in order
+    depth = 0
+    begin = None
+    for match in TOKENS.finditer(buffer, start):
+        pos = match.start()
+        char = buffer[pos]
+        if char == OPEN_BRACE:
+            if depth == 0:
+                begin = pos
+            depth += 1
+        elif char == CLOSE_BRACE:
+            depth -= 1
+            if depth == 0:
+                yield begin, pos + 1
+
+
+def case_name(buffer, start, end):
+    # The "name" of the case at buffer[start:end], found with the same scan
+    # as `scan()` instead of parsing the case
+    depth = 0
+    after_key = False
+    for match in TOKENS.finditer(buffer, start, end):
+        char = buffer[match.start()]
+        if char == OPEN_BRACE:
+            depth += 1
+        elif char == CLOSE_BRACE:
+            depth -= 1
+        elif depth == 1:
+            if after_key:
+                return json.loads(match.group())
+            after_key = match.group() == NAME_KEY and COLON.match(buffer, match.end(), end) is not None
+    return None
+
+
+class FixtureFile:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        # mmap can't map an empty file
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.file.seek(0, 2) else b''
+
+    def __iter__(self):
+        for start, end in scan(self.buffer):
+            yield self.read(start, end)
+
+    def spans(self):
+        # Lazily: only the part of the file read so far is scanned
+        return scan(self.buffer)
+
+    def index(self):
+        # (name, start, end) of every case, without parsing them
+        for start, end in scan(self.buffer):
+            yield case_name(self.buffer, start, end), start, end
+
+    def read(self, start, end):
+        return Fixture(json.loads(self.buffer[start:end]))
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_fixtures(path):
+    # A `FixtureFile`, or a `fixture_format.BinaryFixtureFile` for a file
+    # in the binary format
+    from fixture_format import BinaryFixtureFile, is_binary
+
+    if is_binary(path):
+        return BinaryFixtureFile(path)
+    return FixtureFile(path)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python3 fixtures.py FILE")
+        sys.exit(2)
+    with open_fixtures(sys.argv[1]) as fixtures:
+        for i, fixture in enumerate(fixtures):
+            print(f"{i + 1:5}  {fixture.name}")
+
+
+if __name__ == '__main__':
+    main()
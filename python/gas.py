@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Gas schedule
+#
+# Costs follow the Istanbul fork (EIP-1884 repricing), without refunds and
+# without the EIP-2200 net SSTORE metering: setting a zero slot to non-zero
+# costs SSTORE_SET, any other write SSTORE_RESET.
+#
+# Gas is split in two parts:
+#
+# - The static cost of every opcode (`STATIC_GAS`), which only depends on the
+#   opcode. The engines charge it themselves: the table engine per
+#   instruction, the basic-block engine once per block for the whole block.
+# - Dynamic costs (memory expansion, EXP exponent bytes, SHA3 and copy words,
+#   LOG data, SSTORE, calls, ...), charged by the handlers with the helpers
+#   below.
+
+MAX_UINT256 = 2**256 - 1
+
+# Gas given to an execution whose transaction does not set `gas`: large
+# enough that it never runs out, except on memory past `MAX_MEMORY`
+UNMETERED = MAX_UINT256
+
+# Memory never grows past this many bytes: expanding to it alone costs over
+# 2**31 gas, far above any block gas limit, so going further is out of gas,
+# even unmetered (instead of allocating gigabytes, or failing in Python)
+MAX_MEMORY = 2**25
+
+MEMORY_WORD = 3
+MEMORY_QUAD_DIVISOR = 512
+COPY_WORD = 3
+SHA3_WORD = 6
+EXP_BYTE = 50
+LOG_DATA_BYTE = 8
+SSTORE_SET = 20000
+SSTORE_RESET = 5000
+CALL_VALUE = 9000
+CALL_STIPEND = 2300
+NEW_ACCOUNT = 25000
+CODE_DEPOSIT_BYTE = 200
+SELFDESTRUCT_NEW_ACCOUNT = 25000
+
+
+class OutOfGas(Exception):
+    pass
+
+
+def build_static_gas():
+    static_gas = [0] * 256
+    for op, cost in {
+        0x00: 0,      # STOP
+        0x01: 3,      # ADD
+        0x02: 5,      # MUL
+        0x03: 3,      # SUB
+        0x04: 5,      # DIV
+        0x05: 5,      # SDIV
+        0x06: 5,      # MOD
+        0x07: 5,      # SMOD
+        0x08: 8,      # ADDMOD
+        0x09: 8,      # MULMOD
+        0x0a: 10,     # EXP
+        0x0b: 5,      # SIGNEXTEND
+        0x10: 3,      # LT
+        0x11: 3,      # GT
+        0x12: 3,      # SLT
+        0x13: 3,      # SGT
+        0x14: 3,      # EQ
+        0x15: 3,      # ISZERO
+        0x16: 3,      # AND
+        0x17: 3,      # OR
+        0x18: 3,      # XOR
+        0x19: 3,      # NOT
+        0x1a: 3,      # BYTE
+        0x1b: 3,      # SHL
+        0x1c: 3,      # SHR
+        0x1d: 3,      # SAR
+        0x20: 30,     # SHA3
+        0x30: 2,      # ADDRESS
+        0x31: 700,    # BALANCE
+        0x32: 2,      # ORIGIN
+        0x33: 2,      # CALLER
+        0x34: 2,      # CALLVALUE
+        0x35: 3,      # CALLDATALOAD
+        0x36: 2,      # CALLDATASIZE
+        0x37: 3,      # CALLDATACOPY
+        0x38: 2,      # CODESIZE
+        0x39: 3,      # CODECOPY
+        0x3a: 2,      # GASPRICE
+        0x3b: 700,    # EXTCODESIZE
+        0x3c: 700,    # EXTCODECOPY
+        0x3d: 2,      # RETURNDATASIZE
+        0x3e: 3,      # RETURNDATACOPY
+        0x3f: 700,    # EXTCODEHASH
+        0x40: 20,     # BLOCKHASH
+        0x41: 2,      # COINBASE
+        0x42: 2,      # TIMESTAMP
+        0x43: 2,      # NUMBER
+        0x44: 2,      # DIFFICULTY
+        0x45: 2,      # GASLIMIT
+        0x46: 2,      # CHAINID
+        0x47: 5,      # SELFBALANCE
+        0x48: 2,      # BASEFEE
+        0x50: 2,      # POP
+        0x51: 3,      # MLOAD
+        0x52: 3,      # MSTORE
+        0x53: 3,      # MSTORE8
+        0x54: 800,    # SLOAD
+        0x55: 0,      # SSTORE (dynamic)
+        0x56: 8,      # JUMP
+        0x57: 10,     # JUMPI
+        0x58: 2,      # PC
+        0x59: 2,      # MSIZE
+        0x5a: 2,      # GAS
+        0x5b: 1,      # JUMPDEST
+        0x5f: 2,      # PUSH0
+        0xf0: 32000,  # CREATE
+        0xf1: 700,    # CALL
+        0xf3: 0,      # RETURN
+        0xf4: 700,    # DELEGATECALL
+        0xfa: 700,    # STATICCALL
+        0xfd: 0,      # REVERT
+        0xfe: 0,      # INVALID
+        0xff: 5000,   # SELFDESTRUCT
+    }.items():
+        static_gas[op] = cost
+    for i in range(32):
+        static_gas[0x60 + i] = 3  # PUSH1 - PUSH32
+    for i in range(16):
+        static_gas[0x80 + i] = 3  # DUP1 - DUP16
+        static_gas[0x90 + i] = 3  # SWAP1 - SWAP16
+    for i in range(5):
+        static_gas[0xa0 + i] = 375 + 375 * i  # LOG0 - LOG4
+    return static_gas
+
+
+STATIC_GAS = build_static_gas()
+
+
+def words(byte_size):
+    return (byte_size + 31) // 32
+
+
+def memory_cost(byte_size):
+    n = words(byte_size)
+    return MEMORY_WORD * n + n * n // MEMORY_QUAD_DIVISOR
+
+
+def memory_expansion_cost(current_size, byte_offset, byte_size):
+    # Cost of growing memory from `current_size` bytes so that it covers
+    # [byte_offset, byte_offset + byte_size)
+    if byte_size == 0:
+        return 0
+    end = byte_offset + byte_size
+    if end <= current_size:
+        return 0
+    if end > MAX_MEMORY:
+        raise OutOfGas
+    return memory_cost(end) - memory_cost(current_size)
+
+
+def exp_cost(exponent):
+    return EXP_BYTE * ((exponent.bit_length() + 7) // 8)
+
+
+def all_but_one_64th(gas):
+    # EIP-150: a call can forward at most 63/64 of the remaining gas
+    return gas - gas // 64
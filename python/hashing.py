@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Keccak hashing
+#
+# All hashing of EVM data goes through here:
+#
+# - `keccak256(data)` hashes bytes or a `memoryview` of memory directly,
+#   without copying it into a bytes object (eth_hash's `keccak()` only takes
+#   bytes, `keccak.hasher` is the backend function behind it)
+# - SHA3 over exactly 32 or 64 bytes goes through a small LRU of recent
+#   preimages: Solidity computes the slot of `mapping[key]` as
+#   keccak256(key . slot), so contracts hash the same 64-byte preimages over
+#   and over
+#
+# Code hashes are cached separately: by `CodeCache` (see `analysis.py`) for
+# any piece of code, and on every `Account` through its analysis.
+#
+# `preimage_cache.hits` / `.misses` count lookups; `instrument.CacheStats`
+# reports them per execution.
+
+from collections import OrderedDict
+
+from eth_hash.auto import keccak
+
+DEFAULT_PREIMAGE_CACHE_SIZE = 4096
+
+# Preimage sizes worth caching: one word (a hashed key) or two (key and slot)
+CACHED_SIZES = (32, 64)
+
+# eth_hash picks its backend on the first call, replacing `keccak.hasher`:
+# hash once so the one captured here is the backend itself
+keccak(b'')
+hasher = keccak.hasher
+
+
+def keccak256(data):
+    return hasher(data)
+
+
+class PreimageCache:
+    def __init__(self, maxsize=DEFAULT_PREIMAGE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, data):
+        # keccak256 of `data` as an int
+        key = bytes(data)
+        entries = self.entries
+        digest = entries.get(key)
+        if digest is not None:
+            self.hits += 1
+            entries.move_to_end(key)
+            return digest
+        self.misses += 1
+        digest = int.from_bytes(hasher(key), 'big')
+        entries[key] = digest
+        if len(entries) > self.maxsize:
+            entries.popitem(last=False)
+        return digest
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# Shared by every execution in the process
+preimage_cache = PreimageCache()
+
+
+def keccak_int(data):
+    # keccak256 of `data` (bytes or a view) as an int, what SHA3 pushes
+    if len(data) in CACHED_SIZES:
+        return preimage_cache.lookup(data)
+    return int.from_bytes(hasher(data), 'big')
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Instrumentation
+#
+# The engines have no hooks: checking `if tracing` on every step would slow
+# down every execution, traced or not. Instead, tracing uses its own engine,
+# `traced_engine(tracer)`, a copy of the table engine loop that calls the
+# tracer around every instruction. Executions that don't ask for it never
+# run this code.
+#
+# A tracer is any object with the methods of `Tracer`. The ones below record:
+#
+# - `OpcodeProfile`: count and cumulative time per opcode (the time of CALL
+#   and CREATE includes the sub-context they run)
+# - `PcHistogram`: how often every pc runs, per contract address
+# - `CallTimeline`: when every call frame starts and ends, and at which depth
+# - `JsonTrace`: an EIP-3155 style JSON line per step
+# - `CacheStats`: hits and misses of the keccak preimage cache and the code
+#   analysis cache during the execution
+# - `SequenceProfile`: how often every short sequence of opcodes runs back to
+#   back, which `superinstructions.py` picks its fused instructions from
+#
+# `Tracers` runs several tracers at once. `trace()` is `evm()` with tracers:
+#
+#     profile = OpcodeProfile()
+#     trace(code, tx, block, state, [profile, JsonTrace(sys.stderr)])
+#     profile.report()
+#
+# - Run `python3 instrument.py <code hex>` to profile a piece of bytecode, and
+#   `python3 instrument.py <code hex> --trace trace.jsonl` to also trace it
+#   (streamed, see `trace_stream.py`; `--every N` / `--boundaries` to sample)
+
+import argparse
+import json
+import sys
+import time
+from collections import Counter
+
+from analysis import code_cache
+from gas import STATIC_GAS, OutOfGas
+from hashing import preimage_cache
+from interpreter import FAILURES, HANDLERS, Halt, SubCall, fail, resume, run
+from model import format_address
+
+
+def build_opcode_names():
+    # The mnemonic of every opcode, from the names of the handlers
+    names = []
+    for op, handler in enumerate(HANDLERS):
+        name = handler.__name__[len('op_'):].upper()
+        if name == 'PUSH' or name == 'DUP' or name == 'SWAP' or name == 'LOG':
+            first = {'PUSH': 0x5f, 'DUP': 0x7f, 'SWAP': 0x8f, 'LOG': 0xa0}[name]
+            name += str(op - first)
+        names.append(name)
+    return names
+
+
+OPCODE_NAMES = build_opcode_names()
+
+
+class Tracer:
+    # Does nothing; subclasses override the hooks they need. `depth` is 1 for
+    # the outermost frame.
+
+    def begin(self):
+        # `trace()` is about to set up the execution (and look up its code)
+        pass
+
+    def enter(self, f, depth):
+        # A frame starts running
+        pass
+
+    def step(self, f, op, depth):
+        # Before the instruction at `f.pc` runs, before its gas is charged
+        pass
+
+    def stepped(self, f, op, depth, elapsed):
+        # After the instruction ran (or raised), `elapsed` in seconds
+        pass
+
+    def exit(self, f, depth):
+        # A frame finished, `f.success` and `f.ret` are final
+        pass
+
+
+class Tracers(Tracer):
+    def __init__(self, tracers):
+        self.tracers = list(tracers)
+
+    def begin(self):
+        for tracer in self.tracers:
+            tracer.begin()
+
+    def enter(self, f, depth):
+        for tracer in self.tracers:
+            tracer.enter(f, depth)
+
+    def step(self, f, op, depth):
+        for tracer in self.tracers:
+            tracer.step(f, op, depth)
+
+    def stepped(self, f, op, depth, elapsed):
+        for tracer in self.tracers:
+            tracer.stepped(f, op, depth, elapsed)
+
+    def exit(self, f, depth):
+        for tracer in self.tracers:
+            tracer.exit(f, depth)
+
+
+class OpcodeProfile(Tracer):
+    def __init__(self):
+        self.counts = [0] * 256
+        self.times = [0.0] * 256
+
+    def stepped(self, f, op, depth, elapsed):
+        self.counts[op] += 1
+        self.times[op] += elapsed
+
+    def report(self, out=sys.stdout, top=None):
+        rows = sorted((op for op in range(256) if self.counts[op]), key=lambda op: -self.times[op])
+        total = sum(self.times) or 1
+        print(f"{'opcode':>14} {'count':>10} {'total ms':>10} {'ns/op':>8} {'share':>6}", file=out)
+        for op in rows[:top]:
+            count, elapsed = self.counts[op], self.times[op]
+            print(f"{OPCODE_NAMES[op]:>14} {count:>10,} {elapsed * 1000:>10.2f} "
+                  f"{elapsed * 1e9 / count:>8.0f} {elapsed / total:>6.1%}", file=out)
+
+
+class PcHistogram(Tracer):
+    def __init__(self):
+        # contract address -> Counter of pc
+        self.contracts = {}
+
+    def step(self, f, op, depth):
+        counts = self.contracts.get(f.address)
+        if counts is None:
+            counts = self.contracts[f.address] = Counter()
+        counts[f.pc] += 1
+
+    def hot(self, address, n=10):
+        # The `n` most executed (pc, count) in `address`
+        return self.contracts.get(address, Counter()).most_common(n)
+
+    def report(self, out=sys.stdout, top=10):
+        busiest = sorted(self.contracts.items(), key=lambda item: -sum(item[1].values()))
+        for address, counts in busiest:
+            print(f"{format_address(address)}: {sum(counts.values()):,} steps", file=out)
+            for pc, count in counts.most_common(top):
+                print(f"  pc {pc:>6}: {count:,}", file=out)
+
+
+class CallTimeline(Tracer):
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.start = clock()
+        # (seconds since start, depth, 'enter' / 'exit', address, success)
+        self.events = []
+
+    def enter(self, f, depth):
+        self.events.append((self.clock() - self.start, depth, 'enter', f.address, None))
+
+    def exit(self, f, depth):
+        self.events.append((self.clock() - self.start, depth, 'exit', f.address, f.success))
+
+    def report(self, out=sys.stdout):
+        for elapsed, depth, event, address, success in self.events:
+            status = '' if success is None else (' ok' if success else ' failed')
+            print(f"{elapsed * 1000:>10.3f} ms {'  ' * (depth - 1)}{event} {format_address(address)}{status}", file=out)
+
+
+class CacheStats(Tracer):
+    # Counters of the process-wide caches, as differences between the start
+    # of the execution (before its code is looked up) and the end of the
+    # outermost frame
+
+    CACHES = {'keccak preimages': preimage_cache, 'code analysis': code_cache}
+
+    def __init__(self):
+        self.start = {}
+        # name -> (hits, misses)
+        self.counts = {}
+
+    def begin(self):
+        self.start = {name: (cache.hits, cache.misses) for name, cache in self.CACHES.items()}
+
+    def exit(self, f, depth):
+        if depth == 1:
+            for name, cache in self.CACHES.items():
+                hits, misses = self.start[name]
+                self.counts[name] = (cache.hits - hits, cache.misses - misses)
+
+    def hit_rate(self, name):
+        hits, misses = self.counts.get(name, (0, 0))
+        return hits / (hits + misses) if hits + misses else None
+
+    def report(self, out=sys.stdout):
+        for name, (hits, misses) in self.counts.items():
+            rate = self.hit_rate(name)
+            rate = f"{rate:.1%}" if rate is not None else "-"
+            print(f"{name:>16}: {hits:,} hits, {misses:,} misses, hit rate {rate}", file=out)
+
+
+class SequenceProfile(Tracer):
+    # Counts every sequence of 2 to `length` opcodes that ran one after the
+    # other in the same frame, without a jump in between
+
+    def __init__(self, length=3):
+        self.length = length
+        self.steps = 0
+        # (opcode, ...) -> count
+        self.counts = Counter()
+        # depth -> (the last opcodes run in a row, pc that continues the run)
+        self.runs = {}
+
+    def enter(self, f, depth):
+        self.runs[depth] = ((), None)
+
+    def step(self, f, op, depth):
+        self.steps += 1
+        run, next_pc = self.runs[depth]
+        run = (run + (op,))[-self.length:] if f.pc == next_pc else (op,)
+        for n in range(2, len(run) + 1):
+            self.counts[run[-n:]] += 1
+        self.runs[depth] = (run, f.pc + 1 + (op - 0x5f if 0x60 <= op <= 0x7f else 0))
+
+    def report(self, out=sys.stdout, top=20):
+        print(f"{'sequence':>32} {'count':>10} {'of steps':>8}", file=out)
+        for ops, count in self.counts.most_common(top):
+            names = ' '.join(OPCODE_NAMES[op] for op in ops)
+            print(f"{names:>32} {count:>10,} {count / (self.steps or 1):>8.1%}", file=out)
+
+
+def step_record(f, op, depth, stack_items=None):
+    # EIP-3155 step object. `stack_items` limits the stack to its top items
+    # (all if None). The gas cost of a step is its static cost: dynamic costs
+    # are only known after the step, and the record is made before it runs.
+    stack = f.stack if stack_items is None else f.stack[-stack_items:]
+    return {
+        "pc": f.pc,
+        "op": op,
+        "gas": hex(f.gas),
+        "gasCost": hex(STATIC_GAS[op]),
+        "stack": [hex(value) for value in stack],
+        "depth": depth,
+        "memSize": len(f.memory),
+        "opName": OPCODE_NAMES[op],
+    }
+
+
+def summary_record(f):
+    # EIP-3155 summary of the outermost frame
+    summary = {"output": f.ret.hex() if f.ret is not None else "", "pass": f.success}
+    if f.metered:
+        summary["gasUsed"] = hex(f.tx.gas - f.gas)
+    return summary
+
+
+class JsonTrace(Tracer):
+    # EIP-3155: one JSON line per step, then a summary of the outermost
+    # frame, written to the text file `out`. See `trace_stream.py` for long
+    # executions.
+
+    def __init__(self, out, stack_items=None):
+        self.out = out
+        self.stack_items = stack_items
+
+    def step(self, f, op, depth):
+        self.out.write(json.dumps(step_record(f, op, depth, self.stack_items)) + "\n")
+
+    def exit(self, f, depth):
+        if depth == 1:
+            self.out.write(json.dumps(summary_record(f)) + "\n")
+
+
+def traced_engine(tracer):
+    # The table engine of `interpreter.py` with `tracer` hooks, sub-frames
+    # included. `depth` is the frame's depth + 1.
+    handlers = HANDLERS
+    static_gas = STATIC_GAS
+    clock = time.perf_counter
+
+    def run_traced(f, suspended):
+        # `run_frame` with hooks. An instruction that starts a sub-call is
+        # timed until the sub-call returns: its (op, start) waits in
+        # `suspended` until then.
+        depth = f.depth + 1
+        code = f.code
+        n = len(code)
+        try:
+            while f.pc < n:
+                op = code[f.pc]
+                tracer.step(f, op, depth)
+                start = clock()
+                try:
+                    gas = f.gas - static_gas[op]
+                    if gas < 0:
+                        raise OutOfGas
+                    f.gas = gas
+                    f.pc += 1
+                    handlers[op](f)
+                except SubCall:
+                    suspended.append((op, start))
+                    raise
+                except Exception:
+                    tracer.stepped(f, op, depth, clock() - start)
+                    raise
+                tracer.stepped(f, op, depth, clock() - start)
+        except Halt:
+            pass
+        except FAILURES:
+            fail(f)
+        except SubCall as call:
+            return call.child
+        return None
+
+    def execute_traced(f):
+        # `run_frames` with hooks
+        frames = [f]
+        suspended = []
+        tracer.enter(f, f.depth + 1)
+        while frames:
+            child = run_traced(frames[-1], suspended)
+            if child is not None:
+                frames.append(child)
+                tracer.enter(child, child.depth + 1)
+                continue
+            child = frames.pop()
+            tracer.exit(child, child.depth + 1)
+            if frames:
+                parent = frames[-1]
+                resume(parent, child)
+                op, start = suspended.pop()
+                tracer.stepped(parent, op, parent.depth + 1, clock() - start)
+        return f
+
+    return execute_traced
+
+
+def trace(code, tx, block, state, tracers, static_mode=False):
+    # Same arguments and result as `evm()`, plus a list of tracers
+    tracer = Tracers(tracers)
+    tracer.begin()
+    return run(traced_engine(tracer), code, tx, block, state, static_mode)
+
+
+def positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Profile or trace a piece of bytecode")
+    parser.add_argument('code', help="bytecode in hex")
+    parser.add_argument('--trace', help="write an EIP-3155 trace to this file ('-' for stdout, .gz/.xz to compress)")
+    parser.add_argument('--every', type=positive_int, default=1, help="only trace every Nth step")
+    parser.add_argument('--boundaries', action='store_true', help="only trace steps that enter or leave a frame")
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    profile = OpcodeProfile()
+    pcs = PcHistogram()
+    timeline = CallTimeline()
+    caches = CacheStats()
+    tracers = [profile, pcs, timeline, caches]
+    out = None
+    if args.trace:
+        # Imported here: `trace_stream` builds on this module
+        from trace_stream import StreamingTrace, open_trace
+        out = open_trace(args.trace)
+        tracers.append(StreamingTrace(out, args.every, args.boundaries))
+    try:
+        success, stack, logs, ret, gas_used = trace(bytes.fromhex(args.code), {}, {}, {}, tracers)
+    finally:
+        if out is not None and out is not sys.stdout.buffer:
+            out.close()
+    print(f"success: {success}, return: {ret}")
+    profile.report(top=args.top)
+    pcs.report(top=args.top)
+    timeline.report()
+    caches.report()
+
+
+if __name__ == '__main__':
+    main()
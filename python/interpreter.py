@@ -0,0 +1,1084 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Dispatch-table interpreter
+#
+# Every opcode is handled by its own small function. The functions are
+# collected once at import time into a 256-entry table, so executing an
+# instruction is a single list index plus a call, instead of walking the
+# long if/elif chain in `evm.py`.
+#
+# All handlers share one `Frame` object that holds the execution context
+# (code, pc, stack, memory, ...). The stack is a `Stack` (see `stack.py`)
+# with the top at the end, so pushes and pops are O(1). It is converted back
+# to the top-first list `test()` expects when the frame finishes. Memory is a
+# `Memory` (see `memory.py`) backed by a single bytearray.
+#
+# The JSON `tx`, `block` and `state` are decoded once, before execution, into
+# the typed objects of `model.py`, and results are converted back to JSON at
+# the end: handlers only see ints and bytes.
+#
+# State lives in a `WorldState` (see `world_state.py`): every CALL and CREATE
+# takes a snapshot and reverts to it when the sub-context fails.
+#
+# Sub-contexts don't recurse into the engine. CALL, CREATE, ... prepare a
+# child frame, leave what is left of their work in `f.resume` and raise
+# `SubCall`. `run_frames` keeps the frames on an explicit stack: it runs the
+# child, then hands its result back to the caller with `resume()`, and the
+# caller carries on from the next instruction. Depth is limited by
+# CALL_DEPTH_LIMIT, not by Python's recursion limit, and finished frames go
+# back to a pool for the next call to reuse.
+#
+# Gas: the loop charges the static cost of each opcode, handlers charge the
+# dynamic part (see `gas.py`). Executions whose transaction has no `gas` get
+# `UNMETERED` gas and GAS reports MAX_UINT256, like the `evm.json` tests
+# expect.
+
+from analysis import EMPTY, code_cache
+from gas import (
+    CALL_STIPEND,
+    CALL_VALUE,
+    CODE_DEPOSIT_BYTE,
+    COPY_WORD,
+    LOG_DATA_BYTE,
+    NEW_ACCOUNT,
+    SELFDESTRUCT_NEW_ACCOUNT,
+    SHA3_WORD,
+    SSTORE_RESET,
+    SSTORE_SET,
+    STATIC_GAS,
+    UNMETERED,
+    OutOfGas,
+    all_but_one_64th,
+    exp_cost,
+    memory_expansion_cost,
+    words,
+)
+from hashing import keccak_int
+from memory import Memory
+from model import BlockEnv, Message, format_address
+from stack import Stack, StackOverflow
+from uint256 import MAX_UINT256, sar, sdiv, signextend, smod, to_signed
+from world_state import WorldState, create_address
+
+ADDRESS_MASK = 2**160 - 1
+
+# A frame at this depth (the outermost one is at 0) cannot call any deeper
+CALL_DEPTH_LIMIT = 1024
+
+# At most this many finished frames are kept for reuse
+FRAME_POOL_SIZE = 64
+
+
+class Halt(Exception):
+    # Raised by STOP, RETURN, REVERT and SELFDESTRUCT to leave the loop
+    pass
+
+
+class EVMError(Exception):
+    # Raised on exceptional halts (bad jump, static violation, ...)
+    pass
+
+
+class SubCall(Exception):
+    # Raised by CALL, CREATE, ... for the engine to run `child` before the
+    # caller goes on
+    def __init__(self, child):
+        self.child = child
+
+
+# Everything that makes an execution fail. IndexError comes from popping an
+# empty stack (underflow).
+FAILURES = (EVMError, StackOverflow, OutOfGas, IndexError)
+
+
+class Frame:
+    __slots__ = (
+        'code', 'analysis', 'pc', 'stack', 'memory', 'tx', 'block', 'world',
+        'static_mode', 'calldata', 'address', 'logs', 'ret', 'returndata',
+        'success', 'gas', 'metered', 'depth', 'resume',
+    )
+
+    def __init__(self, analysis, tx, block, world, static_mode=False, gas=None, depth=0):
+        self.stack = Stack()
+        self.memory = Memory()
+        self.setup(analysis, tx, block, world, static_mode, gas, depth)
+
+    def setup(self, analysis, tx, block, world, static_mode, gas, depth):
+        # Everything but the stack and memory, which start (or were left) empty
+        self.code = analysis.code
+        self.analysis = analysis
+        self.pc = 0
+        # `Message` and `BlockEnv`
+        self.tx = tx
+        self.block = block
+        self.world = world
+        self.static_mode = static_mode
+        self.calldata = tx.data
+        self.address = tx.to
+        # (address, data, topics) tuples, see `log_to_json`
+        self.logs = []
+        self.ret = None
+        self.returndata = b''
+        self.success = True
+        self.metered = gas is not None
+        self.gas = gas if gas is not None else UNMETERED
+        self.depth = depth
+        # (function, args) finishing the instruction that started a sub-call
+        self.resume = None
+
+
+# Finished sub-frames, see `new_frame` and `release_frame`
+frame_pool = []
+
+
+def new_frame(analysis, tx, block, world, static_mode, gas, depth):
+    if frame_pool:
+        f = frame_pool.pop()
+        f.setup(analysis, tx, block, world, static_mode, gas, depth)
+        return f
+    return Frame(analysis, tx, block, world, static_mode, gas, depth)
+
+
+def release_frame(f):
+    # `resume()` has copied out everything the caller needs from `f`
+    if len(frame_pool) < FRAME_POOL_SIZE:
+        f.stack.clear()
+        # `ret` may be a view of memory, which would keep `clear()` from
+        # reusing the buffer
+        f.ret = None
+        f.memory.clear()
+        f.tx = f.world = f.analysis = f.code = None
+        frame_pool.append(f)
+
+
+def copy_padded(src, byte_offset, byte_size):
+    data = src[byte_offset:byte_offset + byte_size]
+    if len(data) < byte_size:
+        data = bytes(data) + bytes(byte_size - len(data))
+    return data
+
+
+def charge(f, amount):
+    gas = f.gas - amount
+    if gas < 0:
+        raise OutOfGas
+    f.gas = gas
+
+
+def use_memory(f, byte_offset, byte_size):
+    # Pay for and perform the expansion before a handler touches memory
+    if byte_size and byte_offset + byte_size > len(f.memory):
+        charge(f, memory_expansion_cost(len(f.memory), byte_offset, byte_size))
+        f.memory.extend(byte_offset, byte_size)
+
+
+def get_analysis(f, address):
+    account = f.world.get_account(address)
+    if account is None or not account.code:
+        return EMPTY
+    if account.analysis is None:
+        account.analysis = code_cache.lookup(account.code)
+    return account.analysis
+
+
+def send_value(f, recipient, value):
+    # The `evm.json` fixtures send value from accounts that are not in the
+    # state at all; for those the value is minted instead of debited
+    if f.world.exists(f.address):
+        return f.world.transfer(f.address, recipient, value)
+    if value:
+        f.world.set_balance(recipient, f.world.get_balance(recipient) + value)
+    return True
+
+
+# STOP
+def op_stop(f):
+    raise Halt
+
+
+# ADD (overflow)
+def op_add(f):
+    s = f.stack
+    s.append((s.pop() + s.pop()) & MAX_UINT256)
+
+
+# MUL (overflow)
+def op_mul(f):
+    s = f.stack
+    s.append((s.pop() * s.pop()) & MAX_UINT256)
+
+
+# SUB (overflow)
+def op_sub(f):
+    s = f.stack
+    a = s.pop()
+    s.append((a - s.pop()) & MAX_UINT256)
+
+
+# DIV (whole) (by zero)
+def op_div(f):
+    s = f.stack
+    a = s.pop()
+    b = s.pop()
+    s.append(a // b if b else 0)
+
+
+# SDIV (negative) (mix of negative and positive) (by zero)
+def op_sdiv(f):
+    s = f.stack
+    a = s.pop()
+    s.append(sdiv(a, s.pop()))
+
+
+# MOD (by larger number) (by zero)
+def op_mod(f):
+    s = f.stack
+    a = s.pop()
+    b = s.pop()
+    s.append(a % b if b else 0)
+
+
+# SMOD (negative) (by zero)
+def op_smod(f):
+    s = f.stack
+    a = s.pop()
+    s.append(smod(a, s.pop()))
+
+
+# ADDMOD (wrapped)
+def op_addmod(f):
+    s = f.stack
+    a = s.pop()
+    b = s.pop()
+    n = s.pop()
+    s.append((a + b) % n if n else 0)
+
+
+# MULMOD (wrapped)
+def op_mulmod(f):
+    s = f.stack
+    a = s.pop()
+    b = s.pop()
+    n = s.pop()
+    s.append((a * b) % n if n else 0)
+
+
+# EXP
+def op_exp(f):
+    s = f.stack
+    a = s.pop()
+    exponent = s.pop()
+    charge(f, exp_cost(exponent))
+    s.append(pow(a, exponent, MAX_UINT256 + 1))
+
+
+# SIGNEXTEND (positive) (negative)
+def op_signextend(f):
+    s = f.stack
+    b = s.pop()
+    s.append(signextend(b, s.pop()))
+
+
+# LT (equal) (greater)
+def op_lt(f):
+    s = f.stack
+    a = s.pop()
+    s.append(1 if a < s.pop() else 0)
+
+
+# GT (equal) (less)
+def op_gt(f):
+    s = f.stack
+    a = s.pop()
+    s.append(1 if a > s.pop() else 0)
+
+
+# SLT (equal) (less)
+def op_slt(f):
+    s = f.stack
+    a = to_signed(s.pop())
+    s.append(1 if a < to_signed(s.pop()) else 0)
+
+
+# SGT (equal) (greater)
+def op_sgt(f):
+    s = f.stack
+    a = to_signed(s.pop())
+    s.append(1 if a > to_signed(s.pop()) else 0)
+
+
+# EQ (not equal)
+def op_eq(f):
+    s = f.stack
+    s.append(1 if s.pop() == s.pop() else 0)
+
+
+# ISZERO (not zero) (zero)
+def op_iszero(f):
+    s = f.stack
+    s.append(1 if s.pop() == 0 else 0)
+
+
+# AND
+def op_and(f):
+    s = f.stack
+    s.append(s.pop() & s.pop())
+
+
+# OR
+def op_or(f):
+    s = f.stack
+    s.append(s.pop() | s.pop())
+
+
+# XOR
+def op_xor(f):
+    s = f.stack
+    s.append(s.pop() ^ s.pop())
+
+
+# NOT
+def op_not(f):
+    s = f.stack
+    s.append(MAX_UINT256 ^ s.pop())
+
+
+# BYTE (out of range)
+def op_byte(f):
+    s = f.stack
+    byte_offset = s.pop()
+    num = s.pop()
+    s.append((num >> ((31 - byte_offset) * 8)) & 0xff if byte_offset < 32 else 0)
+
+
+# SHL (discards) (too large)
+def op_shl(f):
+    s = f.stack
+    shift = s.pop()
+    num = s.pop()
+    s.append((num << shift) & MAX_UINT256 if shift < 256 else 0)
+
+
+# SHR (discards) (too large)
+def op_shr(f):
+    s = f.stack
+    shift = s.pop()
+    num = s.pop()
+    s.append(num >> shift if shift < 256 else 0)
+
+
+# SAR (fills 1s) (too large) (positive, too large)
+def op_sar(f):
+    s = f.stack
+    shift = s.pop()
+    s.append(sar(shift, s.pop()))
+
+
+# SHA3
+def op_sha3(f):
+    s = f.stack
+    byte_offset = s.pop()
+    byte_size = s.pop()
+    use_memory(f, byte_offset, byte_size)
+    charge(f, SHA3_WORD * words(byte_size))
+    data = f.memory.view(byte_offset, byte_size)
+    s.append(keccak_int(data))
+    data.release()
+
+
+# ADDRESS
+def op_address(f):
+    f.stack.push(f.address)
+
+
+# BALANCE
+def op_balance(f):
+    s = f.stack
+    s.append(f.world.get_balance(s.pop() & ADDRESS_MASK))
+
+
+# ORIGIN
+def op_origin(f):
+    f.stack.push(f.tx.origin)
+
+
+# CALLER
+def op_caller(f):
+    f.stack.push(f.tx.caller)
+
+
+# CALLVALUE
+def op_callvalue(f):
+    f.stack.push(f.tx.value)
+
+
+# CALLDATALOAD (tail)
+def op_calldataload(f):
+    s = f.stack
+    s.append(int.from_bytes(copy_padded(f.calldata, s.pop(), 32), 'big'))
+
+
+# CALLDATASIZE
+def op_calldatasize(f):
+    f.stack.push(len(f.calldata))
+
+
+# CALLDATACOPY (tail)
+def op_calldatacopy(f):
+    s = f.stack
+    dest_offset = s.pop()
+    byte_offset = s.pop()
+    byte_size = s.pop()
+    use_memory(f, dest_offset, byte_size)
+    charge(f, COPY_WORD * words(byte_size))
+    f.memory.copy_from(dest_offset, f.calldata, byte_offset, byte_size)
+
+
+# CODESIZE (small)
+def op_codesize(f):
+    f.stack.push(len(f.code))
+
+
+# CODECOPY
+def op_codecopy(f):
+    s = f.stack
+    dest_offset = s.pop()
+    byte_offset = s.pop()
+    byte_size = s.pop()
+    use_memory(f, dest_offset, byte_size)
+    charge(f, COPY_WORD * words(byte_size))
+    f.memory.copy_from(dest_offset, f.code, byte_offset, byte_size)
+
+
+# GASPRICE
+def op_gasprice(f):
+    f.stack.push(f.tx.gasprice)
+
+
+# EXTCODESIZE
+def op_extcodesize(f):
+    s = f.stack
+    s.append(len(f.world.get_code(s.pop() & ADDRESS_MASK)))
+
+
+# EXTCODECOPY
+def op_extcodecopy(f):
+    s = f.stack
+    address = s.pop() & ADDRESS_MASK
+    dest_offset = s.pop()
+    byte_offset = s.pop()
+    byte_size = s.pop()
+    use_memory(f, dest_offset, byte_size)
+    charge(f, COPY_WORD * words(byte_size))
+    f.memory.copy_from(dest_offset, f.world.get_code(address), byte_offset, byte_size)
+
+
+# RETURNDATASIZE
+def op_returndatasize(f):
+    f.stack.push(len(f.returndata))
+
+
+# RETURNDATACOPY
+def op_returndatacopy(f):
+    s = f.stack
+    dest_offset = s.pop()
+    byte_offset = s.pop()
+    byte_size = s.pop()
+    if byte_offset + byte_size > len(f.returndata):
+        raise EVMError('return data out of bounds')
+    use_memory(f, dest_offset, byte_size)
+    charge(f, COPY_WORD * words(byte_size))
+    f.memory.copy_from(dest_offset, f.returndata, byte_offset, byte_size)
+
+
+# EXTCODEHASH
+def op_extcodehash(f):
+    s = f.stack
+    address = s.pop() & ADDRESS_MASK
+    if not f.world.exists(address):
+        s.append(0)
+    else:
+        s.append(int.from_bytes(get_analysis(f, address).code_hash, 'big'))
+
+
+# BLOCKHASH
+def op_blockhash(f):
+    s = f.stack
+    s.pop()
+    s.append(0)
+
+
+# COINBASE
+def op_coinbase(f):
+    f.stack.push(f.block.coinbase)
+
+
+# TIMESTAMP
+def op_timestamp(f):
+    f.stack.push(f.block.timestamp)
+
+
+# NUMBER
+def op_number(f):
+    f.stack.push(f.block.number)
+
+
+# DIFFICULTY
+def op_difficulty(f):
+    f.stack.push(f.block.difficulty)
+
+
+# GASLIMIT
+def op_gaslimit(f):
+    f.stack.push(f.block.gaslimit)
+
+
+# CHAINID
+def op_chainid(f):
+    f.stack.push(f.block.chainid)
+
+
+# SELFBALANCE
+def op_selfbalance(f):
+    f.stack.push(f.world.get_balance(f.address))
+
+
+# BASEFEE
+def op_basefee(f):
+    f.stack.push(f.block.basefee)
+
+
+# POP
+def op_pop(f):
+    f.stack.pop()
+
+
+# MLOAD
+def op_mload(f):
+    s = f.stack
+    byte_offset = s.pop()
+    use_memory(f, byte_offset, 32)
+    s.append(f.memory.load_word(byte_offset))
+
+
+# MSTORE
+def op_mstore(f):
+    s = f.stack
+    byte_offset = s.pop()
+    use_memory(f, byte_offset, 32)
+    f.memory.store_word(byte_offset, s.pop())
+
+
+# MSTORE8
+def op_mstore8(f):
+    s = f.stack
+    byte_offset = s.pop()
+    use_memory(f, byte_offset, 1)
+    f.memory.store_byte(byte_offset, s.pop())
+
+
+# SLOAD
+def op_sload(f):
+    s = f.stack
+    s.append(f.world.get_storage(f.address, s.pop()))
+
+
+# SSTORE
+def op_sstore(f):
+    if f.static_mode:
+        raise EVMError('SSTORE in static context')
+    s = f.stack
+    key = s.pop()
+    value = s.pop()
+    world = f.world
+    charge(f, SSTORE_SET if value and not world.get_storage(f.address, key) else SSTORE_RESET)
+    world.set_storage(f.address, key, value)
+
+
+# JUMP
+def op_jump(f):
+    counter = f.stack.pop()
+    if not f.analysis.is_jumpdest(counter):
+        raise EVMError('invalid jump destination')
+    f.pc = counter
+
+
+# JUMPI
+def op_jumpi(f):
+    s = f.stack
+    counter = s.pop()
+    if s.pop():
+        if not f.analysis.is_jumpdest(counter):
+            raise EVMError('invalid jump destination')
+        f.pc = counter
+
+
+# PC
+def op_pc(f):
+    f.stack.push(f.pc - 1)
+
+
+# MSIZE
+def op_msize(f):
+    f.stack.push(len(f.memory))
+
+
+# GAS
+def op_gas(f):
+    f.stack.push(f.gas if f.metered else MAX_UINT256)
+
+
+# JUMPDEST
+def op_jumpdest(f):
+    pass
+
+
+# PUSH0
+def op_push0(f):
+    f.stack.push(0)
+
+
+# PUSH1 - PUSH32
+def make_push(size):
+    def op_push(f):
+        pc = f.pc
+        data = f.code[pc:pc + size]
+        if len(data) < size:
+            data = data + bytes(size - len(data))
+        f.stack.push(int.from_bytes(data, 'big'))
+        f.pc = pc + size
+    return op_push
+
+
+# DUP1 - 16
+def make_dup(index):
+    def op_dup(f):
+        s = f.stack
+        s.push(s[-index])
+    return op_dup
+
+
+# SWAP1 - 16
+def make_swap(index):
+    def op_swap(f):
+        s = f.stack
+        s[-1], s[-index - 1] = s[-index - 1], s[-1]
+    return op_swap
+
+
+# LOG0 - 4
+def make_log(n_topics):
+    def op_log(f):
+        if f.static_mode:
+            raise EVMError('LOG in static context')
+        s = f.stack
+        byte_offset = s.pop()
+        byte_size = s.pop()
+        topics = tuple(s.pop() for _ in range(n_topics))
+        use_memory(f, byte_offset, byte_size)
+        charge(f, LOG_DATA_BYTE * byte_size)
+        f.logs.append((f.address, f.memory.read(byte_offset, byte_size), topics))
+    return op_log
+
+
+def run_frames(f, run_frame):
+    # Runs `f` and all its sub-frames. `run_frame(frame)` runs a frame until
+    # it finishes (and returns None) or starts a sub-call (and returns the
+    # child frame).
+    frames = [f]
+    while frames:
+        child = run_frame(frames[-1])
+        if child is not None:
+            frames.append(child)
+            continue
+        child = frames.pop()
+        if frames:
+            resume(frames[-1], child)
+    return f
+
+
+def resume(f, child):
+    # Finishes the instruction of `f` that started the sub-call `child`
+    finish, args = f.resume
+    f.resume = None
+    finish(f, child, *args)
+    release_frame(child)
+
+
+def start_call(f, child, finish, *args):
+    f.resume = (finish, args)
+    raise SubCall(child)
+
+
+def call_gas(f, requested):
+    # Gas handed to a sub-context: at most all but 1/64th of what is left
+    # (EIP-150). Unmetered frames have unmetered children.
+    if not f.metered:
+        return None
+    gas = min(requested, all_but_one_64th(f.gas))
+    charge(f, gas)
+    return gas
+
+
+def call_into(f, analysis, tx, static_mode, gas, ret_offset, ret_size, snapshot):
+    # Run a sub-context, `finish_call` copies its output back into the
+    # caller's memory. `snapshot` is taken by the caller before any value
+    # was sent.
+    if f.depth >= CALL_DEPTH_LIMIT:
+        # Too deep: fails without running, the caller keeps the gas
+        f.world.revert(snapshot)
+        if gas is not None:
+            f.gas += gas
+        f.returndata = b''
+        f.stack.append(0)
+        return
+    child = new_frame(analysis, tx, f.block, f.world, static_mode, gas, f.depth + 1)
+    start_call(f, child, finish_call, ret_offset, ret_size, snapshot)
+
+
+def finish_call(f, child, ret_offset, ret_size, snapshot):
+    if child.metered:
+        f.gas += child.gas
+    if child.success:
+        f.logs += child.logs
+    else:
+        f.world.revert(snapshot)
+    # A copy: `child.ret` is a view of memory the next call may reuse
+    f.returndata = bytes(child.ret) if child.ret is not None else b''
+    f.memory.write(ret_offset, f.returndata[:ret_size])
+    f.stack.append(int(child.success))
+
+
+# CREATE
+def op_create(f):
+    if f.static_mode:
+        raise EVMError('CREATE in static context')
+    s = f.stack
+    value = s.pop()
+    byte_offset = s.pop()
+    byte_size = s.pop()
+    use_memory(f, byte_offset, byte_size)
+    init_code = f.memory.read(byte_offset, byte_size)
+    world = f.world
+    sender = f.address
+    f.returndata = b''
+    if world.get_balance(sender) < value and world.exists(sender) or f.depth >= CALL_DEPTH_LIMIT:
+        s.append(0)
+        return
+    # Checked before the nonce bump below creates the sender account
+    minted = not world.exists(sender)
+    address = create_address(sender, world.get_nonce(sender))
+    world.increment_nonce(sender)
+    snapshot = world.snapshot()
+    world.create_account(address)
+    if minted:
+        world.set_balance(address, world.get_balance(address) + value)
+    else:
+        world.transfer(sender, address, value)
+    if init_code:
+        tx = Message(address, sender, f.tx.origin, value, f.tx.gasprice)
+        gas = call_gas(f, f.gas)
+        child = new_frame(code_cache.lookup(init_code), tx, f.block, world, False, gas, f.depth + 1)
+        start_call(f, child, finish_create, address, snapshot)
+    s.append(address)
+
+
+def finish_create(f, child, address, snapshot):
+    code = bytes(child.ret) if child.ret is not None else b''
+    if child.success:
+        try:
+            charge(child, CODE_DEPOSIT_BYTE * len(code))
+        except OutOfGas:
+            child.success = False
+            child.gas = 0
+    if child.metered:
+        f.gas += child.gas
+    if not child.success:
+        f.world.revert(snapshot)
+        f.returndata = code
+        f.stack.append(0)
+        return
+    f.logs += child.logs
+    if code:
+        f.world.set_code(address, code)
+    f.stack.append(address)
+
+
+# CALL
+def op_call(f):
+    s = f.stack
+    gas = s.pop()
+    address = s.pop() & ADDRESS_MASK
+    value = s.pop()
+    args_offset = s.pop()
+    args_size = s.pop()
+    ret_offset = s.pop()
+    ret_size = s.pop()
+    if f.static_mode and value:
+        raise EVMError('CALL with value in static context')
+    use_memory(f, args_offset, args_size)
+    use_memory(f, ret_offset, ret_size)
+    if value:
+        charge(f, CALL_VALUE if f.world.exists(address) else CALL_VALUE + NEW_ACCOUNT)
+    gas = call_gas(f, gas)
+    snapshot = f.world.snapshot()
+    if not send_value(f, address, value):
+        if gas is not None:
+            f.gas += gas
+        f.returndata = b''
+        s.append(0)
+        return
+    if gas is not None and value:
+        gas += CALL_STIPEND
+    data = f.memory.read(args_offset, args_size)
+    tx = Message(address, f.address, f.tx.origin, value, f.tx.gasprice, data)
+    call_into(f, get_analysis(f, address), tx, f.static_mode, gas, ret_offset, ret_size, snapshot)
+
+
+# RETURN
+def op_return(f):
+    s = f.stack
+    byte_offset = s.pop()
+    byte_size = s.pop()
+    use_memory(f, byte_offset, byte_size)
+    f.ret = f.memory.view(byte_offset, byte_size)
+    raise Halt
+
+
+# DELEGATECALL
+def op_delegatecall(f):
+    s = f.stack
+    gas = s.pop()
+    address = s.pop() & ADDRESS_MASK
+    args_offset = s.pop()
+    args_size = s.pop()
+    ret_offset = s.pop()
+    ret_size = s.pop()
+    use_memory(f, args_offset, args_size)
+    use_memory(f, ret_offset, ret_size)
+    gas = call_gas(f, gas)
+    # Same address, caller and value: only the code and the data change
+    data = f.memory.read(args_offset, args_size)
+    tx = Message(f.tx.to, f.tx.caller, f.tx.origin, f.tx.value, f.tx.gasprice, data)
+    call_into(f, get_analysis(f, address), tx, f.static_mode, gas, ret_offset, ret_size, f.world.snapshot())
+
+
+# STATICCALL
+def op_staticcall(f):
+    s = f.stack
+    gas = s.pop()
+    address = s.pop() & ADDRESS_MASK
+    args_offset = s.pop()
+    args_size = s.pop()
+    ret_offset = s.pop()
+    ret_size = s.pop()
+    use_memory(f, args_offset, args_size)
+    use_memory(f, ret_offset, ret_size)
+    gas = call_gas(f, gas)
+    data = f.memory.read(args_offset, args_size)
+    tx = Message(address, f.address, f.tx.origin, 0, f.tx.gasprice, data)
+    call_into(f, get_analysis(f, address), tx, True, gas, ret_offset, ret_size, f.world.snapshot())
+
+
+# REVERT
+def op_revert(f):
+    s = f.stack
+    byte_offset = s.pop()
+    byte_size = s.pop()
+    use_memory(f, byte_offset, byte_size)
+    f.ret = f.memory.view(byte_offset, byte_size)
+    f.success = False
+    raise Halt
+
+
+# INVALID
+def op_invalid(f):
+    raise EVMError('invalid opcode')
+
+
+# SELFDESTRUCT
+def op_selfdestruct(f):
+    if f.static_mode:
+        raise EVMError('SELFDESTRUCT in static context')
+    address = f.stack.pop() & ADDRESS_MASK
+    world = f.world
+    balance = world.get_balance(f.address)
+    if balance and not world.exists(address):
+        charge(f, SELFDESTRUCT_NEW_ACCOUNT)
+    # Credit first: a contract destroying itself in favour of itself burns
+    # its balance
+    world.set_balance(address, world.get_balance(address) + balance)
+    world.delete_account(f.address)
+    raise Halt
+
+
+def build_handlers():
+    handlers = [op_invalid] * 256
+    handlers[0x00] = op_stop
+    handlers[0x01] = op_add
+    handlers[0x02] = op_mul
+    handlers[0x03] = op_sub
+    handlers[0x04] = op_div
+    handlers[0x05] = op_sdiv
+    handlers[0x06] = op_mod
+    handlers[0x07] = op_smod
+    handlers[0x08] = op_addmod
+    handlers[0x09] = op_mulmod
+    handlers[0x0a] = op_exp
+    handlers[0x0b] = op_signextend
+    handlers[0x10] = op_lt
+    handlers[0x11] = op_gt
+    handlers[0x12] = op_slt
+    handlers[0x13] = op_sgt
+    handlers[0x14] = op_eq
+    handlers[0x15] = op_iszero
+    handlers[0x16] = op_and
+    handlers[0x17] = op_or
+    handlers[0x18] = op_xor
+    handlers[0x19] = op_not
+    handlers[0x1a] = op_byte
+    handlers[0x1b] = op_shl
+    handlers[0x1c] = op_shr
+    handlers[0x1d] = op_sar
+    handlers[0x20] = op_sha3
+    handlers[0x30] = op_address
+    handlers[0x31] = op_balance
+    handlers[0x32] = op_origin
+    handlers[0x33] = op_caller
+    handlers[0x34] = op_callvalue
+    handlers[0x35] = op_calldataload
+    handlers[0x36] = op_calldatasize
+    handlers[0x37] = op_calldatacopy
+    handlers[0x38] = op_codesize
+    handlers[0x39] = op_codecopy
+    handlers[0x3a] = op_gasprice
+    handlers[0x3b] = op_extcodesize
+    handlers[0x3c] = op_extcodecopy
+    handlers[0x3d] = op_returndatasize
+    handlers[0x3e] = op_returndatacopy
+    handlers[0x3f] = op_extcodehash
+    handlers[0x40] = op_blockhash
+    handlers[0x41] = op_coinbase
+    handlers[0x42] = op_timestamp
+    handlers[0x43] = op_number
+    handlers[0x44] = op_difficulty
+    handlers[0x45] = op_gaslimit
+    handlers[0x46] = op_chainid
+    handlers[0x47] = op_selfbalance
+    handlers[0x48] = op_basefee
+    handlers[0x50] = op_pop
+    handlers[0x51] = op_mload
+    handlers[0x52] = op_mstore
+    handlers[0x53] = op_mstore8
+    handlers[0x54] = op_sload
+    handlers[0x55] = op_sstore
+    handlers[0x56] = op_jump
+    handlers[0x57] = op_jumpi
+    handlers[0x58] = op_pc
+    handlers[0x59] = op_msize
+    handlers[0x5a] = op_gas
+    handlers[0x5b] = op_jumpdest
+    handlers[0x5f] = op_push0
+    for i in range(32):
+        handlers[0x60 + i] = make_push(i + 1)
+    for i in range(16):
+        handlers[0x80 + i] = make_dup(i + 1)
+        handlers[0x90 + i] = make_swap(i + 1)
+    for i in range(5):
+        handlers[0xa0 + i] = make_log(i)
+    handlers[0xf0] = op_create
+    handlers[0xf1] = op_call
+    handlers[0xf3] = op_return
+    handlers[0xf4] = op_delegatecall
+    handlers[0xfa] = op_staticcall
+    handlers[0xfd] = op_revert
+    handlers[0xfe] = op_invalid
+    handlers[0xff] = op_selfdestruct
+    return handlers
+
+
+HANDLERS = build_handlers()
+
+
+def fail(f):
+    # An exceptional halt consumes all gas and returns nothing
+    f.success = False
+    f.ret = None
+    f.gas = 0
+
+
+def execute_frame(f):
+    return run_frames(f, run_frame)
+
+
+def run_frame(f):
+    code = f.code
+    n = len(code)
+    handlers = HANDLERS
+    static_gas = STATIC_GAS
+    try:
+        while f.pc < n:
+            op = code[f.pc]
+            gas = f.gas - static_gas[op]
+            if gas < 0:
+                raise OutOfGas
+            f.gas = gas
+            f.pc += 1
+            handlers[op](f)
+    except Halt:
+        pass
+    except FAILURES:
+        fail(f)
+    except SubCall as call:
+        return call.child
+    return None
+
+
+def log_to_json(log):
+    address, data, topics = log
+    return {
+        "address": format_address(address),
+        "data": data.hex(),
+        "topics": [hex(topic) for topic in topics],
+    }
+
+
+def prepare_run(code, tx, block, state, static_mode=False):
+    # The outermost frame of an execution, the snapshot to revert to if it
+    # fails and its starting gas, see `run`
+    msg = Message.from_json(tx)
+    env = BlockEnv.from_json(block)
+    world = state if isinstance(state, WorldState) else WorldState.from_json(state)
+    snapshot = world.snapshot()
+    f = Frame(code_cache.lookup(code), msg, env, world, static_mode, msg.gas)
+    return f, snapshot, f.gas
+
+
+def finish_run(f, state, snapshot, start):
+    # The result tuple of the finished outermost frame `f`. A failed
+    # execution leaves nothing behind: no state changes, no logs and an
+    # empty stack (which otherwise depends on where each engine charges gas)
+    if not f.success:
+        f.world.revert(snapshot)
+    if isinstance(state, dict):
+        state.clear()
+        state.update(f.world.to_json())
+    ret = f.ret.hex() if f.ret is not None else None
+    if not f.success:
+        return (False, [], [], ret, start - f.gas)
+    logs = [log_to_json(log) for log in f.logs]
+    return (True, f.stack.to_list(), logs, ret, start - f.gas)
+
+
+def run(engine, code, tx, block, state, static_mode=False):
+    # `state` is the JSON state dict, updated in place when the execution
+    # ends, or a `WorldState`. The transaction's `gas` is used as is, there
+    # is no intrinsic cost.
+    f, snapshot, start = prepare_run(code, tx, block, state, static_mode)
+    engine(f)
+    return finish_run(f, state, snapshot, start)
+
+
+def execute(code, tx, block, state, static_mode=False):
+    return run(execute_frame, code, tx, block, state, static_mode)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Memory
+#
+# Memory is a single `bytearray` that only ever grows, in 32-byte words:
+# touching any byte of a word makes the whole word part of memory, so
+# `len(memory)` is always the value MSIZE reports.
+#
+# Reads and writes are slice operations, words are converted with
+# `int.from_bytes` / `int.to_bytes`, and `view()` hands out a zero-copy
+# `memoryview` for hashing and return data. A view must not be kept across
+# anything that can grow memory: a `bytearray` cannot be resized while a view
+# of it exists.
+
+
+class Memory:
+    __slots__ = ('data',)
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        # Empties memory so the object can be reused. A view still held on
+        # the old buffer would make `clear()` fail, so start a new one then.
+        try:
+            self.data.clear()
+        except BufferError:
+            self.data = bytearray()
+
+    def extend(self, byte_offset, byte_size):
+        # Zero-sized accesses never expand memory, whatever the offset
+        if byte_size == 0:
+            return
+        end = (byte_offset + byte_size + 31) & ~31
+        if end > len(self.data):
+            self.data += bytes(end - len(self.data))
+
+    def load_word(self, byte_offset):
+        end = byte_offset + 32
+        if end > len(self.data):
+            self.extend(byte_offset, 32)
+        return int.from_bytes(self.data[byte_offset:end], 'big')
+
+    def store_word(self, byte_offset, value):
+        end = byte_offset + 32
+        if end > len(self.data):
+            self.extend(byte_offset, 32)
+        self.data[byte_offset:end] = value.to_bytes(32, 'big')
+
+    def store_byte(self, byte_offset, value):
+        if byte_offset >= len(self.data):
+            self.extend(byte_offset, 1)
+        self.data[byte_offset] = value & 0xff
+
+    def read(self, byte_offset, byte_size):
+        if byte_size == 0:
+            return b''
+        self.extend(byte_offset, byte_size)
+        return bytes(self.data[byte_offset:byte_offset + byte_size])
+
+    def view(self, byte_offset, byte_size):
+        if byte_size == 0:
+            return memoryview(b'')
+        self.extend(byte_offset, byte_size)
+        return memoryview(self.data)[byte_offset:byte_offset + byte_size]
+
+    def write(self, byte_offset, data):
+        if not data:
+            return
+        self.extend(byte_offset, len(data))
+        self.data[byte_offset:byte_offset + len(data)] = data
+
+    def copy_from(self, dest_offset, src, byte_offset, byte_size):
+        # CALLDATACOPY, CODECOPY, EXTCODECOPY: bytes past the end of `src`
+        # are copied as zeros
+        if byte_size == 0:
+            return
+        self.extend(dest_offset, byte_size)
+        end = dest_offset + byte_size
+        chunk = memoryview(src)[byte_offset:byte_offset + byte_size]
+        self.data[dest_offset:dest_offset + len(chunk)] = chunk
+        if len(chunk) < byte_size:
+            self.data[dest_offset + len(chunk):end] = bytes(byte_size - len(chunk))
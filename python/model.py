@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Typed execution model
+#
+# The `evm.json` format stores every number and address as a hex string.
+# Parsing those strings inside opcode handlers (`int(tx['value'], 16)` on
+# every CALLVALUE, ...) is wasted work, so the JSON is decoded once, when an
+# execution starts, into the small `__slots__` classes below:
+#
+# - numbers and addresses are Python ints (addresses are 160-bit ints)
+# - code and calldata are bytes
+#
+# and converted back to JSON only for the results. Contract code goes
+# through `code_cache` (see `analysis.py`), so the same hex code is decoded
+# and analysed once, however many times a state is loaded.
+
+from analysis import code_cache
+
+
+def parse_int(value, default=0):
+    if value is None:
+        return default
+    if isinstance(value, int):
+        return value
+    return int(value, 16)
+
+
+def format_address(address):
+    return '0x%040x' % address
+
+
+class Account:
+    __slots__ = ('balance', 'nonce', 'code', 'storage', 'analysis')
+
+    def __init__(self, balance=0, nonce=0, code=b'', storage=None):
+        self.balance = balance
+        self.nonce = nonce
+        self.code = code
+        # slot -> value, both ints, zero values are not stored
+        self.storage = storage if storage is not None else {}
+        # `CodeAnalysis` of `code`, looked up on first use
+        self.analysis = None
+
+    @classmethod
+    def from_json(cls, data):
+        code = data.get('code')
+        storage = data.get('storage') or {}
+        analysis = code_cache.lookup_hex(code['bin']) if code else None
+        account = cls(
+            balance=parse_int(data.get('balance')),
+            nonce=parse_int(data.get('nonce')),
+            code=analysis.code if analysis is not None else b'',
+            storage={
+                int(slot, 16): int(value, 16)
+                for slot, value in storage.items()
+                if int(value, 16)
+            },
+        )
+        account.analysis = analysis
+        return account
+
+    def copy(self):
+        account = Account(self.balance, self.nonce, self.code, dict(self.storage))
+        account.analysis = self.analysis
+        return account
+
+    def to_json(self):
+        data = {'balance': hex(self.balance)}
+        if self.nonce:
+            data['nonce'] = hex(self.nonce)
+        if self.code:
+            data['code'] = {'bin': self.code.hex()}
+        if self.storage:
+            data['storage'] = {hex(slot): hex(value) for slot, value in self.storage.items()}
+        return data
+
+
+class Message:
+    # The `tx` of an execution: who calls whom, with which value and data
+    __slots__ = ('to', 'caller', 'origin', 'value', 'gasprice', 'data', 'gas')
+
+    def __init__(self, to=0, caller=0, origin=0, value=0, gasprice=0, data=b'', gas=None):
+        self.to = to
+        self.caller = caller
+        self.origin = origin
+        self.value = value
+        self.gasprice = gasprice
+        self.data = data
+        self.gas = gas
+
+    @classmethod
+    def from_json(cls, data):
+        if data is None:
+            return cls()
+        return cls(
+            to=parse_int(data.get('to')),
+            caller=parse_int(data.get('from')),
+            origin=parse_int(data.get('origin')),
+            value=parse_int(data.get('value')),
+            gasprice=parse_int(data.get('gasprice')),
+            data=bytes.fromhex(data.get('data') or ''),
+            gas=parse_int(data.get('gas'), None),
+        )
+
+    def to_json(self):
+        data = {
+            'to': format_address(self.to),
+            'from': format_address(self.caller),
+            'origin': format_address(self.origin),
+            'value': hex(self.value),
+            'gasprice': hex(self.gasprice),
+            'data': self.data.hex(),
+        }
+        if self.gas is not None:
+            data['gas'] = hex(self.gas)
+        return data
+
+
+class BlockEnv:
+    __slots__ = ('coinbase', 'timestamp', 'number', 'difficulty', 'gaslimit', 'chainid', 'basefee')
+
+    def __init__(self, coinbase=0, timestamp=0, number=0, difficulty=0, gaslimit=0, chainid=0, basefee=0):
+        self.coinbase = coinbase
+        self.timestamp = timestamp
+        self.number = number
+        self.difficulty = difficulty
+        self.gaslimit = gaslimit
+        self.chainid = chainid
+        self.basefee = basefee
+
+    @classmethod
+    def from_json(cls, data):
+        if data is None:
+            return cls()
+        return cls(**{key: parse_int(data.get(key)) for key in cls.__slots__})
+
+    def to_json(self):
+        data = {key: hex(getattr(self, key)) for key in self.__slots__}
+        data['coinbase'] = format_address(self.coinbase)
+        return data
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Resumable execution
+#
+# `evm()` runs a transaction to the end in one call: a long loop holds the
+# whole process until it is done. Here an execution is a generator instead,
+# which runs at most `quantum` instructions at a time and yields in between:
+#
+#     execution = Execution(code, tx, block, state, quantum=1000)
+#     while not execution.done:
+#         execution.advance()      # one slice
+#     success, stack, logs, ret, gas_used = execution.result
+#
+# Nothing is lost between slices: the pc, stack and memory live on the
+# `Frame`, and sub-calls use the explicit frame stack of the interpreter (see
+# `run_frames`), so the generator just keeps the list of frames. It also
+# yields when a sub-call starts or returns.
+#
+# `execute_async` runs an execution as an asyncio coroutine that awaits
+# between slices, so thousands of them share one event loop fairly (the
+# event loop runs ready tasks in turn). Each one can have a step and a time
+# budget; when it runs out, or the task is cancelled, the execution is
+# abandoned, its state changes reverted, and `BudgetExceeded` (or
+# `CancelledError`) raised. `Scheduler` bounds how many run at once.
+#
+# Executions running at the same time must not share a `WorldState`: their
+# journals would interleave.
+#
+# - Run `python3 resumable.py` to run the tests as coroutines and compare the
+#   latency of short executions queued behind long ones, run to completion
+#   one by one or interleaved
+
+import asyncio
+import time
+
+from gas import STATIC_GAS, OutOfGas
+from interpreter import FAILURES, HANDLERS, Halt, SubCall, fail, finish_run, prepare_run, release_frame, resume
+
+DEFAULT_QUANTUM = 1000
+
+# `run_slice` ran out of instructions before the frame finished
+PAUSED = object()
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def run_slice(f, budget):
+    # Like `run_frame`, but runs at most `budget` instructions. Returns
+    # (outcome, instructions left of `budget`), where the outcome is the
+    # child frame of a sub-call, PAUSED, or None once `f` has finished.
+    code = f.code
+    n = len(code)
+    handlers = HANDLERS
+    static_gas = STATIC_GAS
+    try:
+        while f.pc < n:
+            if not budget:
+                return PAUSED, 0
+            budget -= 1
+            op = code[f.pc]
+            gas = f.gas - static_gas[op]
+            if gas < 0:
+                raise OutOfGas
+            f.gas = gas
+            f.pc += 1
+            handlers[op](f)
+    except Halt:
+        pass
+    except FAILURES:
+        fail(f)
+    except SubCall as call:
+        return call.child, budget
+    return None, budget
+
+
+class Execution:
+    def __init__(self, code, tx=None, block=None, state=None, static_mode=False, quantum=DEFAULT_QUANTUM):
+        self.state = state
+        self.frame, self.snapshot, self.start_gas = prepare_run(code, tx, block, state, static_mode)
+        self.frames = [self.frame]
+        self.quantum = quantum
+        self.steps = 0
+        self.result = None
+        self.slices = self.run()
+
+    @property
+    def done(self):
+        return self.result is not None
+
+    def run(self):
+        # The generator behind `advance`: yields after every slice
+        frames = self.frames
+        quantum = self.quantum
+        while frames:
+            outcome, left = run_slice(frames[-1], quantum)
+            self.steps += quantum - left
+            if outcome is PAUSED:
+                yield
+            elif outcome is not None:
+                frames.append(outcome)
+                yield
+            else:
+                child = frames.pop()
+                if frames:
+                    resume(frames[-1], child)
+                    yield
+        self.result = finish_run(self.frame, self.state, self.snapshot, self.start_gas)
+
+    def advance(self):
+        # Runs one slice, returns False once the execution is done
+        next(self.slices, None)
+        return not self.done
+
+    def abort(self):
+        # Stops for good and reverts everything the execution changed
+        if self.done:
+            return
+        self.slices.close()
+        while len(self.frames) > 1:
+            release_frame(self.frames.pop())
+        self.frames.clear()
+        self.frame.world.revert(self.snapshot)
+
+
+async def execute_async(code, tx=None, block=None, state=None, static_mode=False,
+                        quantum=DEFAULT_QUANTUM, max_steps=None, max_time=None):
+    # `evm()` as a coroutine that lets other tasks run every `quantum`
+    # instructions. Raises BudgetExceeded after `max_steps` instructions or
+    # `max_time` seconds.
+    execution = Execution(code, tx, block, state, static_mode, quantum)
+    deadline = time.perf_counter() + max_time if max_time is not None else None
+    try:
+        while execution.advance():
+            if max_steps is not None and execution.steps >= max_steps:
+                raise BudgetExceeded(f"stopped after {execution.steps} steps")
+            if deadline is not None and time.perf_counter() >= deadline:
+                raise BudgetExceeded(f"stopped after {max_time}s ({execution.steps} steps)")
+            await asyncio.sleep(0)
+    finally:
+        execution.abort()
+    return execution.result
+
+
+class Scheduler:
+    # Runs executions as tasks of the running event loop, at most
+    # `concurrency` at a time, with default budgets
+    def __init__(self, concurrency=1000, quantum=DEFAULT_QUANTUM, max_steps=None, max_time=None):
+        self.slots = asyncio.Semaphore(concurrency)
+        self.quantum = quantum
+        self.max_steps = max_steps
+        self.max_time = max_time
+        self.tasks = set()
+
+    def submit(self, code, tx=None, block=None, state=None, static_mode=False, **budget):
+        # An asyncio task with the result of the execution
+        task = asyncio.ensure_future(self.execute(code, tx, block, state, static_mode, **budget))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def execute(self, code, tx, block, state, static_mode, max_steps=None, max_time=None):
+        async with self.slots:
+            return await execute_async(
+                code, tx, block, state, static_mode, self.quantum,
+                max_steps if max_steps is not None else self.max_steps,
+                max_time if max_time is not None else self.max_time,
+            )
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def join(self):
+        # Waits for every submitted task; failures stay on their task
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+def loop_code(rounds):
+    # Counts down from `rounds`, then returns
+    return bytes([
+        0x62, *rounds.to_bytes(3, 'big'),  # PUSH3 rounds
+        0x5b,                              # JUMPDEST (4)
+        0x60, 0x01, 0x90, 0x03,            # PUSH1 1 SWAP1 SUB
+        0x80, 0x60, 0x04, 0x57,            # DUP1 PUSH1 4 JUMPI
+        0x00,                              # STOP
+    ])
+
+
+def check_fixtures():
+    # Every test of `evm.json`, with a quantum of 1 instruction
+    import os
+
+    from evm import evm_fixture
+    from fixtures import open_fixtures
+
+    async def check():
+        failures = 0
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'evm.json')
+        with open_fixtures(path) as fixtures:
+            for fixture in fixtures:
+                expected = evm_fixture(fixture)
+                result = await execute_async(fixture.code, fixture.tx, fixture.block, fixture.world(), quantum=1)
+                if result != expected:
+                    failures += 1
+                    print(f"❌ {fixture.name}: {result} != {expected}")
+        return failures
+
+    return asyncio.run(check())
+
+
+async def latencies(jobs, quantum):
+    # Seconds from submission to completion of every job
+    scheduler = Scheduler(quantum=quantum)
+    start = time.perf_counter()
+    finished = {}
+
+    def done(i):
+        return lambda task: finished.__setitem__(i, time.perf_counter() - start)
+
+    for i, code in enumerate(jobs):
+        scheduler.submit(code).add_done_callback(done(i))
+    await scheduler.join()
+    return [finished[i] for i in range(len(jobs))]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    failures = check_fixtures()
+    print("✓  tests pass when run one instruction at a time" if not failures else f"{failures} tests failed")
+
+    async def runaway():
+        try:
+            await execute_async(loop_code(2**24 - 1), max_steps=10000)
+        except BudgetExceeded as e:
+            return str(e)
+    print(f"✓  endless loop: {asyncio.run(runaway())}")
+
+    # A few long executions submitted first, then many short ones
+    jobs = [loop_code(100000)] * 4 + [loop_code(100)] * 1000
+    for name, quantum in (('one by one', 10**9), ('interleaved', DEFAULT_QUANTUM)):
+        times = asyncio.run(latencies(jobs, quantum))
+        short = times[4:]
+        print(f"{name:>12}: short executions p50 {percentile(short, 0.5) * 1000:7.1f} ms, "
+              f"p99 {percentile(short, 0.99) * 1000:7.1f} ms, all done in {max(times) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,563 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Local JSON-RPC server
+#
+# Wrapping `evm()` in a script pays for Python startup, imports and loading
+# the state on every run. This is a long-running server instead: JSON-RPC 2.0
+# over HTTP on localhost (or a Unix socket), served by an asyncio loop in
+# front of a pool of worker processes. Each worker loads the state once when
+# it starts, warms the code caches with every contract in it, and keeps them
+# hot across requests.
+#
+# Methods:
+#
+# - eth_call(call, block?) runs `call` ({from, to, gas, gasPrice, value,
+#   data/input}) against the code at `to` and returns the output. Nothing it
+#   changes is kept. A failure is error 3 with the revert data.
+# - eth_estimateGas(call, block?) is the least gas for which the call
+#   succeeds, found by binary search up to `--gas-cap`. As with `evm()`,
+#   there is no intrinsic gas.
+# - eth_getBalance, eth_getCode, eth_getTransactionCount, eth_getStorageAt,
+#   eth_chainId, eth_blockNumber read the state and the block.
+#
+# The block argument is ignored: there is one state, from a local file (the
+# JSON `state` format of `evm.json`, or an SQLite database written through
+# `storage_backend.py`), and one block environment (`--block`, a JSON file
+# in the `block` format). Nothing goes to the network.
+#
+# A batch (a JSON array of requests) is split into one chunk per worker, so
+# it costs one round trip to each worker rather than one per request.
+# `GET /metrics` returns the number of requests, errors and latency
+# percentiles per method (the time each request took in its worker), with
+# every method the server doesn't know counted under `unknown`.
+#
+# - Run `python3 rpc_server.py state.json` to serve on 127.0.0.1:8545
+# - Run `python3 rpc_server.py --self-test` to start a server on a demo state
+#   and check its answers against `evm()`
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from analysis import code_cache
+from basic_blocks import execute_blocks, get_blocks
+from interpreter import run
+from model import BlockEnv, parse_int
+from storage_backend import PersistentWorldState, SqliteBackend
+from world_state import WorldState
+
+DEFAULT_GAS_CAP = 50_000_000
+
+# Latencies kept per method for the percentiles
+LATENCY_WINDOW = 10000
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+# JSON-RPC error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+EXECUTION_ERROR = 3
+
+
+class RpcError(Exception):
+    def __init__(self, code, message, data=None):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.data = data
+
+
+def open_state(path):
+    # A `WorldState` from a JSON state file, or a `PersistentWorldState`
+    # over an SQLite one
+    with open(path, 'rb') as f:
+        magic = f.read(len(SQLITE_MAGIC))
+    if magic == SQLITE_MAGIC:
+        return PersistentWorldState(SqliteBackend(path))
+    with open(path) as f:
+        return WorldState.from_json(json.load(f))
+
+
+# Set in each worker by `init_worker`
+worker_world = None
+worker_block = None
+worker_gas_cap = DEFAULT_GAS_CAP
+
+
+def init_worker(state_path, block, gas_cap):
+    global worker_world, worker_block, worker_gas_cap
+    worker_world = open_state(state_path)
+    worker_block = block
+    worker_gas_cap = gas_cap
+    if not isinstance(worker_world, PersistentWorldState):
+        # Decode every contract now rather than on its first call
+        for account in worker_world.accounts.values():
+            if account.code:
+                account.analysis = code_cache.lookup(account.code)
+                get_blocks(account.analysis)
+
+
+def warm_up():
+    # Run once per worker when the server starts, so that they all exist
+    # (and have run `init_worker`) before the first request
+    return os.getpid()
+
+
+def call_to_tx(call):
+    # An `eth_call` call object as the `tx` of `evm()`
+    if not isinstance(call, dict):
+        raise RpcError(INVALID_PARAMS, "expected a call object")
+    data = call.get('data') or call.get('input') or '0x'
+    tx = {
+        'to': call.get('to'),
+        'from': call.get('from'),
+        'origin': call.get('from'),
+        'value': call.get('value'),
+        'gasprice': call.get('gasPrice'),
+        'data': data[2:] if data.startswith('0x') else data,
+    }
+    if call.get('gas') is not None:
+        tx['gas'] = call['gas']
+    return tx
+
+
+def execute_call(tx, gas):
+    # The result of `tx` with `gas`; the state is left as it was
+    world = worker_world
+    tx = dict(tx, gas=hex(gas))
+    snapshot = world.snapshot()
+    try:
+        code = world.get_code(parse_int(tx.get('to')))
+        return run(execute_blocks, code, tx, worker_block, world)
+    finally:
+        world.revert(snapshot)
+
+
+def execution_error(result):
+    success, stack, logs, ret, gas_used = result
+    return RpcError(EXECUTION_ERROR, "execution reverted", '0x' + (ret or ''))
+
+
+def eth_call(call, block_tag=None):
+    tx = call_to_tx(call)
+    result = execute_call(tx, min(parse_int(tx.get('gas'), worker_gas_cap), worker_gas_cap))
+    if not result[0]:
+        raise execution_error(result)
+    return '0x' + (result[3] or '')
+
+
+def eth_estimateGas(call, block_tag=None):
+    tx = call_to_tx(call)
+    cap = min(parse_int(tx.get('gas'), worker_gas_cap), worker_gas_cap)
+    result = execute_call(tx, cap)
+    if not result[0]:
+        raise execution_error(result)
+    # A call can need more gas than it uses (sub-calls only get 63/64 of
+    # what is left), or less (a sub-call that fails with the gas it gets
+    # does not fail the call): search the whole range, starting from the
+    # usual case of what was used being enough
+    low, high = 0, cap
+    if execute_call(tx, result[4])[0]:
+        high = result[4]
+    while high - low > 1:
+        middle = (low + high) // 2
+        if execute_call(tx, middle)[0]:
+            high = middle
+        else:
+            low = middle
+    return hex(high)
+
+
+def eth_getBalance(address, block_tag=None):
+    return hex(worker_world.get_balance(parse_int(address)))
+
+
+def eth_getCode(address, block_tag=None):
+    return '0x' + worker_world.get_code(parse_int(address)).hex()
+
+
+def eth_getTransactionCount(address, block_tag=None):
+    return hex(worker_world.get_nonce(parse_int(address)))
+
+
+def eth_getStorageAt(address, slot, block_tag=None):
+    return '0x%064x' % worker_world.get_storage(parse_int(address), parse_int(slot))
+
+
+def eth_chainId():
+    return hex(BlockEnv.from_json(worker_block).chainid)
+
+
+def eth_blockNumber():
+    return hex(BlockEnv.from_json(worker_block).number)
+
+
+METHODS = {
+    function.__name__: function
+    for function in (
+        eth_call, eth_estimateGas, eth_getBalance, eth_getCode,
+        eth_getTransactionCount, eth_getStorageAt, eth_chainId, eth_blockNumber,
+    )
+}
+
+
+def handle_request(method, params):
+    # Runs in a worker: ('result', value) or ('error', code, message, data)
+    function = METHODS.get(method)
+    if function is None:
+        return ('error', METHOD_NOT_FOUND, f"method {method} not found", None)
+    try:
+        if isinstance(params, dict):
+            return ('result', function(**params))
+        return ('result', function(*params))
+    except RpcError as e:
+        return ('error', e.code, e.message, e.data)
+    except (TypeError, ValueError, AttributeError) as e:
+        return ('error', INVALID_PARAMS, f"invalid params: {e}", None)
+    except Exception as e:
+        return ('error', INTERNAL_ERROR, f"{type(e).__name__}: {e}", None)
+
+
+def trim_state():
+    # Every request reverts what it changed, so an SQLite state has nothing
+    # to write back: drop its cached accounts once there are too many,
+    # rather than keeping everything the worker ever read
+    world = worker_world
+    if isinstance(world, PersistentWorldState) and len(world.accounts.saved) > world.cache_size:
+        world.accounts.evict()
+
+
+def handle_requests(requests):
+    # Runs in a worker: (outcome, seconds) per (method, params) of a batch
+    # chunk
+    results = []
+    for method, params in requests:
+        start = time.perf_counter()
+        outcome = handle_request(method, params)
+        results.append((outcome, time.perf_counter() - start))
+        trim_state()
+    return results
+
+
+class Metrics:
+    def __init__(self):
+        self.counts = {}
+        self.errors = {}
+        self.latencies = {}
+
+    def record(self, method, seconds, error):
+        # Keyed on the methods the server has, so clients can't grow the table
+        if method not in METHODS:
+            method = 'unknown'
+        self.counts[method] = self.counts.get(method, 0) + 1
+        if error:
+            self.errors[method] = self.errors.get(method, 0) + 1
+        self.latencies.setdefault(method, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+    def report(self):
+        report = {}
+        for method, count in self.counts.items():
+            latencies = sorted(self.latencies[method])
+
+            def percentile(p):
+                return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+            report[method] = {
+                'requests': count,
+                'errors': self.errors.get(method, 0),
+                'mean_ms': sum(latencies) / len(latencies) * 1000,
+                'p50_ms': percentile(0.5),
+                'p90_ms': percentile(0.9),
+                'p99_ms': percentile(0.99),
+            }
+        return report
+
+
+def error_response(id, code, message, data=None):
+    error = {'code': code, 'message': message}
+    if data is not None:
+        error['data'] = data
+    return {'jsonrpc': '2.0', 'id': id, 'error': error}
+
+
+class RpcServer:
+    def __init__(self, state_path, block=None, workers=None, gas_cap=DEFAULT_GAS_CAP):
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=init_worker,
+            initargs=(state_path, block or {}, gas_cap),
+        )
+        self.metrics = Metrics()
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=8545, unix=None):
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.pool, warm_up) for _ in range(self.workers)])
+        if unix is not None:
+            self.server = await asyncio.start_unix_server(self.handle_connection, unix)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.pool.shutdown()
+
+    async def handle_connection(self, reader, writer):
+        # HTTP/1.1 with keep-alive: POST a JSON-RPC payload, GET /metrics
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                parts = line.decode('latin-1').split()
+                if len(parts) != 3:
+                    break
+                verb, path, version = parts
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                if verb == 'GET' and path == '/metrics':
+                    status, payload = '200 OK', self.metrics.report()
+                elif verb == 'POST':
+                    status, payload = '200 OK', await self.handle_body(body)
+                else:
+                    status, payload = '404 Not Found', {'error': f"{verb} {path}"}
+                content = json.dumps(payload).encode() if payload is not None else b''
+                writer.write(
+                    f"HTTP/1.1 {status if payload is not None else '204 No Content'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(content)}\r\n\r\n".encode()
+                    + content
+                )
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close' or version == 'HTTP/1.0':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_body(self, body):
+        # The JSON-RPC response to a request or a batch, None if there is
+        # nothing to answer (only notifications)
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return error_response(None, PARSE_ERROR, "parse error")
+        if isinstance(payload, list):
+            if not payload:
+                return error_response(None, INVALID_REQUEST, "empty batch")
+            responses = [response for response in await self.handle_batch(payload) if response is not None]
+            return responses or None
+        return (await self.handle_batch([payload]))[0]
+
+    async def handle_batch(self, requests):
+        responses = [None] * len(requests)
+        valid = []
+        for i, request in enumerate(requests):
+            if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+                responses[i] = error_response(None, INVALID_REQUEST, "invalid request")
+                continue
+            params = request.get('params', [])
+            if not isinstance(params, (list, dict)):
+                responses[i] = error_response(request.get('id'), INVALID_PARAMS, "params must be an array or object")
+                continue
+            valid.append((i, request, (request['method'], params)))
+
+        # One chunk per worker
+        loop = asyncio.get_running_loop()
+        size = -(-len(valid) // self.workers) if valid else 1
+        chunks = [valid[k:k + size] for k in range(0, len(valid), size)]
+        outcomes = await asyncio.gather(*[
+            loop.run_in_executor(self.pool, handle_requests, [call for _, _, call in chunk])
+            for chunk in chunks
+        ])
+        for chunk, results in zip(chunks, outcomes):
+            for (i, request, (method, _)), (outcome, seconds) in zip(chunk, results):
+                self.metrics.record(method, seconds, outcome[0] == 'error')
+                if 'id' not in request:
+                    # A notification: no response
+                    continue
+                if outcome[0] == 'result':
+                    responses[i] = {'jsonrpc': '2.0', 'id': request['id'], 'result': outcome[1]}
+                else:
+                    responses[i] = error_response(request['id'], *outcome[1:])
+        return responses
+
+
+async def serve(args):
+    block = None
+    if args.block:
+        with open(args.block) as f:
+            block = json.load(f)
+    server = RpcServer(args.state, block, args.workers, args.gas_cap)
+    await server.start(args.host, args.port, args.unix)
+    where = args.unix or f"http://{args.host}:{args.port}"
+    print(f"serving {args.state} on {where} with {server.workers} workers")
+    try:
+        await server.server.serve_forever()
+    finally:
+        await server.close()
+
+
+async def http_request(host, port, verb, path, payload=None):
+    # A one-shot HTTP request to the server, returns the decoded JSON body
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(payload).encode() if payload is not None else b''
+    writer.write(
+        f"{verb} {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    content = response.split(b'\r\n\r\n', 1)[1]
+    return json.loads(content) if content else None
+
+
+def demo_state():
+    # A contract returning calldata[0:32] * 2, one that reverts, and one that
+    # burns gas in a loop of calldata[0:32] rounds before calling the first,
+    # and reverts if that call fails
+    double = bytes([
+        0x60, 0x00, 0x35, 0x60, 0x02, 0x02,  # PUSH1 0 CALLDATALOAD PUSH1 2 MUL
+        0x60, 0x00, 0x52,                    # PUSH1 0 MSTORE
+        0x60, 0x20, 0x60, 0x00, 0xf3,        # PUSH1 32 PUSH1 0 RETURN
+    ])
+    revert = bytes([0x60, 0x2a, 0x60, 0x00, 0x53, 0x60, 0x01, 0x60, 0x00, 0xfd])  # MSTORE8 42, REVERT(0, 1)
+    burn = bytes([
+        0x60, 0x00, 0x35,                    # PUSH1 0 CALLDATALOAD
+        0x5b,                                # JUMPDEST (3)
+        0x60, 0x01, 0x90, 0x03,              # PUSH1 1 SWAP1 SUB
+        0x80, 0x60, 0x03, 0x57,              # DUP1 PUSH1 3 JUMPI
+        0x60, 0x20, 0x60, 0x00,              # PUSH1 32 PUSH1 0 (ret)
+        0x60, 0x00, 0x60, 0x00, 0x60, 0x00,  # args, value 0
+        0x61, 0x10, 0x00,                    # PUSH2 0x1000 (double)
+        0x5a, 0xf1,                          # GAS CALL
+        0x15, 0x60, 0x20, 0x57,              # ISZERO PUSH1 32 JUMPI
+        0x00,                                # STOP
+        0x5b, 0x60, 0x00, 0x80, 0xfd,        # JUMPDEST (32) PUSH1 0 DUP1 REVERT
+    ])
+    return {
+        '0x%040x' % 0x1000: {'balance': '0x0', 'code': {'bin': double.hex()}},
+        '0x%040x' % 0x2000: {'balance': '0x0', 'code': {'bin': revert.hex()}},
+        '0x%040x' % 0x3000: {'balance': '0x0', 'code': {'bin': burn.hex()}},
+        '0x%040x' % 0xaaaa: {'balance': '0x2a'},
+    }
+
+
+async def self_test(workers):
+    import tempfile
+
+    from evm import evm
+
+    state = demo_state()
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump(state, f)
+        path = f.name
+    server = RpcServer(path, workers=workers)
+    try:
+        await server.start('127.0.0.1', 0)
+        host, port = server.server.sockets[0].getsockname()[:2]
+        failures = 0
+
+        def check(what, got, expected):
+            nonlocal failures
+            if got != expected:
+                failures += 1
+                print(f"❌ {what}: got {got}, expected {expected}")
+
+        requests = []
+        expected = []
+        for i in range(200):
+            data = i.to_bytes(32, 'big').hex()
+            requests.append({'jsonrpc': '2.0', 'id': i, 'method': 'eth_call',
+                             'params': [{'to': '0x%040x' % 0x1000, 'data': '0x' + data}, 'latest']})
+            result = evm(bytes.fromhex(state['0x%040x' % 0x1000]['code']['bin']),
+                         {'to': '0x%040x' % 0x1000, 'data': data, 'gas': hex(DEFAULT_GAS_CAP)}, {}, json.loads(json.dumps(state)))
+            expected.append('0x' + result[3])
+        start = time.perf_counter()
+        responses = await asyncio.gather(*[http_request(host, port, 'POST', '/', request) for request in requests])
+        single = time.perf_counter() - start
+        check("eth_call", [response['result'] for response in responses], expected)
+        start = time.perf_counter()
+        batch = await http_request(host, port, 'POST', '/', requests)
+        batched = time.perf_counter() - start
+        check("batched eth_call", [response['result'] for response in sorted(batch, key=lambda r: r['id'])], expected)
+
+        reverted = await http_request(host, port, 'POST', '/', {
+            'jsonrpc': '2.0', 'id': 1, 'method': 'eth_call', 'params': [{'to': '0x%040x' % 0x2000}]})
+        check("reverting eth_call", reverted.get('error'), {'code': EXECUTION_ERROR, 'message': "execution reverted", 'data': '0x2a'})
+
+        # The estimate must be enough, and 1 less must not be
+        call = {'to': '0x%040x' % 0x3000, 'data': '0x' + (100).to_bytes(32, 'big').hex()}
+        estimate = (await http_request(host, port, 'POST', '/', {
+            'jsonrpc': '2.0', 'id': 1, 'method': 'eth_estimateGas', 'params': [call]}))['result']
+        for gas, success in ((int(estimate, 16), True), (int(estimate, 16) - 1, False)):
+            response = await http_request(host, port, 'POST', '/', {
+                'jsonrpc': '2.0', 'id': 1, 'method': 'eth_call', 'params': [dict(call, gas=hex(gas))]})
+            check(f"eth_call with {gas} gas", 'result' in response, success)
+
+        balance = await http_request(host, port, 'POST', '/', {
+            'jsonrpc': '2.0', 'id': 1, 'method': 'eth_getBalance', 'params': ['0x%040x' % 0xaaaa, 'latest']})
+        check("eth_getBalance", balance['result'], '0x2a')
+        unknown = await http_request(host, port, 'POST', '/', {'jsonrpc': '2.0', 'id': 1, 'method': 'eth_foo'})
+        check("unknown method", unknown['error']['code'], METHOD_NOT_FOUND)
+
+        metrics = await http_request(host, port, 'GET', '/metrics')
+        check("unknown method metrics", (metrics.get('unknown', {}).get('requests'), 'eth_foo' in metrics), (1, False))
+        print(f"200 eth_calls: one per request {single * 1000:.1f} ms, one batch {batched * 1000:.1f} ms "
+              f"({single / batched:.1f}x); estimate for 100 rounds: {int(estimate, 16)} gas")
+        for method, numbers in metrics.items():
+            print(f"  {method}: {numbers['requests']} requests, {numbers['errors']} errors, "
+                  f"p50 {numbers['p50_ms']:.2f} ms, p99 {numbers['p99_ms']:.2f} ms")
+        print("✓  the server agrees with evm()" if not failures else f"{failures} checks failed")
+        return failures
+    finally:
+        await server.close()
+        os.unlink(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve eth_call and eth_estimateGas on a local state")
+    parser.add_argument('state', nargs='?', help="JSON state file, or an SQLite state database")
+    parser.add_argument('--block', help="JSON file with the block environment")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8545)
+    parser.add_argument('--unix', help="serve on this Unix socket instead of TCP")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--gas-cap', type=int, default=DEFAULT_GAS_CAP, help="gas of calls that give none, and the most any call gets")
+    parser.add_argument('--self-test', action='store_true', help="check a server on a demo state against evm()")
+    args = parser.parse_args(argv)
+
+    if args.self_test:
+        return 1 if asyncio.run(self_test(args.workers)) else 0
+    if args.state is None:
+        parser.error("a state file is required")
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Stack
+#
+# The stack keeps its top at the end of a Python list, so push, pop, DUPn and
+# SWAPn are O(1) and never copy the rest of the stack.
+#
+# `Stack` is a list subclass, so `pop()`, `append()` and indexing are the
+# built-in C implementations:
+#
+# - Handlers that can grow the stack use `push()`, which enforces the 1024
+#   item limit. Handlers that pop at least as many items as they push (ADD,
+#   MSTORE, ...) cannot overflow and use plain `append()`.
+# - Popping or indexing past the bottom raises `IndexError`, which the
+#   interpreter turns into a failed execution (stack underflow).
+
+STACK_LIMIT = 1024
+
+
+class StackOverflow(Exception):
+    pass
+
+
+class Stack(list):
+    __slots__ = ()
+
+    def push(self, value):
+        if len(self) >= STACK_LIMIT:
+            raise StackOverflow('stack limit of %d reached' % STACK_LIMIT)
+        self.append(value)
+
+    def to_list(self):
+        # Top-first, the order `test()` compares against
+        return self[::-1]
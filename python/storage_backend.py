@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Storage backends
+#
+# A `WorldState` (see `world_state.py`) keeps every account in memory and
+# forgets it on exit. `PersistentWorldState` is a `WorldState` over a storage
+# backend instead, so the state can be larger than memory and outlive the
+# process:
+#
+# - `DictBackend` keeps accounts by address and storage by (address, slot),
+#   all ints, in memory
+# - `SqliteBackend` keeps them in an SQLite file (stdlib `sqlite3`), numbers
+#   as 32-byte big-endian blobs since SQLite integers are 64-bit
+#
+# A backend only loads and writes: `load_account`, `load_slot`, `load_slots`,
+# `addresses`, `store_slot` to set one slot, and `write(accounts, slots,
+# cleared)` to apply a batch of changes at once (one SQLite transaction).
+#
+# `PersistentWorldState` is a write-back cache on top: accounts and slots are
+# loaded on first access and changed in memory, so the journal, snapshots and
+# reverts work as in `WorldState`. `commit()` (the end of a transaction)
+# writes the changes to the backend every `flush_every` transactions, in one
+# batch, and drops the cache once it holds more than `cache_size` accounts.
+#
+#     world = PersistentWorldState(SqliteBackend('state.db'))
+#     run(execute_frame, code, tx, block, world)
+#     world.commit()
+#     world.close()
+#
+# - Run `python3 storage_backend.py` to run the tests on a persistent state
+#   and check that it survives a restart
+
+import sqlite3
+
+from model import Account
+from world_state import WorldState
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_FLUSH_EVERY = 100
+
+
+def encode_word(value):
+    return value.to_bytes(32, 'big')
+
+
+def decode_word(data):
+    return int.from_bytes(data, 'big')
+
+
+class DictBackend:
+    def __init__(self):
+        # address -> (balance, nonce, code)
+        self.accounts = {}
+        # (address, slot) -> value, zero values are not stored
+        self.slots = {}
+
+    @classmethod
+    def from_json(cls, state):
+        backend = cls()
+        backend.import_world(WorldState.from_json(state))
+        return backend
+
+    def import_world(self, world):
+        # Writes every account of `world`, replacing what is there
+        accounts = {}
+        slots = {}
+        for address, account in world.accounts.items():
+            accounts[address] = (account.balance, account.nonce, account.code)
+            for slot, value in account.storage.items():
+                slots[(address, slot)] = value
+        self.write(accounts, slots, accounts.keys())
+
+    def load_account(self, address):
+        return self.accounts.get(address)
+
+    def load_slot(self, address, slot):
+        return self.slots.get((address, slot), 0)
+
+    def load_slots(self, address):
+        return {slot: value for (owner, slot), value in self.slots.items() if owner == address}
+
+    def addresses(self):
+        return list(self.accounts)
+
+    def store_slot(self, address, slot, value):
+        # Zero deletes the slot, as in `write`
+        if value:
+            self.slots[(address, slot)] = value
+        else:
+            self.slots.pop((address, slot), None)
+
+    def write(self, accounts, slots, cleared):
+        # accounts: {address: (balance, nonce, code), or None to delete it}
+        # slots: {(address, slot): value, 0 to delete it}
+        # cleared: addresses whose storage is deleted before `slots` apply
+        cleared = set(cleared)
+        if cleared:
+            for key in [key for key in self.slots if key[0] in cleared]:
+                del self.slots[key]
+        for address, fields in accounts.items():
+            if fields is None:
+                self.accounts.pop(address, None)
+            else:
+                self.accounts[address] = fields
+        for key, value in slots.items():
+            if value:
+                self.slots[key] = value
+            else:
+                self.slots.pop(key, None)
+
+    def close(self):
+        pass
+
+
+class SqliteBackend(DictBackend):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS account (
+            address BLOB PRIMARY KEY,
+            balance BLOB NOT NULL,
+            nonce INTEGER NOT NULL,
+            code BLOB NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS slot (
+            address BLOB NOT NULL,
+            slot BLOB NOT NULL,
+            value BLOB NOT NULL,
+            PRIMARY KEY (address, slot)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.SCHEMA)
+
+    @classmethod
+    def from_json(cls, state, path):
+        backend = cls(path)
+        backend.import_world(WorldState.from_json(state))
+        return backend
+
+    def load_account(self, address):
+        row = self.db.execute(
+            'SELECT balance, nonce, code FROM account WHERE address = ?',
+            (address.to_bytes(20, 'big'),),
+        ).fetchone()
+        if row is None:
+            return None
+        return (decode_word(row[0]), row[1], bytes(row[2]))
+
+    def load_slot(self, address, slot):
+        row = self.db.execute(
+            'SELECT value FROM slot WHERE address = ? AND slot = ?',
+            (address.to_bytes(20, 'big'), encode_word(slot)),
+        ).fetchone()
+        return decode_word(row[0]) if row is not None else 0
+
+    def load_slots(self, address):
+        rows = self.db.execute('SELECT slot, value FROM slot WHERE address = ?', (address.to_bytes(20, 'big'),))
+        return {decode_word(slot): decode_word(value) for slot, value in rows}
+
+    def addresses(self):
+        return [int.from_bytes(row[0], 'big') for row in self.db.execute('SELECT address FROM account')]
+
+    def store_slot(self, address, slot, value):
+        self.write({}, {(address, slot): value}, ())
+
+    def write(self, accounts, slots, cleared):
+        # Same arguments as `DictBackend.write`, applied in one transaction
+        with self.db:
+            self.db.executemany(
+                'DELETE FROM slot WHERE address = ?',
+                [(address.to_bytes(20, 'big'),) for address in cleared],
+            )
+            self.db.executemany(
+                'DELETE FROM account WHERE address = ?',
+                [(address.to_bytes(20, 'big'),) for address, fields in accounts.items() if fields is None],
+            )
+            self.db.executemany(
+                'INSERT OR REPLACE INTO account VALUES (?, ?, ?, ?)',
+                [
+                    (address.to_bytes(20, 'big'), encode_word(fields[0]), fields[1], fields[2])
+                    for address, fields in accounts.items() if fields is not None
+                ],
+            )
+            self.db.executemany(
+                'DELETE FROM slot WHERE address = ? AND slot = ?',
+                [(address.to_bytes(20, 'big'), encode_word(slot)) for (address, slot), value in slots.items() if not value],
+            )
+            self.db.executemany(
+                'INSERT OR REPLACE INTO slot VALUES (?, ?, ?)',
+                [
+                    (address.to_bytes(20, 'big'), encode_word(slot), encode_word(value))
+                    for (address, slot), value in slots.items() if value
+                ],
+            )
+
+    def close(self):
+        self.db.close()
+
+
+class BackedStorage(dict):
+    # The storage of one account of a backend. Slots are loaded on first
+    # access, zero values are remembered in `loaded` but not stored, and
+    # changed slots are listed in `dirty` until they are written back.
+
+    def __init__(self, backend, address):
+        super().__init__()
+        self.backend = backend
+        self.address = address
+        self.loaded = set()
+        self.dirty = set()
+        self.complete = False
+
+    def load(self, slot):
+        if slot not in self.loaded:
+            self.loaded.add(slot)
+            value = self.backend.load_slot(self.address, slot)
+            if value:
+                dict.__setitem__(self, slot, value)
+
+    def load_all(self):
+        if not self.complete:
+            self.complete = True
+            for slot, value in self.backend.load_slots(self.address).items():
+                if slot not in self.loaded:
+                    self.loaded.add(slot)
+                    dict.__setitem__(self, slot, value)
+
+    def get(self, slot, default=None):
+        self.load(slot)
+        return dict.get(self, slot, default)
+
+    def __contains__(self, slot):
+        self.load(slot)
+        return dict.__contains__(self, slot)
+
+    def __getitem__(self, slot):
+        self.load(slot)
+        return dict.__getitem__(self, slot)
+
+    def __setitem__(self, slot, value):
+        self.loaded.add(slot)
+        self.dirty.add(slot)
+        dict.__setitem__(self, slot, value)
+
+    def __delitem__(self, slot):
+        self.load(slot)
+        self.dirty.add(slot)
+        dict.__delitem__(self, slot)
+
+    def pop(self, slot, *default):
+        self.load(slot)
+        self.dirty.add(slot)
+        return dict.pop(self, slot, *default)
+
+    # Iterating needs every slot: `Account.copy`, `Account.to_json`
+
+    def __iter__(self):
+        self.load_all()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.load_all()
+        return dict.__len__(self)
+
+    def keys(self):
+        self.load_all()
+        return dict.keys(self)
+
+    def values(self):
+        self.load_all()
+        return dict.values(self)
+
+    def items(self):
+        self.load_all()
+        return dict.items(self)
+
+    def changes(self):
+        # {slot: value} of the dirty slots, 0 when deleted
+        return {slot: dict.get(self, slot, 0) for slot in self.dirty}
+
+
+class BackedAccounts(dict):
+    # The accounts of a `PersistentWorldState`: loaded from the backend on
+    # first access, like `block_executor.Overlay`. `saved` has the fields of
+    # every loaded address as the backend has them, to find what changed.
+
+    def __init__(self, backend):
+        super().__init__()
+        self.backend = backend
+        self.saved = {}
+        self.complete = False
+
+    def load(self, address):
+        if address not in self.saved:
+            fields = self.backend.load_account(address)
+            self.saved[address] = fields
+            if fields is not None:
+                balance, nonce, code = fields
+                dict.__setitem__(self, address, Account(balance, nonce, code, BackedStorage(self.backend, address)))
+
+    def load_all(self):
+        if not self.complete:
+            self.complete = True
+            for address in self.backend.addresses():
+                self.load(address)
+
+    def get(self, address, default=None):
+        self.load(address)
+        return dict.get(self, address, default)
+
+    def __contains__(self, address):
+        self.load(address)
+        return dict.__contains__(self, address)
+
+    def __getitem__(self, address):
+        self.load(address)
+        return dict.__getitem__(self, address)
+
+    def __setitem__(self, address, account):
+        self.load(address)
+        dict.__setitem__(self, address, account)
+
+    def pop(self, address, *default):
+        self.load(address)
+        return dict.pop(self, address, *default)
+
+    def __iter__(self):
+        self.load_all()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.load_all()
+        return dict.__len__(self)
+
+    def keys(self):
+        self.load_all()
+        return dict.keys(self)
+
+    def values(self):
+        self.load_all()
+        return dict.values(self)
+
+    def items(self):
+        self.load_all()
+        return dict.items(self)
+
+    def is_backed(self, address, account):
+        # False for an account created in memory, whose storage replaces
+        # whatever the backend has for `address`
+        storage = account.storage
+        return isinstance(storage, BackedStorage) and storage.backend is self.backend and storage.address == address
+
+    def changes(self):
+        # The arguments of `backend.write` for everything changed in memory
+        accounts = {}
+        slots = {}
+        cleared = []
+        for address, saved in self.saved.items():
+            account = dict.get(self, address)
+            fields = (account.balance, account.nonce, account.code) if account is not None else None
+            if fields != saved:
+                accounts[address] = fields
+            if account is None:
+                if saved is not None:
+                    cleared.append(address)
+            elif self.is_backed(address, account):
+                for slot, value in account.storage.changes().items():
+                    slots[(address, slot)] = value
+            else:
+                if saved is not None:
+                    cleared.append(address)
+                for slot, value in account.storage.items():
+                    slots[(address, slot)] = value
+        return accounts, slots, cleared
+
+    def flush(self):
+        accounts, slots, cleared = self.changes()
+        if accounts or slots or cleared:
+            self.backend.write(accounts, slots, cleared)
+        # Everything in memory now matches the backend
+        for address in self.saved:
+            account = dict.get(self, address)
+            if account is None:
+                self.saved[address] = None
+                continue
+            self.saved[address] = (account.balance, account.nonce, account.code)
+            if self.is_backed(address, account):
+                account.storage.dirty.clear()
+            else:
+                storage = BackedStorage(self.backend, address)
+                dict.update(storage, account.storage)
+                storage.loaded.update(account.storage)
+                storage.complete = True
+                account.storage = storage
+
+    def evict(self):
+        # Forgets every loaded account; only safe right after `flush`
+        dict.clear(self)
+        self.saved.clear()
+        self.complete = False
+
+
+class PersistentWorldState(WorldState):
+    def __init__(self, backend, cache_size=DEFAULT_CACHE_SIZE, flush_every=DEFAULT_FLUSH_EVERY):
+        super().__init__(BackedAccounts(backend))
+        self.backend = backend
+        self.cache_size = cache_size
+        self.flush_every = flush_every
+        self.pending = 0
+
+    def commit(self):
+        super().commit()
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        # Writes the changes of the committed transactions to the backend.
+        # Call between transactions: the journal must be empty.
+        self.pending = 0
+        self.accounts.flush()
+        if len(self.accounts.saved) > self.cache_size:
+            self.accounts.evict()
+
+    def close(self):
+        self.commit()
+        self.flush()
+        self.backend.close()
+
+
+def check_fixtures():
+    # Every test of `evm.json`, run on a `PersistentWorldState` instead of
+    # a `WorldState`, must give the same results
+    import os
+
+    from fixtures import open_fixtures
+    from interpreter import execute
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'evm.json')
+    failures = 0
+    total = 0
+    with open_fixtures(path) as fixtures:
+        for fixture in fixtures:
+            total += 1
+            expected = execute(fixture.code, fixture.tx, fixture.block, fixture.world())
+            world = PersistentWorldState(DictBackend.from_json(fixture.data.get('state')))
+            result = execute(fixture.code, fixture.tx, fixture.block, world)
+            world.close()
+            if result != expected:
+                failures += 1
+                print(f"❌ {fixture.name}: {result} != {expected}")
+    return failures, total
+
+
+def check_restart(path, n=2000):
+    # Fills `n` slots through transactions, flushing in batches with a tiny
+    # cache, then reopens the file and reads them back
+    from interpreter import execute
+
+    contract = 0x1000
+    # SSTORE(calldata[0:32], calldata[32:64]), STOP
+    code = bytes([0x60, 0x20, 0x35, 0x60, 0x00, 0x35, 0x55, 0x00])
+    world = PersistentWorldState(SqliteBackend(path), cache_size=4, flush_every=50)
+    world.create_account(contract)
+    world.set_code(contract, code)
+    world.commit()
+    tx = {'to': '0x%040x' % contract}
+    for i in range(n):
+        tx['data'] = (i.to_bytes(32, 'big') + (i * i + 1).to_bytes(32, 'big')).hex()
+        execute(code, tx, None, world)
+        world.commit()
+    world.close()
+
+    world = PersistentWorldState(SqliteBackend(path))
+    wrong = [i for i in range(n) if world.get_storage(contract, i) != i * i + 1]
+    same_code = world.get_code(contract) == code
+    world.close()
+    return len(wrong) + (not same_code)
+
+
+def main():
+    import os
+    import sys
+    import tempfile
+
+    failures, total = check_fixtures()
+    print(f"{total - failures}/{total} tests give the same results on a persistent state")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(directory, 'state.db')
+        wrong = check_restart(path)
+    print("✓  state survives a restart" if not wrong else f"{wrong} values lost on restart")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Superinstructions
+#
+# Compiled contracts repeat the same few instruction sequences over and over:
+# a PUSH then JUMPI, MLOAD or ADD, a DUP then a SWAP, ISZERO PUSH JUMPI...
+# The basic-block engine (see `basic_blocks.py`) runs each instruction of
+# such a sequence as a separate call. This peephole pass replaces them,
+# inside a block, with one fused instruction that does the work of the whole
+# sequence in a single call, with the PUSH value bound as a constant.
+#
+# JUMPDESTs, which do nothing but be jumped to, are dropped from the
+# instructions (their gas is part of the gas of the block).
+#
+# A fused instruction first checks the stack height: if the sequence would
+# underflow or overflow half-way, it runs the original instructions one by
+# one instead, so it fails at the same point and leaves the same stack. The
+# unchecked instructions of a block (run when the stack height at entry was
+# checked for the whole block) are fused without that check.
+#
+# Which sequences are fused comes from profiles. `SequenceProfile` (see
+# `instrument.py`) counts the opcode sequences a corpus runs back to back,
+# and `select()` keeps the implemented ones (`TEMPLATES`) ranked by the
+# dispatches they save. `SELECTED` is the selection for `evm.json` and the
+# `bench.py` workloads; `use()` switches to another one.
+#
+# - Run `python3 superinstructions.py` to profile `evm.json` and the
+#   `bench.py` workloads, print the selection and, per workload, how many
+#   dispatches fusing saves and the time of the basic-block engine with and
+#   without it
+# - Run `python3 superinstructions.py --profile FILE` to profile another
+#   fixture file instead
+
+import argparse
+import os
+import sys
+import textwrap
+import time
+from collections import Counter
+from functools import partial
+
+from gas import OutOfGas
+from instrument import OPCODE_NAMES
+from interpreter import FAILURES, EVMError, Halt, SubCall, fail, use_memory
+from stack import STACK_LIMIT
+from uint256 import MAX_UINT256
+
+PUSH0 = 0x5f
+PUSH1 = 0x60
+PUSH32 = 0x7f
+PC = 0x58
+JUMPDEST = 0x5b
+DUP1 = 0x80
+DUP16 = 0x8f
+SWAP1 = 0x90
+SWAP16 = 0x9f
+
+
+def shape(op):
+    # What fused instructions match on: PUSHes (and PC, which the block
+    # engine decodes as a push of its pc), DUPs and SWAPs are one shape each
+    if PUSH0 <= op <= PUSH32 or op == PC:
+        return 'PUSH'
+    if DUP1 <= op <= DUP16:
+        return 'DUP'
+    if SWAP1 <= op <= SWAP16:
+        return 'SWAP'
+    return OPCODE_NAMES[op]
+
+
+JUMP_TO_V = '''\
+if not f.analysis.is_jumpdest(v):
+    raise EVMError('invalid jump destination')
+f.pc = v'''
+
+# shapes -> (condition on the stack to run fused, code). In both, `s` is the
+# stack, `v` and `w` the values of the first and second PUSH of the
+# sequence, `n` the index of its DUP and `m` the index of its SWAP.
+TEMPLATES = {
+    ('PUSH', 'ADD'): ('len(s) < L', 's.append((v + s.pop()) & M)'),
+    ('PUSH', 'SUB'): ('len(s) < L', 's.append((v - s.pop()) & M)'),
+    ('PUSH', 'MUL'): ('len(s) < L', 's.append((v * s.pop()) & M)'),
+    ('PUSH', 'AND'): ('len(s) < L', 's.append(v & s.pop())'),
+    ('PUSH', 'OR'): ('len(s) < L', 's.append(v | s.pop())'),
+    ('PUSH', 'EQ'): ('len(s) < L', 's.append(1 if v == s.pop() else 0)'),
+    ('PUSH', 'LT'): ('len(s) < L', 's.append(1 if v < s.pop() else 0)'),
+    ('PUSH', 'GT'): ('len(s) < L', 's.append(1 if v > s.pop() else 0)'),
+    ('PUSH', 'SHR'): ('len(s) < L', 's.append(s.pop() >> v)'),
+    ('PUSH', 'PUSH'): ('len(s) < L - 1', 's.append(v)\ns.append(w)'),
+    ('PUSH', 'SWAP'): ('m <= len(s) < L', 'x = s[-m]\ns[-m] = v\ns.append(x)'),
+    ('PUSH', 'MLOAD'): ('len(s) < L', 'use_memory(f, v, 32)\ns.append(f.memory.load_word(v))'),
+    ('PUSH', 'MSTORE'): ('len(s) < L', 'use_memory(f, v, 32)\nf.memory.store_word(v, s.pop())'),
+    ('PUSH', 'SLOAD'): ('len(s) < L', 's.append(f.world.get_storage(f.address, v))'),
+    ('PUSH', 'JUMP'): ('len(s) < L', JUMP_TO_V),
+    ('PUSH', 'JUMPI'): ('len(s) < L', 'if s.pop():\n' + textwrap.indent(JUMP_TO_V, '    ')),
+    ('ISZERO', 'PUSH', 'JUMPI'): ('len(s) < L', 'if not s.pop():\n' + textwrap.indent(JUMP_TO_V, '    ')),
+    ('DUP', 'SWAP'): ('n <= len(s) < L and m <= len(s)', 'x = s[-m]\ns[-m] = s[-n]\ns.append(x)'),
+    ('SWAP', 'POP'): ('m < len(s)', 's[-m] = s.pop()'),
+}
+
+NAMESPACE = {
+    'L': STACK_LIMIT,
+    'M': MAX_UINT256,
+    'EVMError': EVMError,
+    'use_memory': use_memory,
+}
+
+
+def compile_template(shapes, condition, code, checked=True):
+    # A function (v, w, n, m, slow) -> fused instruction
+    name = 'op_' + '_'.join(shapes).lower()
+    if checked:
+        body = f"if {condition}:\n{textwrap.indent(code, '    ')}\nelse:\n    slow(f)"
+    else:
+        body = code
+    source = (
+        f"def make(v, w, n, m, slow):\n"
+        f"    def {name}(f):\n"
+        f"        s = f.stack\n"
+        f"{textwrap.indent(body, ' ' * 8)}\n"
+        f"    return {name}\n"
+    )
+    namespace = dict(NAMESPACE)
+    exec(compile(source, f'<{name}>', 'exec'), namespace)
+    return namespace['make']
+
+
+MAKERS = {shapes: compile_template(shapes, *template) for shapes, template in TEMPLATES.items()}
+UNCHECKED_MAKERS = {
+    shapes: compile_template(shapes, *template, checked=False) for shapes, template in TEMPLATES.items()
+}
+
+# The selection for `evm.json` and the `bench.py` workloads, printed by
+# `python3 superinstructions.py`
+SELECTED = (
+    ('PUSH', 'SWAP'),
+    ('PUSH', 'PUSH'),
+    ('PUSH', 'JUMPI'),
+    ('PUSH', 'MSTORE'),
+    ('PUSH', 'ADD'),
+    ('PUSH', 'MLOAD'),
+    ('PUSH', 'SLOAD'),
+    ('PUSH', 'JUMP'),
+    ('PUSH', 'MUL'),
+    ('DUP', 'SWAP'),
+    ('SWAP', 'POP'),
+    ('PUSH', 'LT'),
+    ('PUSH', 'GT'),
+    ('PUSH', 'SHR'),
+    ('PUSH', 'SUB'),
+    ('PUSH', 'EQ'),
+    ('PUSH', 'AND'),
+    ('PUSH', 'OR'),
+)
+
+# The sequences in use
+enabled = set(SELECTED)
+
+
+def use(selection):
+    # Fuses the sequences of `selection` in code analysed from now on (the
+    # decoded blocks of code analysed before stay as they are)
+    from analysis import code_cache
+
+    enabled.clear()
+    enabled.update(selection)
+    code_cache.clear()
+
+
+def run_each(instructions, f):
+    for instruction in instructions:
+        instruction(f)
+
+
+def fuse_sequence(entries, instructions, maker):
+    # The fused instruction for the decoded `entries` (pc, opcode, immediate)
+    # of a sequence, and their `instructions`
+    pushes = [immediate for _, _, immediate in entries if immediate is not None] + [None, None]
+    n = m = None
+    for _, op, _ in entries:
+        if DUP1 <= op <= DUP16 and n is None:
+            n = op - DUP1 + 1
+        elif SWAP1 <= op <= SWAP16 and m is None:
+            m = op - SWAP1 + 1
+    return maker(pushes[0], pushes[1], n, m, partial(run_each, tuple(instructions)))
+
+
+def fuse(ops, instructions, selection=None, checked=True):
+    # The instructions of a block, with the sequences of `selection` (by
+    # default the ones in use) fused, longest first, and without JUMPDESTs.
+    # An empty selection leaves them as they are.
+    makers = MAKERS if checked else UNCHECKED_MAKERS
+    makers = {shapes: makers[shapes] for shapes in (enabled if selection is None else selection)}
+    if not makers:
+        return tuple(instructions)
+    lengths = sorted({len(shapes) for shapes in makers}, reverse=True)
+    shapes = [shape(op) for _, op, _ in ops]
+    fused = []
+    i = 0
+    while i < len(ops):
+        if ops[i][1] == JUMPDEST:
+            i += 1
+            continue
+        for length in lengths:
+            maker = makers.get(tuple(shapes[i:i + length])) if i + length <= len(ops) else None
+            if maker is not None:
+                fused.append(fuse_sequence(ops[i:i + length], instructions[i:i + length], maker))
+                i += length
+                break
+        else:
+            fused.append(instructions[i])
+            i += 1
+    return tuple(fused)
+
+
+def select(counts, limit=None):
+    # The implemented sequences of a profile ((opcode, ...) -> count, see
+    # `SequenceProfile`), most dispatches saved first
+    saved = Counter()
+    for ops, count in counts.items():
+        shapes = tuple(shape(op) for op in ops)
+        if shapes in TEMPLATES:
+            saved[shapes] += count * (len(shapes) - 1)
+    return tuple(shapes for shapes, _ in saved.most_common(limit))
+
+
+def run_counted(counts, f):
+    # `basic_blocks.run_blocks` that adds up the instructions of the blocks
+    # it enters: counts[0] as decoded, counts[1] after fusing
+    from basic_blocks import get_blocks
+
+    blocks = get_blocks(f.analysis)
+    try:
+        pc = f.pc
+        while True:
+            block = blocks.get(pc)
+            if block is None:
+                break
+            counts[0] += len(block.ops)
+            counts[1] += len(block.instructions)
+            gas = f.gas - block.static_gas
+            if gas < 0:
+                raise OutOfGas
+            f.gas = gas
+            f.pc = block.next
+            for instruction in block.instructions:
+                instruction(f)
+            pc = f.pc
+    except Halt:
+        pass
+    except FAILURES:
+        fail(f)
+    except SubCall as call:
+        return call.child
+    return None
+
+
+def count_dispatches(code, tx, block, state):
+    # (instructions dispatched without fusing, with fusing) of one execution
+    # on the basic-block engine. A block that fails half-way counts whole.
+    from interpreter import run, run_frames
+
+    counts = [0, 0]
+    run(lambda f: run_frames(f, partial(run_counted, counts)), code, tx, block, state)
+    return counts
+
+
+def fixture_corpus(path):
+    # (workload, code, tx, block, state) of every case of a fixture file,
+    # all in one workload named after the file
+    from fixtures import open_fixtures
+
+    name = os.path.basename(path)
+    with open_fixtures(path) as fixtures:
+        return [(name, fixture.code, fixture.tx, fixture.block, fixture.data.get('state')) for fixture in fixtures]
+
+
+def bench_corpus(iterations):
+    # (workload, code, tx, block, state) of every `bench.py` workload
+    from bench import WORKLOADS, build_workload
+
+    corpus = []
+    for name, build in WORKLOADS.items():
+        code, _, state = build_workload(build, iterations)
+        corpus.append((name, code, {}, {}, state))
+    return corpus
+
+
+def profile(corpus):
+    # The `SequenceProfile` of running every execution of `corpus`
+    import copy
+
+    from instrument import SequenceProfile, trace
+
+    sequences = SequenceProfile()
+    for _, code, tx, block, state in corpus:
+        trace(code, tx, block, copy.deepcopy(state), [sequences])
+    return sequences
+
+
+def timed(code, tx, block, state, repeat=3):
+    # Fastest of `repeat` runs on the basic-block engine, in seconds
+    import copy
+
+    from basic_blocks import execute
+
+    best = None
+    for _ in range(repeat):
+        run_state = copy.deepcopy(state)
+        start = time.perf_counter()
+        execute(code, tx, block, run_state)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report(corpus, selection, out=sys.stdout):
+    # Dispatches and time per workload of `corpus`, without and with fusing
+    import copy
+
+    from analysis import code_cache
+    from basic_blocks import decode_blocks
+
+    # workload -> [dispatches, fused dispatches, seconds, fused seconds]
+    workloads = {}
+    for name, code, tx, block, state in corpus:
+        analysis = code_cache.lookup(code)
+        analysis.blocks = decode_blocks(code, ())
+        plain = timed(code, tx, block, state)
+        analysis.blocks = decode_blocks(code, selection)
+        fused = timed(code, tx, block, state)
+        before, after = count_dispatches(code, tx, block, copy.deepcopy(state))
+        totals = workloads.setdefault(name, [0, 0, 0.0, 0.0])
+        for i, value in enumerate((before, after, plain, fused)):
+            totals[i] += value
+    workloads['total'] = [sum(totals[i] for totals in workloads.values()) for i in range(4)]
+
+    print(f"{'workload':>14} {'dispatches':>10} {'fused':>10} {'saved':>6} {'time':>9} {'fused':>9} {'saved':>6}",
+          file=out)
+    for name, (before, after, plain, fused) in workloads.items():
+        print(f"{name:>14} {before:>10,} {after:>10,} {1 - after / (before or 1):>6.1%} "
+              f"{plain * 1000:>7.2f}ms {fused * 1000:>7.2f}ms {1 - fused / plain:>6.1%}", file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pick superinstructions from profiles and report what they save")
+    parser.add_argument('--profile', action='append',
+                        help="fixture file to profile (repeatable, default: evm.json and the bench.py workloads)")
+    parser.add_argument('--iterations', type=int, default=1000, help="loop iterations of the bench.py workloads")
+    parser.add_argument('--limit', type=int, help="fuse at most this many sequences")
+    parser.add_argument('--top', type=int, default=20, help="sequences to list from the profile")
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        corpus = [case for path in args.profile for case in fixture_corpus(path)]
+    else:
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+        corpus = fixture_corpus(os.path.join(root, 'evm.json')) + bench_corpus(args.iterations)
+
+    sequences = profile(corpus)
+    sequences.report(top=args.top)
+    selection = select(sequences.counts, args.limit)
+    print("\nSELECTED = (")
+    for shapes in selection:
+        print(f"    {shapes!r},")
+    print(")\n")
+    use(selection)
+    report(corpus, selection)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# Streaming traces
+#
+# A long transaction runs tens of millions of steps, so its trace can't be
+# collected in memory. `StreamingTrace` is a tracer (see `instrument.py`)
+# that pushes every record through a pipeline of generators as soon as the
+# step runs:
+#
+#     StreamingTrace -> encode -> write -> file, pipe or compressed stream
+#
+# `write` keeps at most `buffer_size` bytes of encoded lines before writing
+# them out, so memory use stays flat however long the execution is.
+#
+# Sampling is done in the tracer, before a record is even built:
+#
+# - `every=N` keeps every Nth step
+# - `boundaries=True` keeps only the steps that enter or leave a call frame
+#   (the CALL and CREATE family, RETURN, REVERT, STOP, SELFDESTRUCT, ...)
+#
+# The summary line of the outermost frame is always written.
+#
+#     with open_trace('trace.jsonl.gz') as out:
+#         trace(code, tx, block, state, [StreamingTrace(out, every=100)])
+
+import gzip
+import json
+import lzma
+import sys
+
+from instrument import Tracer, step_record, summary_record
+
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+# Opcodes after which execution continues in another frame
+BOUNDARIES = frozenset([
+    0x00,  # STOP
+    0xf0,  # CREATE
+    0xf1,  # CALL
+    0xf2,  # CALLCODE
+    0xf3,  # RETURN
+    0xf4,  # DELEGATECALL
+    0xf5,  # CREATE2
+    0xfa,  # STATICCALL
+    0xfd,  # REVERT
+    0xfe,  # INVALID
+    0xff,  # SELFDESTRUCT
+])
+
+
+def open_trace(path, compress=None):
+    # Binary file for a trace. `compress` is None, 'gzip' or 'xz', and is
+    # guessed from the file name when None. '-' is stdout.
+    if compress is None:
+        if path.endswith('.gz'):
+            compress = 'gzip'
+        elif path.endswith('.xz'):
+            compress = 'xz'
+    if path == '-':
+        out = sys.stdout.buffer
+        if compress == 'gzip':
+            return gzip.GzipFile(fileobj=out, mode='wb')
+        if compress == 'xz':
+            return lzma.LZMAFile(out, mode='wb')
+        return out
+    if compress == 'gzip':
+        return gzip.open(path, 'wb')
+    if compress == 'xz':
+        return lzma.open(path, 'wb')
+    return open(path, 'wb')
+
+
+def write(out, buffer_size=DEFAULT_BUFFER_SIZE):
+    # Receives encoded lines, writes them to `out` in chunks of about
+    # `buffer_size` bytes. Closing the generator writes what is left.
+    buffer = []
+    size = 0
+    try:
+        while True:
+            line = yield
+            buffer.append(line)
+            size += len(line)
+            if size >= buffer_size:
+                out.write(b''.join(buffer))
+                buffer.clear()
+                size = 0
+    finally:
+        if buffer:
+            out.write(b''.join(buffer))
+        out.flush()
+
+
+def encode(target):
+    # Receives records, sends them to `target` as JSON lines
+    try:
+        while True:
+            record = yield
+            target.send(json.dumps(record).encode() + b"\n")
+    finally:
+        target.close()
+
+
+def start(generator):
+    next(generator)
+    return generator
+
+
+class StreamingTrace(Tracer):
+    def __init__(self, out, every=1, boundaries=False, stack_items=None, buffer_size=DEFAULT_BUFFER_SIZE):
+        if every < 1:
+            raise ValueError(f"every must be at least 1, got {every}")
+        self.pipeline = start(encode(start(write(out, buffer_size))))
+        self.every = every
+        self.boundaries = boundaries
+        self.stack_items = stack_items
+        self.steps = 0
+        self.written = 0
+
+    def step(self, f, op, depth):
+        self.steps += 1
+        if self.boundaries:
+            if op not in BOUNDARIES:
+                return
+        elif self.steps % self.every:
+            return
+        self.written += 1
+        self.pipeline.send(step_record(f, op, depth, self.stack_items))
+
+    def exit(self, f, depth):
+        if depth == 1:
+            self.pipeline.send(summary_record(f))
+            self.close()
+
+    def close(self):
+        # Writes out what is buffered; safe to call more than once
+        self.pipeline.close()
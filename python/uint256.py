@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# 256-bit arithmetic
+#
+# Stack values are Python ints in [0, 2**256). Signed opcodes read them as
+# two's complement: a value is negative when its sign bit (2**255) is set,
+# whatever its bit length. Everything here is integer-only (no float
+# division, which loses precision past 2**53) and the masks are constants
+# computed once at import time.
+#
+# The engines inline the cheap operations (ADD, LT, ...) and call the
+# functions below for the signed ones.
+#
+# - Run `python3 uint256.py` to check every function against a slower,
+#   independently written reference on random and edge-case operands, and
+#   the engines against each other on the same operands
+
+MODULUS = 2**256
+MAX_UINT256 = MODULUS - 1
+SIGN_BIT = 2**255
+
+# SIGNEXTEND masks by byte index b < 31: the sign bit of byte b, and the
+# bits above it that get filled
+SIGNEXTEND_SIGN_BITS = tuple(1 << (8 * b + 7) for b in range(31))
+SIGNEXTEND_FILL = tuple(MAX_UINT256 ^ ((1 << (8 * b + 8)) - 1) for b in range(31))
+
+
+def to_signed(num):
+    return num - MODULUS if num & SIGN_BIT else num
+
+
+def to_unsigned(num):
+    return num & MAX_UINT256
+
+
+def sdiv(a, b):
+    # Truncates towards zero; -2**255 / -1 overflows back to -2**255
+    a = to_signed(a)
+    b = to_signed(b)
+    if b == 0:
+        return 0
+    value = abs(a) // abs(b)
+    return (-value if (a < 0) != (b < 0) else value) & MAX_UINT256
+
+
+def smod(a, b):
+    # The result has the sign of `a`
+    a = to_signed(a)
+    b = to_signed(b)
+    if b == 0:
+        return 0
+    value = abs(a) % abs(b)
+    return (-value if a < 0 else value) & MAX_UINT256
+
+
+def signextend(b, x):
+    # Extends the sign of byte `b` (0 = least significant) of `x`
+    if b >= 31:
+        return x
+    fill = SIGNEXTEND_FILL[b]
+    return x | fill if x & SIGNEXTEND_SIGN_BITS[b] else x & (MAX_UINT256 ^ fill)
+
+
+def slt(a, b):
+    return 1 if to_signed(a) < to_signed(b) else 0
+
+
+def sgt(a, b):
+    return 1 if to_signed(a) > to_signed(b) else 0
+
+
+def byte(i, x):
+    return (x >> (8 * (31 - i))) & 0xff if i < 32 else 0
+
+
+def shl(shift, x):
+    return (x << shift) & MAX_UINT256 if shift < 256 else 0
+
+
+def shr(shift, x):
+    return x >> shift if shift < 256 else 0
+
+
+def sar(shift, x):
+    # Python's >> on negative ints already fills with 1s
+    return (to_signed(x) >> min(shift, 256)) & MAX_UINT256
+
+
+def div(a, b):
+    return a // b if b else 0
+
+
+def mod(a, b):
+    return a % b if b else 0
+
+
+def addmod(a, b, n):
+    return (a + b) % n if n else 0
+
+
+def mulmod(a, b, n):
+    return (a * b) % n if n else 0
+
+
+def exp(a, exponent):
+    return pow(a, exponent, MODULUS)
+
+
+# Reference implementations for the differential check: written another way
+# (through bytes and floor division), so a shared mistake is unlikely
+
+def ref_to_signed(x):
+    return int.from_bytes(x.to_bytes(32, 'big'), 'big', signed=True)
+
+
+def ref_to_unsigned(v):
+    return int.from_bytes((v % MODULUS).to_bytes(32, 'big'), 'big')
+
+
+def ref_truncating_div(a, b):
+    q = a // b
+    if q < 0 and q * b != a:
+        q += 1
+    return q
+
+
+def ref_sdiv(a, b):
+    a, b = ref_to_signed(a), ref_to_signed(b)
+    return 0 if b == 0 else ref_to_unsigned(ref_truncating_div(a, b))
+
+
+def ref_smod(a, b):
+    a, b = ref_to_signed(a), ref_to_signed(b)
+    return 0 if b == 0 else ref_to_unsigned(a - b * ref_truncating_div(a, b))
+
+
+def ref_signextend(b, x):
+    if b >= 31:
+        return x
+    low = x.to_bytes(32, 'big')[31 - b:]
+    return ref_to_unsigned(int.from_bytes(low, 'big', signed=True))
+
+
+def ref_slt(a, b):
+    return int(ref_to_signed(a) < ref_to_signed(b))
+
+
+def ref_sgt(a, b):
+    return int(ref_to_signed(a) > ref_to_signed(b))
+
+
+def ref_byte(i, x):
+    return x.to_bytes(32, 'big')[i] if i < 32 else 0
+
+
+def ref_shl(shift, x):
+    return 0 if shift >= 256 else (x * 2**shift) % MODULUS
+
+
+def ref_shr(shift, x):
+    return 0 if shift >= 256 else x // 2**shift
+
+
+def ref_sar(shift, x):
+    bits = format(x, '0256b')
+    shift = min(shift, 256)
+    return int((bits[0] * shift + bits)[:256], 2)
+
+
+CHECKS = [
+    (sdiv, ref_sdiv, 0x05),
+    (smod, ref_smod, 0x07),
+    (signextend, ref_signextend, 0x0b),
+    (slt, ref_slt, 0x12),
+    (sgt, ref_sgt, 0x13),
+    (byte, ref_byte, 0x1a),
+    (shl, ref_shl, 0x1b),
+    (shr, ref_shr, 0x1c),
+    (sar, ref_sar, 0x1d),
+]
+
+EDGE_CASES = [
+    0, 1, 2, 7, 31, 32, 255, 256, 257,
+    SIGN_BIT - 1, SIGN_BIT, SIGN_BIT + 1,
+    MAX_UINT256 - 1, MAX_UINT256,
+    2**64, 2**128 - 1, MODULUS - 2**64,
+]
+
+
+def operands(rng, n):
+    # Edge cases paired with each other, then random values of random sizes
+    # (small ones, so shifts and byte indexes are in range too)
+    for a in EDGE_CASES:
+        for b in EDGE_CASES:
+            yield a, b
+    for _ in range(n):
+        yield tuple(
+            rng.choice([rng.getrandbits(rng.randint(1, 256)), rng.randrange(300), rng.choice(EDGE_CASES)])
+            for _ in range(2)
+        )
+
+
+def check(n=20000, seed=0):
+    import random
+
+    rng = random.Random(seed)
+    failures = 0
+    for a, b in operands(rng, n):
+        for function, reference, _ in CHECKS:
+            if function(a, b) != reference(a, b):
+                failures += 1
+                print(f"❌ {function.__name__}({hex(a)}, {hex(b)}) = {hex(function(a, b))}, expected {hex(reference(a, b))}")
+        # Properties: a == b * (a sdiv b) + (a smod b) for b != 0
+        if b and ref_to_signed(a) != ref_to_signed(b) * ref_to_signed(sdiv(a, b)) + ref_to_signed(smod(a, b)) \
+                and not (a == SIGN_BIT and b == MAX_UINT256):
+            failures += 1
+            print(f"❌ sdiv/smod identity for {hex(a)}, {hex(b)}")
+        if to_unsigned(to_signed(a)) != a:
+            failures += 1
+            print(f"❌ to_signed round trip for {hex(a)}")
+    return failures
+
+
+def check_engines(n=300, seed=1):
+    # Runs every checked opcode as `PUSH32 b PUSH32 a OP` on each engine and
+    # compares the results with the reference
+    import random
+
+    from evm import ENGINES
+
+    rng = random.Random(seed)
+    failures = 0
+    cases = list(operands(rng, n))
+    for name, engine in ENGINES.items():
+        for a, b in cases:
+            for _, reference, op in CHECKS:
+                code = bytes([0x7f]) + b.to_bytes(32, 'big') + bytes([0x7f]) + a.to_bytes(32, 'big') + bytes([op])
+                success, stack, logs, ret, gas_used = engine(code, {}, {}, {}, False)
+                if stack != [reference(a, b)]:
+                    failures += 1
+                    print(f"❌ {name}: opcode {hex(op)} on {hex(a)}, {hex(b)} gave {[hex(x) for x in stack]}")
+    return failures
+
+
+if __name__ == '__main__':
+    failures = check() + check_engines()
+    print("✓  uint256 matches the reference" if not failures else f"{failures} mismatches")
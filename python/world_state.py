@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+# EVM From Scratch
+# World state
+#
+# `WorldState` maps addresses (ints) to `Account`s (see `model.py`), each
+# with its own storage. Nothing is global: every execution gets its own
+# `WorldState`, or shares one explicitly. `from_json` / `to_json` convert
+# from and to the `state` format of `evm.json`.
+#
+# All changes are made in place and recorded in an undo journal. A snapshot
+# is just the current length of the journal, and reverting pops and undoes
+# the entries recorded after it, so the cost of a revert is proportional to
+# the number of changes made since the snapshot, not to the size of the
+# state. The interpreter takes a snapshot at every CALL and CREATE and
+# reverts to it when the sub-context fails.
+
+from hashing import keccak256
+
+from model import Account, format_address
+
+# Journal entry kinds
+ACCOUNT = 0
+FIELD = 1
+STORAGE = 2
+
+# Marks an account or slot that did not exist before a change
+MISSING = object()
+
+
+class WorldState:
+    def __init__(self, accounts=None):
+        self.accounts = accounts if accounts is not None else {}
+        self.journal = []
+
+    @classmethod
+    def from_json(cls, state):
+        if not state:
+            return cls()
+        return cls({
+            int(address, 16): Account.from_json(account)
+            for address, account in state.items()
+        })
+
+    def to_json(self):
+        return {
+            format_address(address): account.to_json()
+            for address, account in self.accounts.items()
+        }
+
+    def copy(self):
+        # Independent copy of the accounts, without the journal. Code and
+        # its analysis are shared, they are never changed in place.
+        return WorldState({address: account.copy() for address, account in self.accounts.items()})
+
+    # Snapshots
+
+    def snapshot(self):
+        return len(self.journal)
+
+    def revert(self, snapshot):
+        journal = self.journal
+        while len(journal) > snapshot:
+            entry = journal.pop()
+            kind = entry[0]
+            if kind == ACCOUNT:
+                _, address, previous = entry
+                if previous is MISSING:
+                    self.accounts.pop(address, None)
+                else:
+                    self.accounts[address] = previous
+            elif kind == FIELD:
+                _, account, name, previous = entry
+                setattr(account, name, previous)
+            else:
+                _, slots, slot, previous = entry
+                if previous is MISSING:
+                    slots.pop(slot, None)
+                else:
+                    slots[slot] = previous
+
+    def commit(self):
+        # Forget the undo information, e.g. at the end of a transaction
+        self.journal.clear()
+
+    # Accounts
+
+    def exists(self, address):
+        return address in self.accounts
+
+    def get_account(self, address):
+        return self.accounts.get(address)
+
+    def _touch(self, address):
+        # The account at `address`, created empty if needed
+        account = self.accounts.get(address)
+        if account is None:
+            account = Account()
+            self.accounts[address] = account
+            self.journal.append((ACCOUNT, address, MISSING))
+        return account
+
+    def _set_field(self, account, name, value):
+        self.journal.append((FIELD, account, name, getattr(account, name)))
+        setattr(account, name, value)
+
+    def get_balance(self, address):
+        account = self.accounts.get(address)
+        return account.balance if account is not None else 0
+
+    def set_balance(self, address, balance):
+        self._set_field(self._touch(address), 'balance', balance)
+
+    def transfer(self, sender, recipient, value):
+        # False, and nothing changes, if `sender` cannot afford `value`
+        balance = self.get_balance(sender)
+        if balance < value:
+            return False
+        if value:
+            self.set_balance(sender, balance - value)
+            self.set_balance(recipient, self.get_balance(recipient) + value)
+        return True
+
+    def get_nonce(self, address):
+        account = self.accounts.get(address)
+        return account.nonce if account is not None else 0
+
+    def increment_nonce(self, address):
+        account = self._touch(address)
+        self._set_field(account, 'nonce', account.nonce + 1)
+
+    def get_code(self, address):
+        account = self.accounts.get(address)
+        return account.code if account is not None else b''
+
+    def create_account(self, address):
+        # A fresh account keeps the balance already sent to its address
+        previous = self.accounts.get(address, MISSING)
+        balance = previous.balance if previous is not MISSING else 0
+        self.journal.append((ACCOUNT, address, previous))
+        self.accounts[address] = Account(balance=balance)
+
+    def set_code(self, address, code):
+        account = self._touch(address)
+        self._set_field(account, 'code', code)
+        self._set_field(account, 'analysis', None)
+
+    def delete_account(self, address):
+        if address in self.accounts:
+            self.journal.append((ACCOUNT, address, self.accounts.pop(address)))
+
+    # Storage
+
+    def get_storage(self, address, slot):
+        account = self.accounts.get(address)
+        return account.storage.get(slot, 0) if account is not None else 0
+
+    def set_storage(self, address, slot, value):
+        account = self.accounts.get(address)
+        slots = (account if account is not None else self._touch(address)).storage
+        previous = slots.get(slot, MISSING)
+        if previous is MISSING and not value:
+            return
+        self.journal.append((STORAGE, slots, slot, previous))
+        if value:
+            slots[slot] = value
+        else:
+            del slots[slot]
+
+
+def rlp_encode_bytes(data):
+    if len(data) == 1 and data[0] < 0x80:
+        return data
+    return bytes([0x80 + len(data)]) + data
+
+
+def create_address(sender, nonce):
+    # keccak256(rlp([sender, nonce]))[12:]
+    sender = sender.to_bytes(20, 'big')
+    nonce = nonce.to_bytes((nonce.bit_length() + 7) // 8, 'big')
+    payload = rlp_encode_bytes(sender) + rlp_encode_bytes(nonce)
+    return int.from_bytes(keccak256(bytes([0xc0 + len(payload)]) + payload)[12:], 'big')